@@ -0,0 +1,83 @@
+""" Measures the startup cost paid by every crawler process: the time to
+    import the command line module and to run --help in a new interpreter,
+    over an empty interpreter. Also checks that importing the package leaves
+    nothing behind in the working directory (e.g. a logs/ folder), and can
+    list the slowest imports reported by python -X importtime.
+
+    python benchmarks/import_time.py --runs 20 --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    'python': ['-c', 'pass'],
+    'import': ['-c', 'import opendatacrawler.__main__'],
+    '--help': ['-m', 'opendatacrawler', '--help']
+}
+
+
+def run(args, cwd, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def slowest_imports(cwd, env, top):
+    """ Modules with the highest cumulative import time, in ms"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', COMMANDS['import'][1]],
+                            cwd=cwd, env=env, check=True, capture_output=True, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative) / 1000, name.rstrip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of the crawler.')
+    parser.add_argument('--runs', type=int, default=10, help='Interpreters started per command.')
+    parser.add_argument('--top', type=int, default=0, help='Also list the N slowest imports.')
+    parser.add_argument('--json', type=str, required=False, help='Also write the results to this file.')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    results = {}
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, command in COMMANDS.items():
+            # The first run warms the bytecode and filesystem caches.
+            run(command, cwd, env)
+            times = [run(command, cwd, env) for _ in range(args.runs)]
+            results[name] = {'median_ms': statistics.median(times) * 1000, 'min_ms': min(times) * 1000}
+        side_effects = os.listdir(cwd)
+        top = slowest_imports(cwd, env, args.top) if args.top else []
+
+    base = results['python']['median_ms']
+    print('{:<10}{:>12}{:>12}{:>14}'.format('command', 'median ms', 'min ms', 'over python'))
+    for name, result in results.items():
+        print('{:<10}{:>12.1f}{:>12.1f}{:>14.1f}'.format(name, result['median_ms'], result['min_ms'],
+                                                        result['median_ms'] - base))
+    print('Files left in the working directory: ' + (', '.join(side_effects) if side_effects else 'none'))
+    if top:
+        print('\nSlowest imports (cumulative ms):')
+        for ms, name in top:
+            print('{:>10.1f}  {}'.format(ms, name))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'results': results, 'side_effects': side_effects,
+                       'slowest_imports': top}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+""" Local stand-in for the portals supported by the crawler, used to benchmark
+    it without hitting zenodo.org or data.europa.eu.
+
+    data.europa.eu: /api/hub/search/ (detection), /api/hub/search/datasets/<id>,
+    /api/hub/search/search and /scroll (bulk harvest) and /sparql (id listing).
+    Zenodo: /api/records/ (detection), /api/records?q=&page=&size= (created and
+    updated date ranges in q, at most max_results deep) and /api/records/<id>. Files are served from /files/<name> with ETag and Range
+    support. Latency, error and throttling rates and file sizes are configurable,
+    and /_stats returns the requests, failures and file bytes served so far.
+
+    python benchmarks/mock_portal.py --portal dataeuropa --datasets 1000 --port 8000
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+DATASET_URI = 'http://data.europa.eu/88u/dataset/'
+# Zenodo records are created one hour apart from this date.
+RECORDS_START = datetime(2024, 1, 1)
+
+
+class MockServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops the connections opened at once by a crawl
+    # with hundreds of requests in flight, which then wait for SYN retries.
+    request_queue_size = 1024
+
+
+class MockPortal():
+    """ Mock portal server running in a background thread. Every request waits
+        latency seconds (plus up to jitter), and fails with a 500 or a 429 with
+        the given rates. Bodies of downloaded files are counted in stats."""
+
+    def __init__(self, portal='dataeuropa', datasets=1000, resources=2, file_size=64 * 1024,
+                 latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=0,
+                 max_results=10000, host='127.0.0.1', port=0, seed=0):
+        self.portal = portal
+        self.datasets = datasets
+        self.resources = resources
+        self.file_size = file_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_results = max_results
+        self.random = random.Random(seed)
+        self.file_body = bytes(range(256)) * (file_size // 256) + bytes(file_size % 256)
+        self.etag = '"' + hashlib.md5(self.file_body).hexdigest() + '"'
+        self.uris = sorted(DATASET_URI + 'd{}'.format(i) for i in range(datasets))
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+        self.server = MockServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = 'http://{}:{}'.format(host, self.server.server_address[1])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def fault(self):
+        """ Status code of an injected failure for the next request, if any"""
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    # Metadata of a dataset as returned by the hub search API.
+    def dataset(self, i):
+        return {
+            'id': 'd{}'.format(i),
+            'title': {'en': 'Dataset {}'.format(i)},
+            'description': {'en': 'Benchmark dataset {}'.format(i)},
+            'categories': [{'id': 'tech', 'label': {'en': 'Science and technology'}}],
+            'keywords': [{'id': 'benchmark', 'label': 'benchmark', 'language': 'en'}],
+            'publisher': {'name': 'Benchmark', 'resource': self.url},
+            'issued': '2024-01-01T00:00:00',
+            'modified': '2024-01-01T00:00:00',
+            'resource': DATASET_URI + 'd{}'.format(i),
+            'distributions': [{
+                'id': 'd{}-{}'.format(i, j),
+                'title': {'en': 'File {}'.format(j)},
+                'format': {'id': 'CSV'},
+                'download_url': [self.url + '/files/d{}-{}.csv'.format(i, j)],
+                'byte_size': self.file_size
+            } for j in range(self.resources)]
+        }
+
+    # Record as returned by the Zenodo records API.
+    def record(self, i):
+        created = RECORDS_START + timedelta(hours=i)
+        return {
+            'id': i,
+            'created': created.isoformat() + '+00:00',
+            'updated': (created + timedelta(days=i % 7)).isoformat() + '+00:00',
+            'metadata': {
+                'title': 'Record {}'.format(i),
+                'description': 'Benchmark record {}'.format(i),
+                'keywords': ['benchmark'],
+                'publication_date': '2024-01-01',
+                'resource_type': {'type': 'dataset'},
+                'license': {'id': 'cc-by-4.0'}
+            },
+            'files': [{
+                'id': 'r{}-{}'.format(i, j),
+                'key': 'file{}.csv'.format(j),
+                'size': self.file_size,
+                'links': {'self': self.url + '/files/r{}-{}.csv'.format(i, j)}
+            } for j in range(self.resources)],
+            'links': {'self': self.url + '/api/records/{}'.format(i)}
+        }
+
+    def sparql(self, query):
+        if 'count(' in query:
+            return {'results': {'bindings': [{'total': {'value': str(self.datasets)}}]}}
+        uris = self.uris
+        shard = re.search(r'MD5\(STR\(\?dataset\)\), "(\w+)"', query)
+        if shard:
+            uris = [uri for uri in uris if hashlib.md5(uri.encode()).hexdigest().startswith(shard.group(1))]
+        last = re.search(r'STR\(\?dataset\) > "([^"]*)"', query)
+        if last:
+            uris = [uri for uri in uris if uri > last.group(1)]
+        limit = re.search(r'LIMIT (\d+)', query)
+        if limit:
+            uris = uris[:int(limit.group(1))]
+        return {'results': {'bindings': [{'dataset': {'value': uri}} for uri in uris]}}
+
+    def records_page(self, page, size, q=''):
+        ids = range(self.datasets)
+        window = re.search(r'(created|updated):\["?([^" ]+)"? TO "?([^" \]}]+)"?([\]}])', q)
+        if window:
+            field, low, high, bracket = window.groups()
+            dates = [self.record(i)[field][:19] for i in ids]
+            ids = [i for i in ids if low <= dates[i] and (dates[i] <= high if bracket == ']' else dates[i] < high)]
+        if page * size > self.max_results:
+            return None
+        start = (page - 1) * size
+        links = {}
+        if start + size < len(ids):
+            links['next'] = self.url + '/api/records?page={}&size={}'.format(page + 1, size)
+        return {'hits': {'total': len(ids), 'hits': [self.record(i) for i in ids[start:start + size]]},
+                'links': links}
+
+    def search_page(self, offset, limit):
+        results = [self.dataset(i) for i in range(offset, min(offset + limit, self.datasets))]
+        scroll_id = '{}:{}'.format(offset + limit, limit) if offset + limit < self.datasets else None
+        return {'result': {'count': self.datasets, 'results': results, 'scrollId': scroll_id}}
+
+    def _handler(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, code, body=b'', content_type='application/json', headers=None):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def send_json(self, data):
+                self.send(200, json.dumps(data).encode())
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                if self.path == '/_stats':
+                    with portal.lock:
+                        return self.send_json(dict(portal.stats))
+                portal.count('requests')
+                if portal.latency or portal.jitter:
+                    time.sleep(portal.latency + portal.random.random() * portal.jitter)
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                path = url.path
+
+                fault = portal.fault()
+                if fault == 429:
+                    portal.count('throttled')
+                    return self.send(429, b'{}', headers={'Retry-After': str(portal.retry_after)})
+                if fault == 500:
+                    portal.count('errors')
+                    return self.send(500, b'{}')
+
+                try:
+                    if path.startswith('/files/'):
+                        return self.send_file()
+                    if portal.portal == 'dataeuropa':
+                        if path == '/api/hub/search/':
+                            return self.send_json({})
+                        if path.startswith('/api/hub/search/datasets/'):
+                            i = int(path.split('/')[-1][1:])
+                            if i >= portal.datasets:
+                                return self.send(404, b'{}')
+                            return self.send_json({'result': portal.dataset(i)})
+                        if path == '/api/hub/search/search':
+                            return self.send_json(portal.search_page(0, int(query['limit'][0])))
+                        if path == '/api/hub/search/scroll':
+                            offset, limit = map(int, query['scrollId'][0].split(':'))
+                            return self.send_json(portal.search_page(offset, limit))
+                        if path == '/sparql':
+                            return self.send_json(portal.sparql(query['query'][0]))
+                    if portal.portal == 'zenodo':
+                        if path == '/api/records/' and not query:
+                            return self.send_json(portal.records_page(1, 1))
+                        if path.rstrip('/') == '/api/records':
+                            page = portal.records_page(int(query.get('page', ['1'])[0]),
+                                                       int(query.get('size', ['10'])[0]),
+                                                       query.get('q', [''])[0])
+                            if page is None:
+                                # Deep pagination limit of the search API.
+                                return self.send(400, b'{"message": "Maximum number of results reached"}')
+                            return self.send_json(page)
+                        if path.startswith('/api/records/'):
+                            i = int(path.split('/')[-1])
+                            if i >= portal.datasets:
+                                return self.send(404, b'{}')
+                            return self.send_json(portal.record(i))
+                except (KeyError, ValueError):
+                    return self.send(400, b'{}')
+                return self.send(404, b'<html></html>', 'text/html')
+
+            def send_file(self):
+                body = portal.file_body
+                headers = {'ETag': portal.etag, 'Accept-Ranges': 'bytes'}
+                if self.headers.get('If-None-Match') == portal.etag:
+                    return self.send(304, headers=headers)
+                byte_range = self.headers.get('Range')
+                if byte_range:
+                    start, end = byte_range.split('=')[1].split('-')
+                    start = int(start)
+                    end = int(end) if end else len(body) - 1
+                    headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(body))
+                    body = body[start:end + 1]
+                    code = 206
+                else:
+                    code = 200
+                if self.command != 'HEAD':
+                    portal.count('bytes', len(body))
+                self.send(code, body, 'text/csv', headers)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock open data portal for benchmarks.')
+    parser.add_argument('--portal', choices=['dataeuropa', 'zenodo'], default='dataeuropa')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--datasets', type=int, default=1000)
+    parser.add_argument('--resources', type=int, default=2, help='Files per dataset.')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='Bytes per file.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra seconds, up to this value.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with 429.')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After seconds sent with 429s.')
+    parser.add_argument('--max-results', type=int, default=10000,
+                        help='Deepest Zenodo search result reachable with pagination.')
+    args = parser.parse_args()
+
+    portal = MockPortal(portal=args.portal, datasets=args.datasets, resources=args.resources,
+                        file_size=args.file_size, latency=args.latency, jitter=args.jitter,
+                        error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                        retry_after=args.retry_after, max_results=args.max_results,
+                        host=args.host, port=args.port)
+    print('Mock {} portal at {}'.format(args.portal, portal.url))
+    try:
+        portal.server.serve_forever()
+    except KeyboardInterrupt:
+        portal.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+""" Runs OpenDataCrawler end to end against the mock portal and reports
+    packages/s, MB/s, p50/p99 latency of the metadata and store stages and
+    peak RSS of the crawler process. Several concurrency values can be given
+    to compare them on the same mock portal.
+
+    python benchmarks/run_benchmark.py --datasets 2000 --latency 0.02 -c 5 20 50
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from mock_portal import MockPortal
+from opendatacrawler.portals.odcrawler import OpenDataCrawler
+from opendatacrawler.engine import AsyncCrawlEngine, ThreadCrawlEngine
+
+PORTAL_ARGS = ['portal', 'datasets', 'resources', 'file_size', 'latency', 'jitter',
+               'error_rate', 'throttle_rate', 'retry_after']
+
+
+def serve(options, urls):
+    """ Runs the mock portal in its own process, so it is not measured"""
+    portal = MockPortal(**options)
+    urls.put(portal.url)
+    portal.server.serve_forever()
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux.
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(function, samples):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+    return wrapper
+
+
+def atimed(function, samples):
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+    return wrapper
+
+
+def crawl(url, args, concurrency):
+    """ Crawls the mock portal once and returns the measures of the run"""
+    path = tempfile.mkdtemp(prefix='odc-bench-')
+    workers = concurrency * 2 if args.engine == 'async' else concurrency
+    metadata_times = []
+    store_times = []
+    stats_before = requests.get(url + '/_stats').json()
+    try:
+        start = time.perf_counter()
+        crawler = OpenDataCrawler(domain=url, path=path, only_metadata=args.metadata, workers=workers,
+                                  download_workers=args.downloads or concurrency, per_host=args.per_host,
+                                  rate=args.rate, bulk=args.bulk, metadata_format=args.metadata_format,
+                                  compression={'jsonl': 'gzip', 'parquet': 'zstd'}.get(args.metadata_format),
+                                  normalize_workers=args.normalize_workers)
+        if not crawler.dms:
+            raise RuntimeError('Mock portal not detected at ' + url)
+        if args.engine == 'async':
+            crawler.aget_package = atimed(crawler.aget_package, metadata_times)
+            crawler.astore_package = atimed(crawler.astore_package, store_times)
+            engine = AsyncCrawlEngine(crawler, concurrency=concurrency)
+        else:
+            crawler.get_package = timed(crawler.get_package, metadata_times)
+            crawler.store_package = timed(crawler.store_package, store_times)
+            engine = ThreadCrawlEngine(crawler, concurrency=concurrency)
+        try:
+            engine.run(crawler.get_package_list())
+        finally:
+            crawler.close()
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    stats = requests.get(url + '/_stats').json()
+    served = {key: stats[key] - stats_before[key] for key in stats}
+
+    return {
+        'engine': args.engine,
+        'concurrency': concurrency,
+        'packages': engine.total,
+        'seconds': round(elapsed, 3),
+        'packages_per_s': round(engine.total / elapsed, 2),
+        'mb_per_s': round(served['bytes'] / 1024 / 1024 / elapsed, 2),
+        'metadata_p50_ms': ms(percentile(metadata_times, 50)),
+        'metadata_p99_ms': ms(percentile(metadata_times, 99)),
+        'store_p50_ms': ms(percentile(store_times, 50)),
+        'store_p99_ms': ms(percentile(store_times, 99)),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'requests': served['requests'],
+        'errors': served['errors'],
+        'throttled': served['throttled']
+    }
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def print_table(results):
+    columns = ['engine', 'concurrency', 'packages', 'seconds', 'packages_per_s', 'mb_per_s',
+               'metadata_p50_ms', 'metadata_p99_ms', 'store_p50_ms', 'store_p99_ms', 'peak_rss_mb',
+               'requests', 'errors', 'throttled']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).rjust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the crawler against a local mock portal.')
+    # Mock portal.
+    parser.add_argument('--portal', choices=['dataeuropa', 'zenodo'], default='dataeuropa')
+    parser.add_argument('--datasets', type=int, default=500)
+    parser.add_argument('--resources', type=int, default=2, help='Files per dataset.')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='Bytes per file.')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds added to every request.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra seconds, up to this value.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with 429.')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After seconds sent with 429s.')
+    # Crawler.
+    parser.add_argument('-e', '--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[5],
+                        help='Concurrency values to compare, one crawl each.')
+    parser.add_argument('--downloads', type=int, required=False)
+    parser.add_argument('--per-host', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='Initial requests per second per host of the crawler.')
+    parser.add_argument('-m', '--metadata', action='store_true', help='Only save metadata.')
+    parser.add_argument('-b', '--bulk', action='store_true', help='Harvest metadata in bulk.')
+    parser.add_argument('--metadata-format', choices=['json', 'jsonl', 'parquet'], default='json')
+    parser.add_argument('--normalize-workers', type=int, default=0)
+    parser.add_argument('--json', type=str, required=False, help='Also write the results to this file.')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    urls = context.Queue()
+    options = {key: getattr(args, key) for key in PORTAL_ARGS}
+    server = context.Process(target=serve, args=(options, urls), daemon=True)
+    server.start()
+    try:
+        url = urls.get(timeout=30)
+        results = [crawl(url, args, concurrency) for concurrency in args.concurrency]
+    finally:
+        server.terminate()
+
+    print()
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
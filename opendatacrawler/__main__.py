@@ -1,10 +1,18 @@
 from .utils import utils
 from .utils import setup_logger
-from tqdm import tqdm
-from .portals.odcrawler import OpenDataCrawler
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from .utils import progress
+from .utils import metrics
+from .portals.odcrawler import OpenDataCrawler, CrawlPools
+from .batch import BatchCrawler, read_domains
+from .engine import AsyncCrawlEngine, ThreadCrawlEngine
+from .scheduler import PRIORITY_KEYS, PriorityScheduler
+from .distributed import Coordinator, Worker
+from .utils.workqueue import WorkQueue
+from .utils.ratelimit import SharedRateLimiter
+from .utils.cache import ResponseCache
 from sys import exit
 import argparse
+import importlib.util
 import os
 import traceback
 
@@ -15,70 +23,305 @@ def main():
     parser = argparse.ArgumentParser()
 
     # Arguments
-    parser.add_argument('-d', '--domain', type=str, required=True)
+    parser.add_argument('-d', '--domain', type=str, required=False)
+    parser.add_argument('--domains', type=str, required=False,
+                        help='Batch mode: crawl the domains of this file (one per line) in one process, '
+                             'sharing its threads and connections.')
+    parser.add_argument('--per-portal', type=int, default=5,
+                        help='Batch mode: maximum packages of the same portal crawled at the same time.')
+    parser.add_argument('--parallel-portals', type=int, default=10,
+                        help='Batch mode: portals crawled at the same time.')
     parser.add_argument('-p', '--path', type=str, required=False)
     parser.add_argument('-f', '--formats', nargs='+', required=False,
                         help='Filter which resources will be downloaded by format (csv, xlsx, pdf, zip)')
     parser.add_argument('-m','--metadata', required=False, action=argparse.BooleanOptionalAction,
                         help='Only save metadata.')
-  
+    parser.add_argument('-i', '--incremental', required=False, action=argparse.BooleanOptionalAction,
+                        help='Only download packages and resources modified since the previous run.')
+    parser.add_argument('-b', '--bulk', required=False, action=argparse.BooleanOptionalAction,
+                        help='Harvest metadata in pages of many packages when the portal supports it.')
+    parser.add_argument('-e', '--engine', choices=['threads', 'async'], default='threads',
+                        help='Crawl engine: a fixed thread pool, or separate metadata and download stages '
+                             'with non-blocking requests on asyncio (requires httpx).')
+    parser.add_argument('-c', '--concurrency', type=int, required=False,
+                        help='Number of concurrent packages (default 5 for threads, 100 for async).')
+    parser.add_argument('--downloads', type=int, required=False,
+                        help='Number of resources downloaded at the same time across all packages '
+                             '(default: same as concurrency).')
+    parser.add_argument('--per-host', type=int, default=8,
+                        help='Maximum simultaneous downloads from the same host.')
+    parser.add_argument('--max-time', type=int, default=60,
+                        help='Seconds spent on a file before the other downloads get a turn. It is resumed '
+                             'in the same run while it makes progress, otherwise in the next one (0 for no limit).')
+    parser.add_argument('--max-size', type=float, required=False,
+                        help='Skip files bigger than this many MB, checked before downloading them.')
+    parser.add_argument('--segments', type=int, default=1,
+                        help='Simultaneous Range requests used for big files when the server allows it.')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='Initial requests per second per host, adapted to 429/503 and rate limit headers.')
+    parser.add_argument('--dedup', required=False, action=argparse.BooleanOptionalAction,
+                        help='Store each distinct file once and link it from data/, reusing urls already downloaded.')
+    parser.add_argument('--normalize-workers', type=int, default=0,
+                        help='Processes used to parse and format metadata (0 to do it in the crawl threads).')
+    parser.add_argument('--layout', choices=['flat', 'hashed'], default='flat',
+                        help='Save files in data/ or spread them in hashed subfolders (data/ab/cd/).')
+    parser.add_argument('--metadata-format', choices=['json', 'jsonl', 'parquet'], default='json',
+                        help='Metadata output: one json file per package, or jsonl/parquet shards (requires pyarrow).')
+    parser.add_argument('--compression', choices=['gzip', 'zstd', 'none'], required=False,
+                        help='Compression of metadata shards (default gzip for jsonl, zstd for parquet).')
+    parser.add_argument('--fanout', required=False, action=argparse.BooleanOptionalAction,
+                        help='Spread json metadata files in hashed subfolders (metadata/ab/cd/).')
+    parser.add_argument('--headless', required=False, action=argparse.BooleanOptionalAction,
+                        help='Do not draw progress bars.')
+    parser.add_argument('--metrics-port', type=int, required=False,
+                        help='Expose metrics on http://127.0.0.1:PORT/metrics while crawling.')
+    parser.add_argument('--metrics-json', type=str, required=False,
+                        help='Write a json summary of the metrics to this file when the crawl ends.')
+    parser.add_argument('--cache', required=False, action=argparse.BooleanOptionalAction,
+                        help='Cache API responses on disk, so repeated and resumed runs do not fetch them again.')
+    parser.add_argument('--cache-ttl', type=int, default=86400,
+                        help='Seconds a cached response is used before revalidating it.')
+    parser.add_argument('--cache-size', type=int, default=512,
+                        help='Maximum size of the response cache in MB.')
+    parser.add_argument('--priority', nargs='+', choices=list(PRIORITY_KEYS), required=False,
+                        help='Crawl packages by priority: most recently modified, smallest estimated size '
+                             '(cheapest first), preferred formats or publishers. Needs package metadata, '
+                             'so it applies with --bulk or the async engine.')
+    parser.add_argument('--prefer', nargs='+', required=False,
+                        help='Preferred formats or publishers, in order, for the format and publisher '
+                             'priorities (default: the -f formats, or csv).')
+    parser.add_argument('--priority-window', type=int, default=1000,
+                        help='Packages of the listing reordered at a time with --priority and --bulk.')
+    parser.add_argument('--max-runtime', type=float, required=False,
+                        help='Minutes after which no new package is started. The next run continues the crawl.')
+    parser.add_argument('--detect-ttl', type=int, default=604800,
+                        help='Seconds the portal software detected for a domain is reused (0 to detect it every run).')
+    parser.add_argument('--queue', type=str, required=False,
+                        help='Shared work queue (SQLite file on a shared filesystem) of a distributed crawl.')
+    parser.add_argument('--role', choices=['coordinator', 'worker'], default='worker',
+                        help='With --queue, list the packages into the queue or crawl packages from it.')
+    parser.add_argument('--lease-batch', type=int, default=50,
+                        help='Packages leased at a time by a worker.')
+    parser.add_argument('--lease-time', type=int, default=300,
+                        help='Seconds before the packages of an unresponsive worker are given to others.')
+    parser.add_argument('--http2', required=False, action=argparse.BooleanOptionalAction,
+                        help='Use HTTP/2 connections (requires httpx[http2]).')
+
     args = vars(parser.parse_args())
+    if not args['domain'] and not args['domains']:
+        parser.error('a domain (-d) or a file of domains (--domains) is required')
+    if args['domains'] and args['queue']:
+        parser.error('--queue crawls a single domain')
+    if args['engine'] == 'async' and importlib.util.find_spec('httpx') is None:
+        parser.error('-e async requires httpx (pip install httpx)')
+    # Logs are written in ./logs, set up only when the crawler runs from the command line.
+    setup_logger.configure()
 
     # Save arguments to variables
     url = args['domain']
     path = args['path']
     only_metadata = args['metadata']
+    engine = args['engine']
+    concurrency = args['concurrency'] or (100 if engine == 'async' else 5)
+    if args['domains']:
+        # Threads shared by every portal of the batch.
+        concurrency = args['concurrency'] or args['per_portal'] * args['parallel_portals']
+    # The async engine runs metadata and download stages side by side. Its own requests
+    # don't use these connections, only the package list and portals without aget_package.
+    workers = concurrency * 2 if engine == 'async' else concurrency
+    compression = args['compression'] or {'jsonl': 'gzip', 'parquet': 'zstd'}.get(args['metadata_format'])
+    if compression == 'none':
+        compression = None
     formats = list(
         map(lambda x: x.lower(), args['formats'])) if args['formats'] else None
 
+    scheduler = None
+    if args['priority']:
+        scheduler = PriorityScheduler(args['priority'], prefer=args['prefer'] or formats,
+                                      window=args['priority_window'])
+        if engine == 'threads' and not args['bulk']:
+            print('Packages are listed without metadata: only resources are prioritized, '
+                  'use --bulk or -e async to prioritize packages.')
+    # Workers stop when the queue is finished, a time limit would leave leased packages undone.
+    max_runtime = args['max_runtime'] * 60 if args['max_runtime'] and not args['queue'] else None
+
+    if args['headless']:
+        progress.enabled = False
+    if args['metrics_port']:
+        metrics.registry.serve(args['metrics_port'])
+
+    # Distributed crawl: a queue and per-host rate limits shared by every worker.
+    work_queue = None
+    limiter = None
+    if args['queue']:
+        work_queue = WorkQueue(args['queue'], lease_time=args['lease_time'])
+        limiter = SharedRateLimiter(args['queue'], rate=args['rate'])
+
+    # Crawler options, the same for every domain of a batch.
+    options = dict(path=path, formats=formats, only_metadata=only_metadata,
+                   http2=args['http2'], incremental=args['incremental'],
+                   per_host=args['per_host'], max_sec=args['max_time'] or None,
+                   segments=args['segments'], rate=args['rate'], bulk=args['bulk'],
+                   dedup=args['dedup'], metadata_format=args['metadata_format'],
+                   compression=compression, fanout=args['fanout'],
+                   layout=args['layout'], normalize_workers=args['normalize_workers'],
+                   cache=args['cache'], cache_ttl=args['cache_ttl'], cache_size=args['cache_size'],
+                   max_size=int(args['max_size'] * 1024 * 1024) if args['max_size'] else None,
+                   scheduler=scheduler, detect_ttl=args['detect_ttl'])
+
+    if args['domains']:
+        crawl_batch(args, options, concurrency)
+        return
+
     # Main script
+    crawler = None
     try:
         if (utils.check_url(url)):
-            crawler = OpenDataCrawler(domain=url, path=path, formats=formats, only_metadata=only_metadata)
+            crawler = OpenDataCrawler(domain=url, workers=workers, download_workers=args['downloads'] or concurrency,
+                                      limiter=limiter, **options)
 
             if crawler.dms:
-                logger.info("Obtaining packages from %s", url)
-                print("Obtaining packages from " + url)
-                packages_ids = crawler.get_package_list()
-                logger.info("%i packages found", len(packages_ids))
-                print(str(len(packages_ids)) + " packages found!")
-
-                # Checks for previous downloaded packages.
-                if crawler.last_ids:
-                    package_difference = utils.get_difference(
-                        packages_ids, crawler.last_ids)
-                    packages_ids = package_difference
-                    print('Previous download detected! ({} packages left)'.format(
-                        len(package_difference)))
-                    print('Resuming...')
+                if work_queue and args['role'] == 'worker':
+                    print("Crawling packages from the work queue " + args['queue'])
                 else:
-                    print('Previous download not detected.')
-
-                # Saves resources and metadata for each package.
-                if packages_ids:
-                    pbar = tqdm(total = len(packages_ids))
-                    with ThreadPoolExecutor(max_workers=5) as executor:
-                        try:
-                            futures = [executor.submit(crawler.process_package, id) for id in packages_ids]
-                            for _ in as_completed(futures):
-                                pbar.update(1)
-                        except KeyboardInterrupt:
-                            print('\nWaiting for left tasks to complete!')
-                            logger.info("Keyboard interruption!")
-                            logger.info('Waiting for left tasks to complete!')
-                            executor.shutdown(wait=False, cancel_futures=True)
-                            exit()
-                    # Removes resume_data if all resources were succesfully saved.
-                    os.remove(crawler.resume_path)
+                    logger.info("Obtaining packages from %s", url)
+                    print("Obtaining packages from " + url)
+                    # Checks for previous downloaded packages.
+                    if crawler.resuming:
+                        print('Previous download detected!')
+                        print('Resuming...')
+                    else:
+                        print('Previous download not detected.')
+
+                # Saves resources and metadata for each package while ids are still being listed.
+                pbar = progress.bar()
+                if engine == 'async':
+                    crawl_engine = AsyncCrawlEngine(crawler, concurrency=concurrency,
+                                                    callback=lambda: pbar.update(1),
+                                                    scheduler=scheduler, max_runtime=max_runtime)
+                else:
+                    crawl_engine = ThreadCrawlEngine(crawler, concurrency=concurrency,
+                                                     callback=lambda: pbar.update(1), max_runtime=max_runtime)
+                try:
+                    if work_queue and args['role'] == 'coordinator':
+                        # Shows the packages done by the workers while waiting for them.
+                        coordinator = Coordinator(crawler, work_queue,
+                                                  callback=lambda counts: pbar.update(counts.get('done', 0) - pbar.n))
+                        counts = coordinator.run()
+                        total = counts.get('done', 0)
+                        print("{} packages listed, {} failed".format(coordinator.total, counts.get('failed', 0)))
+                    elif work_queue:
+                        total = Worker(crawler, work_queue, crawl_engine, batch_size=args['lease_batch']).run()
+                    else:
+                        ids = crawler.get_package_list()
+                        if scheduler:
+                            ids = scheduler.reorder(ids)
+                        crawl_engine.run(ids)
+                        total = crawl_engine.total
+                    # Packages are marked done once their metadata is durable.
+                    crawler.flush()
+                except KeyboardInterrupt:
+                    print('\nStopping crawl!')
+                    logger.info("Keyboard interruption!")
+                    crawler.flush()
+                    save_metrics(args['metrics_json'])
+                    exit()
+                pbar.close()
+                if crawl_engine.failed:
+                    print("{} packages failed, see the log".format(crawl_engine.failed))
+
+                if crawl_engine.expired():
+                    # The run stays open, so the next one resumes the packages not crawled yet.
+                    print("Maximum runtime reached, run again to continue the crawl.")
+                elif total:
+                    logger.info("%i packages crawled", total)
+                    print(str(total) + " packages crawled!")
+                    # Closes the run so the next one starts from scratch.
+                    crawler.state.finish_run()
+                elif args['incremental']:
+                    # Nothing changed, the next incremental run starts from this one.
+                    print("No packages modified since the previous run.")
+                    crawler.state.finish_run()
                 else:
-                    print("Error ocurred while obtaining packages!")
+                    print("No packages left to crawl or error ocurred while obtaining packages!")
+                save_metrics(args['metrics_json'])
         else:
             print("Incorrect domain form.\nMust have the form "
                   "https://domain.example or http://domain.example")
 
     except Exception:
         print(traceback.format_exc())
-        print('Keyboard interrumption!')
+        print('Crawl stopped by an error, run it again to resume it.')
+
+    finally:
+        # Saves the metadata and crawl state of the packages done so far.
+        if crawler:
+            crawler.close()
+        if work_queue:
+            work_queue.close()
+            limiter.close()
+
+
+def crawl_batch(args, options, concurrency):
+    """ Crawls the domains of a file in one process, fairly sharing one set of
+        pools between them (see BatchCrawler)"""
+    domains = []
+    for domain in read_domains(args['domains']):
+        if utils.check_url(domain):
+            domains.append(domain.rstrip('/'))
+        else:
+            print("Skipping " + domain + ": incorrect domain form")
+
+    # Connections are kept alive for every portal and a few file servers of each.
+    pools = CrawlPools(workers=concurrency, download_workers=args['downloads'] or concurrency,
+                       per_host=args['per_host'], http2=args['http2'], rate=args['rate'],
+                       normalize_workers=args['normalize_workers'], hosts=max(32, 4 * len(domains)))
+    if args['cache']:
+        pools.transport.cache = ResponseCache(os.path.join(args['path'] or os.getcwd(), 'cache.sqlite'),
+                                              ttl=args['cache_ttl'], max_bytes=args['cache_size'] * 1024 * 1024)
+
+    def create(domain):
+        return OpenDataCrawler(domain=domain, workers=concurrency, download_workers=args['downloads'] or concurrency,
+                               pools=pools, **options)
+
+    def finish(portal):
+        crawler = portal.crawler
+        if crawler is None:
+            return
+        # Closes the run so the next one starts from scratch, unless the listing failed
+        # and the next one has to resume it.
+        crawler.flush()
+        if crawler.dms and not portal.error and (portal.total or args['incremental']):
+            crawler.state.finish_run()
+        crawler.close()
+
+    print("Crawling {} portals".format(len(domains)))
+    pbar = progress.bar()
+    batch = BatchCrawler(domains, create, concurrency=concurrency, per_portal=args['per_portal'],
+                         parallel_portals=args['parallel_portals'], finish=finish,
+                         callback=lambda: pbar.update(1))
+    try:
+        totals = batch.run()
+    except KeyboardInterrupt:
+        print('\nStopping crawl!')
+        for portal in batch.active:
+            if portal.crawler:
+                portal.crawler.close()
+        pools.close()
+        save_metrics(args['metrics_json'])
+        exit()
+    pbar.close()
+
+    for domain in domains:
+        print("{}: {} packages crawled".format(domain, totals.get(domain, 0)))
+    pools.close()
+    save_metrics(args['metrics_json'])
+
+
+def save_metrics(path):
+    if path:
+        metrics.registry.save_summary(path)
+        print('Metrics summary saved in ' + path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from opendatacrawler.utils import setup_logger
+from opendatacrawler.utils import metrics
+
+logger = setup_logger.logger
+
+# End of the package list of a portal.
+DONE = object()
+
+
+def read_domains(path):
+    """ Domains of a batch file, one per line. Blank lines and # comments are skipped"""
+    domains = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.split('#')[0].strip()
+            if line and line not in domains:
+                domains.append(line)
+    return domains
+
+
+class Portal():
+    """ A domain of a batch crawl. Its crawler is created (detecting the dms)
+        and its packages listed in a background thread, into a bounded queue
+        the batch takes them from, so a slow portal never blocks the others."""
+
+    def __init__(self, domain, factory, prefetch):
+        self.domain = domain
+        self.factory = factory
+        self.crawler = None
+        self.items = queue.Queue(maxsize=prefetch)
+        self.listed = False
+        self.in_flight = 0
+        self.total = 0
+        # Packages whose crawl raised an error.
+        self.failed = 0
+        # Error that stopped the listing, the crawl of the portal is not complete.
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._list, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _list(self):
+        try:
+            self.crawler = self.factory(self.domain)
+            if self.crawler.dms:
+                for item in self.crawler.get_package_list():
+                    if not self._put(item):
+                        return
+        except Exception as e:
+            self.error = e
+            logger.error('Error listing packages of %s', self.domain)
+            logger.error(e)
+        finally:
+            self._put(DONE)
+
+    def _put(self, item):
+        # Waits for room in the queue unless the batch was stopped.
+        while not self.stop_event.is_set():
+            try:
+                self.items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def next(self):
+        """ Next package to crawl, None if there is none ready yet"""
+        try:
+            item = self.items.get_nowait()
+        except queue.Empty:
+            return None
+        if item is DONE:
+            self.listed = True
+            return None
+        return item
+
+    def is_finished(self):
+        return self.listed and self.in_flight == 0
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class BatchCrawler():
+    """ Crawls many portals in one process, on one pool of concurrency threads.
+        Up to parallel_portals portals are crawled at the same time, each with
+        at most per_portal packages in flight, and free threads are handed to
+        the portals in turn. A big portal gets its share without starving the
+        small ones, which finish and leave room for the next domains.
+
+        factory(domain) creates the crawler of a domain, usually sharing one
+        CrawlPools so every portal uses the same connection and download pools.
+        finish(portal) is called once a portal is done, with its crawler, the
+        number of packages crawled and the error of its listing if it failed."""
+
+    def __init__(self, domains, factory, concurrency=50, per_portal=5, parallel_portals=10,
+                 finish=None, callback=None):
+        self.domains = deque(domains)
+        self.factory = factory
+        self.concurrency = concurrency
+        self.per_portal = per_portal
+        self.parallel_portals = parallel_portals
+        self.finish = finish
+        # Called once per finished package (e.g. to update a progress bar).
+        self.callback = callback
+        self.active = []
+        self.pending = {}
+        self.totals = {}
+
+    def _start_portals(self):
+        while self.domains and len(self.active) < self.parallel_portals:
+            domain = self.domains.popleft()
+            self.active.append(Portal(domain, self.factory, prefetch=self.per_portal * 2).start())
+
+    def _schedule(self, executor):
+        # One package per portal and turn, until threads or ready packages run out.
+        submitted = True
+        while submitted and len(self.pending) < self.concurrency:
+            submitted = False
+            for portal in self.active:
+                if len(self.pending) >= self.concurrency:
+                    break
+                if portal.in_flight >= self.per_portal:
+                    continue
+                item = portal.next()
+                if item is None:
+                    continue
+                future = executor.submit(portal.crawler.process_package, item)
+                self.pending[future] = portal
+                portal.in_flight += 1
+                portal.total += 1
+                submitted = True
+            # The next round starts with the portal after the first one served.
+            if self.active:
+                self.active.append(self.active.pop(0))
+        metrics.queue_depth.set('packages', value=len(self.pending))
+
+    def _collect(self):
+        if not self.pending:
+            # Nothing in flight, the portals are being detected or listed.
+            time.sleep(0.05)
+            return
+        done, _ = wait(list(self.pending), timeout=0.1, return_when=FIRST_COMPLETED)
+        for future in done:
+            portal = self.pending.pop(future)
+            portal.in_flight -= 1
+            if future.exception():
+                portal.failed += 1
+                metrics.packages.inc('error')
+                logger.error('Error crawling a package of %s', portal.domain)
+                logger.error(future.exception())
+            if self.callback:
+                self.callback()
+
+    def _finish_portals(self):
+        for portal in [portal for portal in self.active if portal.is_finished()]:
+            self.active.remove(portal)
+            self.totals[portal.domain] = portal.total
+            logger.info('%i packages crawled from %s, %i failed', portal.total, portal.domain, portal.failed)
+            if self.finish:
+                try:
+                    self.finish(portal)
+                except Exception as e:
+                    logger.error('Error closing the crawl of %s', portal.domain)
+                    logger.error(e)
+
+    def run(self):
+        """ Crawls every domain. Returns the packages crawled by domain"""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                while self.domains or self.active:
+                    self._start_portals()
+                    self._schedule(executor)
+                    self._collect()
+                    self._finish_portals()
+            except KeyboardInterrupt:
+                for portal in self.active:
+                    portal.stop()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+        return self.totals
@@ -0,0 +1,120 @@
+import os
+import socket
+import threading
+import time
+from opendatacrawler.utils import setup_logger
+
+logger = setup_logger.logger
+
+
+class Coordinator():
+    """ Lists the packages of a portal into the shared work queue, then waits
+        until the workers crawled all of them. Listing resumes from the
+        crawl state of the coordinator if it is restarted."""
+
+    def __init__(self, crawler, queue, batch_size=500, poll_interval=5, callback=None):
+        self.crawler = crawler
+        self.queue = queue
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        # Called with the package counts by status while waiting for the workers.
+        self.callback = callback
+        self.total = 0
+
+    def _put(self, batch):
+        self.queue.put(batch)
+        self.total += len(batch)
+
+    def run(self):
+        # A finished queue belongs to a previous crawl.
+        if self.queue.is_finished():
+            self.queue.reset()
+        self.queue.set_listed(False)
+
+        batch = []
+        for item in self.crawler.get_package_list():
+            batch.append((self.crawler.get_item_id(item), item))
+            if len(batch) >= self.batch_size:
+                self._put(batch)
+                batch = []
+        self._put(batch)
+        self.queue.set_listed()
+        logger.info("%i packages listed in the work queue", self.total)
+
+        while not self.queue.is_finished():
+            if self.callback:
+                self.callback(self.queue.counts())
+            time.sleep(self.poll_interval)
+        return self.queue.counts()
+
+
+class Worker():
+    """ Leases batches of packages from the shared work queue and crawls them
+        with a crawl engine. Once the metadata of the batch is flushed, the
+        packages saved are acked and the others failed, so they are tried
+        again up to the attempts of the queue. Leases are renewed while the
+        batch is crawled; if the worker dies they expire and the packages go
+        to other workers. Stops when the queue is finished or the engine
+        reached its maximum runtime."""
+
+    def __init__(self, crawler, queue, engine, batch_size=50, poll_interval=5, owner=None):
+        self.crawler = crawler
+        self.queue = queue
+        self.engine = engine
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.owner = owner if owner else '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.leased = []
+        self.total = 0
+        self.stop_event = threading.Event()
+
+    def _heartbeat(self):
+        while not self.stop_event.wait(self.queue.lease_time / 3):
+            leased = self.leased
+            if leased:
+                try:
+                    self.queue.extend(self.owner, leased)
+                except Exception as e:
+                    logger.error('Error renewing leases of %s', self.owner)
+                    logger.error(e)
+
+    # Saved in this run, partial packages included: their files are resumed by the next run.
+    def is_saved(self, id):
+        package = self.crawler.state.get_package(id)
+        return package is not None and package['run'] == self.crawler.state.run \
+            and package['status'] in ('done', 'partial')
+
+    def run(self):
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        try:
+            while True:
+                batch = self.queue.lease(self.owner, self.batch_size)
+                if not batch:
+                    if self.queue.is_finished():
+                        break
+                    # The coordinator is still listing, or other workers hold the rest.
+                    time.sleep(self.poll_interval)
+                    continue
+                self.leased = [id for id, _ in batch]
+                self.engine.run(item for _, item in batch)
+                # Packages are only marked in the crawl state once their metadata is durable.
+                self.crawler.flush()
+                saved = [id for id in self.leased if self.is_saved(id)]
+                others = [id for id in self.leased if id not in saved]
+                self.queue.ack(self.owner, saved)
+                self.total += len(saved)
+                if self.engine.expired():
+                    # Packages not started are not an attempt, other workers take them.
+                    self.queue.release(self.owner, others)
+                    self.leased = []
+                    break
+                self.queue.fail(self.owner, others)
+                self.leased = []
+        except KeyboardInterrupt:
+            if self.leased:
+                self.queue.release(self.owner, self.leased)
+            raise
+        finally:
+            self.stop_event.set()
+        return self.total
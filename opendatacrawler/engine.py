@@ -0,0 +1,212 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from opendatacrawler.utils import setup_logger
+from opendatacrawler.utils import metrics
+
+logger = setup_logger.logger
+
+
+class ThreadCrawlEngine():
+    """ Crawls packages on a fixed thread pool. Ids are pulled lazily from
+        the package list, keeping at most queue_size packages in flight.
+        No new package is started after max_runtime seconds. Packages that
+        raise are logged and counted in failed."""
+
+    def __init__(self, crawler, concurrency=5, queue_size=None, callback=None, max_runtime=None):
+        self.crawler = crawler
+        self.concurrency = concurrency
+        self.queue_size = queue_size or concurrency * 2
+        self.callback = callback
+        self.deadline = time.monotonic() + max_runtime if max_runtime else None
+        self.total = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    # Runs in the thread that finished the package, as soon as it is done.
+    def _check(self, id, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        with self.lock:
+            self.failed += 1
+        metrics.packages.inc('error')
+        logger.error('Error crawling package %s', self.crawler.get_item_id(id))
+        logger.error(future.exception())
+
+    def _done(self, futures):
+        for _ in futures:
+            if self.callback:
+                self.callback()
+
+    def run(self, ids):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = set()
+            try:
+                for id in ids:
+                    if self.expired():
+                        logger.info('Maximum runtime reached, %i packages started', self.total)
+                        break
+                    if len(pending) >= self.queue_size:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        self._done(done)
+                    future = executor.submit(self.crawler.process_package, id)
+                    future.add_done_callback(lambda future, id=id: self._check(id, future))
+                    pending.add(future)
+                    self.total += 1
+                    metrics.queue_depth.set('packages', value=len(pending))
+                done, _ = wait(pending)
+                self._done(done)
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            except Exception:
+                # The listing failed: packages already started are finished before raising.
+                done, _ = wait(pending)
+                self._done(done)
+                raise
+
+
+class AsyncCrawlEngine():
+    """ Crawls packages with asyncio in two bounded stages: metadata fetching
+        and resource downloading. Requests are made with httpx.AsyncClient
+        through an AsyncTransport sharing the rate limiter and cache of the
+        crawler's transport, and files are streamed to disk on the loop, so a
+        request in flight costs a coroutine instead of a thread. Portals that
+        only implement the blocking get_package run it in a thread, and the
+        package list, which may block on the network, is pulled in batches in
+        a thread too.
+
+        With a scheduler, packages waiting between the stages are downloaded
+        in priority order instead of arrival order. No new package is started
+        after max_runtime seconds."""
+
+    def __init__(self, crawler, concurrency=100, download_concurrency=None,
+                 queue_size=None, callback=None, scheduler=None, max_runtime=None, connections=None):
+        self.crawler = crawler
+        self.concurrency = concurrency
+        self.download_concurrency = download_concurrency or concurrency
+        self.queue_size = queue_size or concurrency * 2
+        # Requests in flight on the async client, by default one per metadata and download task.
+        self.connections = connections or self.concurrency + self.download_concurrency
+        # Called once per finished package (e.g. to update a progress bar).
+        self.callback = callback
+        self.scheduler = scheduler
+        self.deadline = time.monotonic() + max_runtime if max_runtime else None
+        self.counter = itertools.count()
+        self.total = 0
+        self.failed = 0
+        # Error of the package list, raised once the packages already listed are crawled.
+        self.error = None
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    async def _put_package(self, package_queue, package):
+        if self.scheduler:
+            # Packages sort before the stop sentinels, then by priority and arrival.
+            package = (0, self.scheduler.key(package), next(self.counter), package)
+        await package_queue.put(package)
+
+    async def _get_package(self, package_queue):
+        package = await package_queue.get()
+        return package[-1] if self.scheduler else package
+
+    def _done(self):
+        if self.callback:
+            self.callback()
+
+    async def _produce(self, loop, executor, ids, id_queue):
+        # The package list may block on the network, pull it in small batches off the loop.
+        ids = iter(ids)
+        while True:
+            try:
+                batch = await loop.run_in_executor(executor, lambda: list(itertools.islice(ids, 100)))
+            except Exception as e:
+                self.error = e
+                break
+            if not batch:
+                break
+            if self.expired():
+                logger.info('Maximum runtime reached, %i packages started', self.total)
+                break
+            for id in batch:
+                await id_queue.put(id)
+                self.total += 1
+                metrics.queue_depth.set('metadata', value=id_queue.qsize())
+        for _ in range(self.concurrency):
+            await id_queue.put(None)
+
+    async def _fetch_metadata(self, transport, id_queue, package_queue):
+        while True:
+            id = await id_queue.get()
+            if id is None:
+                break
+            package = None
+            try:
+                package = await self.crawler.aget_package(id, transport)
+            except Exception as e:
+                self.failed += 1
+                metrics.packages.inc('error')
+                logger.error('Error obtaining package %s', id)
+                logger.error(e)
+
+            if package and self.expired():
+                self._done()
+            elif package:
+                await self._put_package(package_queue, package)
+                metrics.queue_depth.set('downloads', value=package_queue.qsize())
+            else:
+                self._done()
+
+    async def _download(self, transport, package_queue):
+        while True:
+            package = await self._get_package(package_queue)
+            if package is None:
+                break
+            if self.expired():
+                self._done()
+                continue
+            try:
+                await self.crawler.astore_package(package, transport)
+            except Exception as e:
+                self.failed += 1
+                metrics.packages.inc('error')
+                logger.error('Error saving package %s', package.get('dct:identifier'))
+                logger.error(e)
+            self._done()
+
+    async def crawl(self, ids):
+        import asyncio
+        from opendatacrawler.utils.transport import AsyncTransport
+        loop = asyncio.get_running_loop()
+        id_queue = asyncio.Queue(maxsize=self.queue_size)
+        # A priority queue needs more waiting packages to choose the next download from.
+        package_queue = (asyncio.PriorityQueue(maxsize=self.queue_size * 4) if self.scheduler
+                         else asyncio.Queue(maxsize=self.queue_size))
+
+        # The package list is an iterator, pulled by one thread at a time.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            async with AsyncTransport(self.crawler.transport, connections=self.connections) as transport:
+                fetchers = [asyncio.create_task(self._fetch_metadata(transport, id_queue, package_queue))
+                            for _ in range(self.concurrency)]
+                downloaders = [asyncio.create_task(self._download(transport, package_queue))
+                               for _ in range(self.download_concurrency)]
+
+                await self._produce(loop, executor, ids, id_queue)
+                await asyncio.gather(*fetchers)
+
+                # Every metadata fetch finished, so downloaders can stop once drained.
+                for _ in range(self.download_concurrency):
+                    await package_queue.put((1, (), next(self.counter), None) if self.scheduler else None)
+                await asyncio.gather(*downloaders)
+        if self.error:
+            raise self.error
+
+    def run(self, ids):
+        # asyncio is imported here, the thread engine does not need it at startup.
+        import asyncio
+        asyncio.run(self.crawl(ids))
@@ -1,15 +1,255 @@
-import requests
+import asyncio
 import urllib.parse
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from opendatacrawler.utils import utils
+from opendatacrawler.utils import setup_logger
+from opendatacrawler.utils.transport import Transport, backoff
 from opendatacrawler.portals.crawler_interface_abc import OpenDataCrawlerInterface
-from tqdm import tqdm
+from opendatacrawler.utils import progress
+
+logger = setup_logger.logger
+
+
+# Formats the metadata of a dataset as returned by the hub search API. A pure
+# function of its arguments so it can run in a process pool.
+def normalize_package(domain, id, response_json):
+    hash_id = utils.generate_hash(domain, id)
+    resources = []
+
+    # Initialize metadata dict.
+    package_data = {
+         'dct:identifier': id,
+         'custom:id': hash_id,
+         'custom:url': None,
+         'dct:title': None,
+         'dct:description': None,
+         'dcat:theme': None,
+         'dcat:keyword': None,
+         'dct:publisher': None,
+         'dct:language': None,
+         'dct:issued': None,
+         'dct:modified': None,
+         'custom:country': None,
+         'dcat:distribution': None
+    }
+
+    # Check metadata existence and update dict.
+    if response_json.get('title'):
+        if response_json.get('title').get('es'):
+              package_data['dct:title'] = {
+                   'language':'es',
+                   'label':response_json.get('title').get('es')
+              }
+        elif response_json.get('title').get('en'):
+             package_data['dct:title'] = {
+                   'language':'en',
+                   'label':response_json.get('title').get('en')
+              }
+        else:
+            titles = response_json.get('title')
+            t_keys = list(titles.keys())
+            if len(t_keys)>0:
+                package_data['dct:title'] = {
+                     'language':t_keys[0],
+                     'label':titles.get(t_keys[0])
+                }
+    
+    if response_json.get('description'):
+        if response_json.get('description').get('es'):
+              package_data['dct:description'] = {
+                   'language':'es',
+                   'label':response_json.get('description').get('es')
+              }
+        elif response_json.get('description').get('en'):
+             package_data['dct:description'] = {
+                  'language':'en',
+                  'label':response_json.get('description').get('en')
+             }
+        else:
+             descriptions = response_json.get('description')
+             d_keys = list(descriptions.keys())
+             if len(d_keys)>0:
+                  package_data['dct:description'] = {
+                       'language':d_keys[0],
+                       'label':descriptions.get(d_keys[0])
+                  }
+             
+
+    if response_json.get('country'):
+              package_data['custom:country'] = response_json['country'].get('label', None)
+              
+    if response_json.get('language'):
+              package_data['dct:language'] = response_json['language'][0].get('label', None)
+              
+    if response_json.get('publisher', None):
+        package_data['dct:publisher'] = {}
+        package_data['dct:publisher']['name'] = response_json.get('publisher',{}).get('name', None)
+        package_data['dct:publisher']['homepage'] = response_json.get('publisher',{}).get('resource', None)
+    
+    if response_json.get('categories'):
+        categories = []
+        for category in response_json.get('categories'):
+            if category.get('label'):
+                label = category.get('label')
+                if label.get('es'):
+                     categories.append({
+                          'language': 'es',
+                          'label': label.get('es')
+                     })
+                elif label.get('en'):
+                     categories.append({
+                          'language': 'en',
+                          'label': label.get('en')
+                     })
+                elif len(list(label.keys()))>0:
+                     categories.append({
+                          'language': list(label.keys())[0],
+                          'label': label.get(list(label.keys())[0])
+                     })
+                    
+        package_data['dcat:theme'] = categories 
+    
+    if response_json.get('keywords'):
+        keywords = []
+        for keyword in response_json.get('keywords'):
+            if keyword.get('language'):
+                language = keyword.get('language')
+                if language in ['es','en']:
+                        keywords.append({
+                            'language': language,
+                            'label': keyword.get('label')
+                        })
+        if len(keywords) == 0:
+             keywords = [{
+                  'language': keyword.get('language'),
+                  'label': keyword.get('label')
+             } for keyword in response_json.get('keywords') ]
+        package_data['dcat:keyword'] = keywords
+              
+                
+    package_data['dct:issued'] = response_json.get('issued', None)
+    package_data['dct:modified'] = response_json.get('modified', None)
+    package_data['custom:url'] = response_json.get('resource', None).replace("88u/dataset","data/datasets")
+
+    # Save resources metadata.
+    if response_json.get('distributions'):
+        if len(response_json['distributions']) > 0:
+            for resource in response_json.get('distributions'):
+                format = None if resource.get('format') is None else resource.get('format').get('id', None)
+                if resource.get('download_url'):
+                    download_url = resource.get('download_url')[0]
+                elif resource.get('access_url'):
+                    access_url =  resource.get('access_url')[0]
+                    if '&compressed=true' in access_url:
+                        download_url = access_url.replace('&compressed=true', '')
+                    else: 
+                        download_url = access_url
+                else:
+                    download_url = None
+                
+                license = None 
+                
+                if resource.get('rights'):
+                    license = resource.get('rights').get('resource', None)
+                
+                if resource.get('license'):
+                    license = resource.get('license').get('label', None)
+                
+                resource_size = resource.get('byte_size', None)
+                
+                resource_title = None
+
+                if resource.get('title'):
+                    resource_titles = resource.get('title')
+                    if resource_titles.get('es'):
+                        resource_title = {
+                            'language':'es',
+                            'label':resource_titles.get('es') 
+                        }
+                    elif resource_titles.get('en'):
+                        resource_title = {
+                             'language':'en',
+                             'label':resource_titles.get('en')
+                        }
+                    else:
+                        t_r_keys = list(resource_titles.keys())
+                        if len(t_r_keys)>0:
+                             resource_title = {
+                                  'language':t_r_keys[0],
+                                  'label':resource_titles.get(t_r_keys[0])
+                             }
+                                                         
+                
+                resources.append({
+                    'dct:title': resource_title,
+                    'dcat:downloadURL': urllib.parse.unquote(download_url),
+                    'custom:resource_id': utils.generate_hash(domain, resource.get('id', None)),
+                    'dcat:mediaType': format.lower() if format else None,
+                    'dcat:byteSize': resource_size,
+                    'dct:rights': license,
+                    'custom:path': None                            
+                })
+        else:
+        # No resources, maybe link to web with the info
+            if package_data.get('landing_page'):
+                for landing in package_data.get('landing_page'):
+                    resources.append({
+                        'dcat:downloadURL':  landing['resource'],
+                        'custom:resource_id': None,
+                        'dcat:mediaType': 'Web',
+                        'dct:rights': None,
+                        'dct:title': list(landing['title'].keys())[0]
+                        
+                    })
+    
+    package_data['dcat:distribution'] = resources
+
+    return package_data
+
+
+def normalize_raw(domain, id, content):
+    """ Parses the raw body of a dataset response and formats its metadata"""
+    return normalize_package(domain, id, utils.loads(content)['result'])
+
+
+def normalize_batch(domain, datasets):
+    """ Formats a list of datasets from a search page. The bare id is returned
+        for the datasets that can not be formatted, to request them on their own."""
+    packages = []
+    for dataset in datasets:
+        try:
+            packages.append(normalize_package(domain, dataset['id'], dataset))
+        except Exception as e:
+            logger.error('Error formatting dataset %s', dataset.get('id'))
+            logger.error(e)
+            packages.append(dataset.get('id'))
+    return packages
+
 
 class DataEuropaCrawler(OpenDataCrawlerInterface):
+    probes = ['/api/hub/search/']
     base_url = 'https://data.europa.eu/api/hub/search/'
+    sparql_url = 'https://data.europa.eu/sparql'
+    page_size = 50000
+    # Attempts of a SPARQL page before its shard is left unfinished.
+    page_attempts = 5
     
-    def __init__(self, domain, formats):
+    def __init__(self, domain, formats, transport=None, checkpoints=None, shard_workers=4,
+                 normalize_pool=None, base_url=None, sparql_url=None):
         self.domain = domain
+        # Endpoints of the portal, data.europa.eu unless other ones are given.
+        self.base_url = base_url if base_url else DataEuropaCrawler.base_url
+        self.sparql_url = sparql_url if sparql_url else DataEuropaCrawler.sparql_url
         self.formats = formats
+        self.transport = transport if transport else Transport()
+        # Store with get_checkpoint/set_checkpoint (e.g. CrawlState) to resume the listing.
+        self.checkpoints = checkpoints
+        self.shard_workers = shard_workers
+        # Process pool where responses are parsed and formatted, off the I/O threads.
+        self.normalize_pool = normalize_pool
 
     # Retrieves and processes package/dataset metadata.
     def get_formats_dict():
@@ -20,252 +260,207 @@ class DataEuropaCrawler(OpenDataCrawlerInterface):
         }  
         
     def get_package(self, id):
-            url = DataEuropaCrawler.base_url + 'datasets/{}'.format(id)
+            url = self.base_url + 'datasets/{}'.format(id)
             try:
-                response = requests.get(url)
+                response = self.transport.get(url)
                 response.raise_for_status()
-                response_json = response.json()['result']
-                hash_id = utils.generate_hash(self.domain, id)
-                resources = []
-
-                # Initialize metadata dict.
-                package_data = {
-                     'dct:identifier': id,
-                     'custom:id': hash_id,
-                     'custom:url': None,
-                     'dct:title': None,
-                     'dct:description': None,
-                     'dcat:theme': None,
-                     'dcat:keyword': None,
-                     'dct:publisher': None,
-                     'dct:language': None,
-                     'dct:issued': None,
-                     'dct:modified': None,
-                     'custom:country': None,
-                     'dcat:distribution': None
-                }
-
-                # Check metadata existence and update dict.
-                if response_json.get('title'):
-                    if response_json.get('title').get('es'):
-                          package_data['dct:title'] = {
-                               'language':'es',
-                               'label':response_json.get('title').get('es')
-                          }
-                    elif response_json.get('title').get('en'):
-                         package_data['dct:title'] = {
-                               'language':'en',
-                               'label':response_json.get('title').get('en')
-                          }
-                    else:
-                        titles = response_json.get('title')
-                        t_keys = list(titles.keys())
-                        if len(t_keys)>0:
-                            package_data['dct:title'] = {
-                                 'language':t_keys[0],
-                                 'label':titles.get(t_keys[0])
-                            }
-                
-                if response_json.get('description'):
-                    if response_json.get('description').get('es'):
-                          package_data['dct:description'] = {
-                               'language':'es',
-                               'label':response_json.get('description').get('es')
-                          }
-                    elif response_json.get('description').get('en'):
-                         package_data['dct:description'] = {
-                              'language':'en',
-                              'label':response_json.get('description').get('en')
-                         }
-                    else:
-                         descriptions = response_json.get('description')
-                         d_keys = list(descriptions.keys())
-                         if len(d_keys)>0:
-                              package_data['dct:description'] = {
-                                   'language':d_keys[0],
-                                   'label':descriptions.get(d_keys[0])
-                              }
-                         
-
-                if response_json.get('country'):
-                          package_data['custom:country'] = response_json['country'].get('label', None)
-                          
-                if response_json.get('language'):
-                          package_data['dct:language'] = response_json['language'][0].get('label', None)
-                          
-                if response_json.get('publisher', None):
-                    package_data['dct:publisher'] = {}
-                    package_data['dct:publisher']['name'] = response_json.get('publisher',{}).get('name', None)
-                    package_data['dct:publisher']['homepage'] = response_json.get('publisher',{}).get('resource', None)
-        
-                if response_json.get('categories'):
-                    categories = []
-                    for category in response_json.get('categories'):
-                        if category.get('label'):
-                            label = category.get('label')
-                            if label.get('es'):
-                                 categories.append({
-                                      'language': 'es',
-                                      'label': label.get('es')
-                                 })
-                            elif label.get('en'):
-                                 categories.append({
-                                      'language': 'en',
-                                      'label': label.get('en')
-                                 })
-                            elif len(list(label.keys()))>0:
-                                 categories.append({
-                                      'language': list(label.keys())[0],
-                                      'label': label.get(list(label.keys())[0])
-                                 })
-                                
-                    package_data['dcat:theme'] = categories 
-                
-                if response_json.get('keywords'):
-                    keywords = []
-                    for keyword in response_json.get('keywords'):
-                        if keyword.get('language'):
-                            language = keyword.get('language')
-                            if language in ['es','en']:
-                                    keywords.append({
-                                        'language': language,
-                                        'label': keyword.get('label')
-                                    })
-                    if len(keywords) == 0:
-                         keywords = [{
-                              'language': keyword.get('language'),
-                              'label': keyword.get('label')
-                         } for keyword in response_json.get('keywords') ]
-                    package_data['dcat:keyword'] = keywords
-                          
-                            
-                package_data['dct:issued'] = response_json.get('issued', None)
-                package_data['dct:modified'] = response_json.get('modified', None)
-                package_data['custom:url'] = response_json.get('resource', None).replace("88u/dataset","data/datasets")
-
-                # Save resources metadata.
-                if response_json.get('distributions'):
-                    if len(response_json['distributions']) > 0:
-                        for resource in response_json.get('distributions'):
-                            format = None if resource.get('format') is None else resource.get('format').get('id', None)
-                            if resource.get('download_url'):
-                                download_url = resource.get('download_url')[0]
-                            elif resource.get('access_url'):
-                                access_url =  resource.get('access_url')[0]
-                                if '&compressed=true' in access_url:
-                                    download_url = access_url.replace('&compressed=true', '')
-                                else: 
-                                    download_url = access_url
-                            else:
-                                download_url = None
-                            
-                            license = None 
-                            
-                            if resource.get('rights'):
-                                license = resource.get('rights').get('resource', None)
-                            
-                            if resource.get('license'):
-                                license = resource.get('license').get('label', None)
-                            
-                            resource_size = resource.get('byte_size', None)
-                            
-                            resource_title = None
-
-                            if resource.get('title'):
-                                resource_titles = resource.get('title')
-                                if resource_titles.get('es'):
-                                    resource_title = {
-                                        'language':'es',
-                                        'label':resource_titles.get('es') 
-                                    }
-                                elif resource_titles.get('en'):
-                                    resource_title = {
-                                         'language':'en',
-                                         'label':resource_titles.get('en')
-                                    }
-                                else:
-                                    t_r_keys = list(resource_titles.keys())
-                                    if len(t_r_keys)>0:
-                                         resource_title = {
-                                              'language':t_r_keys[0],
-                                              'label':resource_titles.get(t_r_keys[0])
-                                         }
-                                                                     
-                            
-                            resources.append({
-                                'dct:title': resource_title,
-                                'dcat:downloadURL': urllib.parse.unquote(download_url),
-                                'custom:resource_id': utils.generate_hash(self.domain, resource.get('id', None)),
-                                'dcat:mediaType': format.lower() if format else None,
-                                'dcat:byteSize': resource_size,
-                                'dct:rights': license,
-                                'custom:path': None                            
-                            })
-                    else:
-                    # No resources, maybe link to web with the info
-                        if package_data.get('landing_page'):
-                            for landing in package_data.get('landing_page'):
-                                resources.append({
-                                    'dcat:downloadURL':  landing['resource'],
-                                    'custom:resource_id': None,
-                                    'dcat:mediaType': 'Web',
-                                    'dct:rights': None,
-                                    'dct:title': list(landing['title'].keys())[0]
-                                    
-                                })
-                
-                package_data['dcat:distribution'] = resources
-
-                return package_data
+                if self.normalize_pool:
+                    return self.normalize_pool.submit(normalize_raw, self.domain, id, response.content).result()
+                return normalize_raw(self.domain, id, response.content)
             except Exception as e:
                 print(e)
             #except requests.exceptions.HTTPError as errh:
             #        print(f"HTTP Error: {errh}")
                 return None
 
+    # get_package for the async engine. With a normalize pool the dataset is
+    # formatted in a worker process while the loop goes on with other requests.
+    async def aget_package(self, id, transport):
+        url = self.base_url + 'datasets/{}'.format(id)
+        try:
+            response = await transport.get(url)
+            response.raise_for_status()
+            if self.normalize_pool:
+                return await asyncio.wrap_future(
+                    self.normalize_pool.submit(normalize_raw, self.domain, id, response.content))
+            return normalize_raw(self.domain, id, response.content)
+        except Exception as e:
+            logger.error('Error obtaining dataset %s', id)
+            logger.error(e)
+            return None
+
+    # Formats the metadata of a dataset as returned by the hub search API.
+    def normalize_package(self, id, response_json):
+        return normalize_package(self.domain, id, response_json)
+
+    # Harvests formatted datasets in pages of page_size from the hub search API,
+    # instead of one request per dataset.
+    def get_packages(self, page_size=1000):
+        params = {
+            'filter': 'dataset',
+            'limit': page_size,
+            'scroll': 'true'
+        }
+        # Scroll pages are never cached: a scroll id is only valid for a while on the
+        # server, and the search opening the scroll must return a fresh one.
+        res = self.transport.get(self.base_url + 'search', params=params, cache=False)
+        res.raise_for_status()
+        result = utils.loads(res.content)['result']
+        pbar = progress.bar(total=int(result.get('count', 0)/page_size)+1, bar_format='{desc}: {percentage:3.0f}%|{bar}')
+
+        while result.get('results'):
+            for package in self.normalize_page(result['results']):
+                if package is None:
+                    continue
+                if not isinstance(package, dict):
+                    # Its hit could not be formatted: the crawler requests it by id,
+                    # and marks it as an error if that fails too.
+                    yield package
+                    continue
+                # Same format filter as the SPARQL query of get_package_list.
+                if self.formats and not any(resource['dcat:mediaType'] and
+                                            any(f in resource['dcat:mediaType'] for f in self.formats)
+                                            for resource in package['dcat:distribution']):
+                    continue
+                yield package
+            pbar.update(1)
+
+            if not result.get('scrollId'):
+                break
+            res = self.transport.get(self.base_url + 'scroll',
+                                     params={'scrollId': result['scrollId']}, cache=False)
+            res.raise_for_status()
+            result = utils.loads(res.content)['result']
+        pbar.close()
 
-    # Retrieves ids from all datasets.
+    # Formats a page of datasets, split in batches across the process pool if any.
+    def normalize_page(self, datasets, batch_size=50):
+        if not self.normalize_pool:
+            return normalize_batch(self.domain, datasets)
+        batches = [datasets[i:i + batch_size] for i in range(0, len(datasets), batch_size)]
+        futures = [self.normalize_pool.submit(normalize_batch, self.domain, batch) for batch in batches]
+        return [package for future in futures for package in future.result()]
+
+    # Retrieves ids from all datasets. Dataset URIs are split in shards by the
+    # first hex digit of their MD5, listed at the same time with keyset
+    # pagination, and each shard saves a checkpoint after every page.
     def get_package_list(self):
-        ids = []
         params = {}
-        q_w = ""        
-        url = 'https://data.europa.eu/sparql'
+        pattern = ""        
+        url = self.sparql_url
         
         # Total datasets
         if self.formats:
             format_text = " || ".join([f"CONTAINS(LCASE(STR(?format)),'{f}')" for f in self.formats])
-            q_w = """
-             where{
+            pattern = """
                 ?dataset a <http://www.w3.org/ns/dcat#Dataset> .
                 ?dataset <http://www.w3.org/ns/dcat#distribution> ?distribution .
                 ?distribution <http://purl.org/dc/terms/format> ?format .
-                FILTER ("""+format_text+")}"
+                FILTER ("""+format_text+")"
         else:
-            q_w = 'where{?dataset a <http://www.w3.org/ns/dcat#Dataset>}'
+            pattern = '?dataset a <http://www.w3.org/ns/dcat#Dataset>'
         
         params = {
-                'query': 'select (count( distinct ?dataset) as ?total)' + q_w
+                'query': 'select (count( distinct ?dataset) as ?total) where{' + pattern + '}'
         }
         
         header = {
             'Accept': 'application/sparql-results+json'
         }
 
-        res = requests.get(url, params=params, headers=header)
-        
-        total = int(res.json()['results']['bindings'][0]['total']['value'])
+        res = self.transport.get(url, params=params, headers=header)
         
+        total = int(utils.loads(res.content)['results']['bindings'][0]['total']['value'])
+        pbar = progress.bar(total=total, bar_format='{desc}: {percentage:3.0f}%|{bar}')
         
         # Retrieve ids
-        for offset in tqdm(range(0,total,50000), bar_format='{desc}: {percentage:3.0f}%|{bar}'):
-            params = {
-                'query': 'select distinct ?dataset '+q_w+' LIMIT 50000 OFFSET '+ str(offset)
-            }
-            header = {
-                'Accept': 'application/sparql-results+json'
-            }
-            res = requests.get(url, params=params, headers=header)
-            
-            ids.extend(list(map(lambda dataset: dataset['dataset']['value'].split("/")[-1], res.json()['results']['bindings'])))
-        return ids
-    
\ No newline at end of file
+        shards = [format(i, 'x') for i in range(16)]
+        ids = queue.Queue(maxsize=DataEuropaCrawler.page_size)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.shard_workers)
+        try:
+            for shard in shards:
+                executor.submit(self.enumerate_shard, url, pattern, shard, ids, stop)
+            finished = 0
+            failed = 0
+            while finished < len(shards):
+                item = ids.get()
+                if item is None:
+                    finished += 1
+                elif isinstance(item, Exception):
+                    failed += 1
+                elif isinstance(item, tuple):
+                    # Every id of the page was handed out, the shard can resume after it.
+                    self.set_checkpoint(*item)
+                else:
+                    pbar.update(1)
+                    yield item
+            if failed:
+                # The listing is incomplete: the run must not be finished, the next one
+                # resumes the failed shards from their checkpoints.
+                raise ConnectionError('{} of {} shards of datasets could not be listed'.format(failed, len(shards)))
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            pbar.close()
+
+    # Lists the ids of a shard page by page, from its checkpoint if there is one.
+    # If a page keeps failing the error is handed to get_package_list and the
+    # shard stays at its last checkpoint.
+    def enumerate_shard(self, url, pattern, shard, ids, stop):
+        header = {
+            'Accept': 'application/sparql-results+json'
+        }
+        page_size = DataEuropaCrawler.page_size
+        try:
+            last = self.get_checkpoint(shard)
+            while last != 'done' and not stop.is_set():
+                keyset = ' FILTER(STR(?dataset) > "{}")'.format(last.replace('"', '\\"')) if last else ''
+                params = {
+                    'query': 'select distinct ?dataset where{' + pattern +
+                             ' FILTER(STRSTARTS(MD5(STR(?dataset)), "' + shard + '"))' + keyset +
+                             '} ORDER BY STR(?dataset) LIMIT ' + str(page_size)
+                }
+                bindings = self.query_page(url, params, header)
+
+                for dataset in bindings:
+                    self._put(ids, dataset['dataset']['value'].split("/")[-1], stop)
+                last = bindings[-1]['dataset']['value'] if len(bindings) == page_size else 'done'
+                self._put(ids, (shard, last), stop)
+        except Exception as e:
+            logger.error('Error listing datasets of shard %s', shard)
+            logger.error(e)
+            self._put(ids, e, stop)
+        finally:
+            self._put(ids, None, stop)
+
+    # Bindings of a SPARQL page, retried with backoff when the request or the response fails.
+    def query_page(self, url, params, header):
+        for attempt in range(self.page_attempts):
+            try:
+                res = self.transport.get(url, params=params, headers=header)
+                res.raise_for_status()
+                return utils.loads(res.content)['results']['bindings']
+            except Exception as e:
+                if attempt == self.page_attempts - 1:
+                    raise
+                logger.warning('Retrying SPARQL page: %s', e)
+                time.sleep(backoff(attempt))
+
+    @staticmethod
+    def _put(ids, item, stop):
+        # Waits for room in the queue unless the listing was stopped.
+        while not stop.is_set():
+            try:
+                ids.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def get_checkpoint(self, shard):
+        return self.checkpoints.get_checkpoint('sparql:' + shard) if self.checkpoints else None
+
+    def set_checkpoint(self, shard, last):
+        if self.checkpoints:
+            self.checkpoints.set_checkpoint('sparql:' + shard, last)
+    
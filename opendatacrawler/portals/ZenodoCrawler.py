@@ -1,111 +1,331 @@
+import queue
+import threading
+import time
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from opendatacrawler.portals.crawler_interface_abc import OpenDataCrawlerInterface
 from opendatacrawler.utils import utils
-import requests
-import time
+from opendatacrawler.utils.transport import Transport, backoff
 from opendatacrawler.utils import setup_logger
-from tqdm import tqdm
+from opendatacrawler.utils import progress
 
 logger = setup_logger.logger
+
+# Dates of the search windows, in UTC.
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+# Formats a record as returned by the Zenodo records API, from a search hit
+# or from /api/records/<id>, which have the same structure.
+def normalize_record(domain, record):
+    id = record['id']
+    metadata = record.get('metadata') or {}
+    language = metadata.get('language')
+    license = metadata.get('license') or record.get('license') or {}
+    license = license.get('id') if isinstance(license, dict) else license
+    resources = []
+
+    # Initialize metadata dict.
+    package_data = {
+         'dct:identifier': id,
+         'custom:id': utils.generate_hash(domain, id),
+         'custom:url': (record.get('links') or {}).get('self_html') or (record.get('links') or {}).get('html'),
+         'dct:title': None,
+         'dct:description': None,
+         'dcat:theme': None,
+         'dcat:keyword': None,
+         'dct:publisher': None,
+         'dct:language': language,
+         'dct:issued': metadata.get('publication_date') or record.get('created'),
+         'dct:modified': record.get('updated') or record.get('modified'),
+         'custom:country': None,
+         'dcat:distribution': None
+    }
+
+    # Check metadata existence and update dict.
+    if metadata.get('title'):
+        package_data['dct:title'] = {
+             'language': language,
+             'label': metadata.get('title')
+        }
+
+    if metadata.get('description'):
+        package_data['dct:description'] = {
+             'language': language,
+             'label': metadata.get('description')
+        }
+
+    if metadata.get('keywords'):
+        package_data['dcat:keyword'] = [{
+             'language': language,
+             'label': keyword
+        } for keyword in metadata.get('keywords')]
+
+    if metadata.get('subjects'):
+        package_data['dcat:theme'] = [{
+             'language': language,
+             'label': subject.get('term')
+        } for subject in metadata.get('subjects')]
+
+    if metadata.get('publisher'):
+        package_data['dct:publisher'] = {
+             'name': metadata.get('publisher'),
+             'homepage': None
+        }
+
+    # Save resources metadata.
+    for resource in record.get('files') or []:
+        key = resource.get('key') or resource.get('filename')
+        format = key.split('.')[-1] if key and '.' in key else None
+        resources.append({
+            'dct:title': {'language': None, 'label': key} if key else None,
+            'dcat:downloadURL': (resource.get('links') or {}).get('self'),
+            'custom:resource_id': utils.generate_hash(domain, resource.get('id', None)),
+            'dcat:mediaType': format.lower() if format else None,
+            'dcat:byteSize': resource.get('size') or resource.get('filesize'),
+            'dct:rights': license,
+            'custom:path': None
+        })
+
+    package_data['dcat:distribution'] = resources
+
+    return package_data
+
+
 class ZenodoCrawler(OpenDataCrawlerInterface):
-    def __init__(self, domain, formats):
+    probes = ['/api/records/']
+    page_size = 200
+    page_attempts = 5
+    # Deepest result reachable with page/size pagination in the search API.
+    max_results = 10000
+    # No record was created before Zenodo was launched.
+    first_date = datetime(2013, 1, 1)
+
+    def __init__(self, domain, formats, transport=None, base_url=None, checkpoints=None,
+                 window_workers=4, since=None):
         self.domain = domain
+        # Root of the portal, zenodo.org unless another one is given.
+        self.base_url = base_url if base_url else 'https://zenodo.org'
         self.formats = formats
-        self.token = utils.get_token(domain)
-    
-    # Collects ids from all packages.
-    def get_package_list(self):
-        url = 'https://zenodo.org/api/records?q=&page={}&size=200&resource_type=dataset{}'
-        formats = []
+        self.transport = transport if transport else Transport()
+        # Store with get_checkpoint/set_checkpoint (e.g. CrawlState) to resume the listing.
+        self.checkpoints = checkpoints
+        self.window_workers = window_workers
+        # Delta mode: only records updated after this time (epoch seconds) are listed.
+        self.since = since
+
+    # API token from config.ini, only read when it is used.
+    @cached_property
+    def token(self):
+        return utils.get_token(self.domain)
 
+    # Requests a page of the records of a date window, None if it keeps failing.
+    # The transport already waited for the API call limit (Zenodo limit is 60 requests per minute,
+    # 2000 requests per hour), so the page is retried a few times with backoff before giving up.
+    def search(self, window, page, size=None):
+        field, start, end = window
+        params = {
+            'q': '{}:["{}" TO "{}"}}'.format(field, start, end),
+            'page': page,
+            'size': size or self.page_size,
+            'sort': 'mostrecent',
+            'resource_type': 'dataset'
+        }
         if self.formats:
-            formats = ['&file_type={}'.format(format) for format in self.formats]
+            params['file_type'] = self.formats
+
+        for attempt in range(self.page_attempts):
+            if attempt:
+                time.sleep(backoff(attempt - 1))
+            try:
+                response = self.transport.get(self.base_url + '/api/records', params=params)
+                if response.status_code == 200:
+                    return utils.loads(response.content)
+                logger.info(response.status_code)
+            except Exception as e:
+                logger.error(e)
+        logger.error('Too many errors listing Zenodo records of %s, stopping at page %i',
+                     self.window_name(window), page)
+        return None
 
-        stop_condition = False
-        page = 1
-        ids = []
-        result_count = []
+    # The whole harvest as a date window: records created since Zenodo started or, in
+    # delta mode, updated since the given time. A resumed run reuses the window of
+    # the interrupted one so it finds the same windows and checkpoints.
+    def get_bounds(self):
+        bounds = self.get_checkpoint('bounds')
+        if bounds:
+            return tuple(bounds.split('|'))
+        if self.since:
+            field = 'updated'
+            start = datetime.fromtimestamp(self.since, timezone.utc).replace(tzinfo=None)
+        else:
+            field = 'created'
+            start = self.first_date
+        end = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=1)
+        bounds = (field, start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))
+        self.set_checkpoint('bounds', '|'.join(bounds))
+        return bounds
 
+    # A records search, with its hits.
+    @classmethod
+    def matches(cls, response):
+        return super().matches(response) and 'hits' in utils.loads(response.content)
+
+    @staticmethod
+    def window_name(window):
+        return '{}:{}/{}'.format(*window)
+
+    # Halves of a date window, None when it can not be split any more.
+    @staticmethod
+    def split(window):
+        field, start, end = window
+        start_date = datetime.strptime(start, DATE_FORMAT)
+        middle = start_date + (datetime.strptime(end, DATE_FORMAT) - start_date) / 2
+        middle = middle.replace(microsecond=0)
+        if middle <= start_date:
+            return None
+        return (field, start, middle.strftime(DATE_FORMAT)), (field, middle.strftime(DATE_FORMAT), end)
+
+    # Yields the records of the search API. Deep pagination is capped at max_results,
+    # so the harvest is split in date windows, bisecting the ones with more records.
+    # Windows are listed at the same time and each one saves a checkpoint after every page.
+    def get_records(self):
+        root = self.get_bounds()
+        result = self.search(root, 1, size=1)
+        if result is None:
+            # An empty listing would look like a delta run without changes.
+            raise ConnectionError('Zenodo records could not be listed')
+        pbar = progress.bar(total=result['hits']['total'], bar_format='{desc}: {percentage:3.0f}%|{bar}')
+
+        records = queue.Queue(maxsize=self.page_size * self.window_workers * 2)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.window_workers)
         try:
-            while not stop_condition:
-                response = requests.get(url.format(page,"".join(formats)))
-                if response.status_code == 200:
-                    if page==1:
-                        result_count = response.json().get('hits').get('total')
-                        pbar = tqdm(total = int(result_count/200), bar_format='{desc}: {percentage:3.0f}%|{bar}')
-                    datasets = response.json()['hits']['hits']
-                    for dataset in datasets:
-                        ids.append(dataset['id'])
-                    next_page = response.json().get('links').get('next', None)
-                    # Checks pagination.
-                    if not next_page:
-                        stop_condition = True
-                    else:
-                        page+=1
+            executor.submit(self.list_window, root, records, stop)
+            running = 1
+            failed = 0
+            while running:
+                item = records.get()
+                if item is None:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    failed += 1
+                elif isinstance(item, dict):
                     pbar.update(1)
-                # If API call limit is reached, waits 60s to make next call (Zenodo limit is 60 requests per minute, 2000 requests per hour).
+                    yield item
+                elif item[0] == 'split':
+                    self.set_checkpoint(self.window_name(item[1]), 'split')
+                    for half in self.split(item[1]):
+                        executor.submit(self.list_window, half, records, stop)
+                        running += 1
                 else:
-                    logger.info(response.status_code)
-                    time.sleep(60)
-            return ids
-        
+                    # Every record of the page was handed out, the window can resume after it.
+                    self.set_checkpoint(self.window_name(item[1]), item[2])
+            if failed:
+                # The listing is incomplete: the run must not be finished, the next one
+                # resumes the failed windows from their checkpoints.
+                raise ConnectionError('{} windows of Zenodo records could not be listed'.format(failed))
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            pbar.close()
+
+    # Lists the records of a window page by page, from its checkpoint if there is one,
+    # or asks for it to be split if it has more records than can be paginated. If a page
+    # keeps failing the error is handed to get_records and the window stays at its last checkpoint.
+    def list_window(self, window, records, stop):
+        try:
+            last = self.get_checkpoint(self.window_name(window))
+            if last == 'split':
+                self._put(records, ('split', window), stop)
+                return
+            page = int(last) + 1 if last and last != 'done' else 1
+            while last != 'done' and not stop.is_set():
+                result = self.search(window, page)
+                if result is None:
+                    raise ConnectionError('Page {} could not be obtained'.format(page))
+                if page == 1 and result['hits']['total'] > self.max_results:
+                    if self.split(window):
+                        self._put(records, ('split', window), stop)
+                        return
+                    logger.warning('More than %i Zenodo records in %s, only the first ones are listed',
+                                   self.max_results, self.window_name(window))
+
+                for record in result['hits']['hits']:
+                    self._put(records, record, stop)
+                last = 'done' if not (result.get('links') or {}).get('next') \
+                    or page * self.page_size >= self.max_results else page
+                self._put(records, ('checkpoint', window, last), stop)
+                page += 1
         except Exception as e:
-             logger.error(e)
-        
-    # to do: falta gestionar el límite de llamadas en la API de Zenodo.
-    
+            logger.error('Error listing Zenodo records of %s', self.window_name(window))
+            logger.error(e)
+            self._put(records, e, stop)
+        finally:
+            self._put(records, None, stop)
+
+    @staticmethod
+    def _put(records, item, stop):
+        # Waits for room in the queue unless the listing was stopped.
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def get_checkpoint(self, name):
+        return self.checkpoints.get_checkpoint('zenodo:' + name) if self.checkpoints else None
+
+    def set_checkpoint(self, name, value):
+        if self.checkpoints:
+            self.checkpoints.set_checkpoint('zenodo:' + name, value)
+
+    # Collects ids from all packages, yielding them page by page.
+    def get_package_list(self):
+        for record in self.get_records():
+            yield record['id']
+
+    # Harvests formatted packages straight from the search hits, so the crawl
+    # needs one request per page instead of one per record. A record is only
+    # requested on its own when its hit has no files listed.
+    def get_packages(self):
+        for record in self.get_records():
+            if record.get('files') is None and self.has_open_files(record):
+                package = self.get_package(record['id'])
+                if package:
+                    yield package
+                continue
+            try:
+                yield normalize_record(self.domain, record)
+            except Exception as e:
+                logger.error('Error formatting record %s', record.get('id'))
+                logger.error(e)
+
+    @staticmethod
+    def has_open_files(record):
+        # Restricted and closed records do not list their files anywhere.
+        access = (record.get('metadata') or {}).get('access_right')
+        return access in (None, 'open')
+
     def get_package(self, id):
-        url = 'https://zenodo.org/api/records/{}'.format(id)
+        url = self.base_url + '/api/records/{}'.format(id)
         try:
-            response = requests.get(url)
+            response = self.transport.get(url)
             response.raise_for_status()
-            response_json = response.json()
-            hash_id = utils.generate_hash(self.domain, id)
-            resources = []
-            
-            # Initialize metadata dict.
-            package_data = {
-                        'id': id,
-                        'custom_id': hash_id,
-                        'title': None,
-                        'description': None,
-                        'theme': None,
-                        'issued': None,
-                        'modified': None,
-                        'license': None,
-                        'country': None,
-                        'resources': None
-                    }
-            
-            # Check metadata existence and update dict.
-            if response_json.get('metadata'):
-                metadata = response_json.get('metadata')
-                if metadata.get('title'):
-                    package_data['title'] = response_json.get('title')
-                if metadata.get('description'):
-                    package_data['description'] = response_json.get('description')
-                if metadata.get('keywords'):
-                    package_data['theme'] = response_json.get('keywords')
-            
-            if response_json.get('created'):
-                package_data['issued'] = response_json.get('created')
-            
-            if response_json.get('modified'):
-                package_data['modified'] = response_json.get('modified')
-            
-            if response_json.get('license'):
-                if response_json.get('license').get('id'):
-                    package_data['license'] = response_json.get('license').get('id')
-
-            # Save resources metadata
-            if response_json.get('files'):
-                for resource in response_json.get('files'):
-                    format = None if resource.get('key') is None else resource.get('key').split('.')[-1]
-                    resources.append({
-                        'download_url': None if resource.get('links') is None else resource.get('links').get('self', None),
-                        'resource_id': utils.generate_hash(self.domain, resource.get('id', None)),
-                        'mediatype': format.lower() if format else None 
-                    })
-            package_data['resources'] = resources
-            return package_data
-        except requests.exceptions.HTTPError as errh:
+            return normalize_record(self.domain, utils.loads(response.content))
+        except Exception as errh:
             print(f"HTTP Error: {errh}")
+
+    # get_package for the async engine.
+    async def aget_package(self, id, transport):
+        url = self.base_url + '/api/records/{}'.format(id)
+        try:
+            response = await transport.get(url)
+            response.raise_for_status()
+            return normalize_record(self.domain, utils.loads(response.content))
+        except Exception as e:
+            logger.error('Error obtaining record %s', id)
+            logger.error(e)
+            return None
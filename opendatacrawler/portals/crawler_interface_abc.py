@@ -1,13 +1,27 @@
+import asyncio
 from abc import abstractmethod
 from abc import ABCMeta
 
 class OpenDataCrawlerInterface(metaclass=ABCMeta):
+    # Paths of the portal API requested to detect it, see matches.
+    probes = []
+
+    @classmethod
+    def matches(cls, response):
+        """ Checks the response to one of the probes. It must be cheap and
+            only True for the portal software of the class.
+
+            return match: bool
+        """
+        return response.status_code == 200 and 'text/html' not in response.headers.get('Content-Type', '')
+
     @abstractmethod
     def get_package_list():
-        """ This funciton must be used to obtain a list of all packages ids
-            from the portal.
+        """ This funciton must be used to obtain all packages ids from the
+            portal. It should be a generator, so crawling can start before
+            the whole catalogue has been listed.
 
-            return ids: list
+            yield ids: iterable
         """
         pass
 
@@ -41,4 +55,22 @@ class OpenDataCrawlerInterface(metaclass=ABCMeta):
 
             return metadata: dict
         """
-        pass
\ No newline at end of file
+        pass
+
+    async def aget_package(self, id, transport):
+        """ get_package for the async engine, with the requests made through
+            transport (an AsyncTransport) so they don't block the event loop.
+            Portals that don't implement it run get_package in a thread.
+
+            return metadata: dict
+        """
+        return await asyncio.to_thread(self.get_package, id)
+
+    def get_packages(self):
+        """ Optional bulk harvest. Portals that can return the metadata of many
+            packages per request yield them here, already formatted as in
+            get_package. Returns None when the portal does not support it.
+
+            yield metadata: iterable of dict
+        """
+        return None
\ No newline at end of file
@@ -1,20 +1,70 @@
+import asyncio
 import os
-import requests
 from opendatacrawler.utils import utils
+from opendatacrawler.utils.transport import Transport, HostLimiter
+from opendatacrawler.utils.ratelimit import RateLimiter
+from opendatacrawler.utils.state import CrawlState
+from opendatacrawler.utils import download
+from opendatacrawler.utils.blobstore import BlobStore
+from opendatacrawler.utils.cache import ResponseCache
+from opendatacrawler.utils import sinks
+from opendatacrawler.utils import metrics
+from opendatacrawler.utils import progress
 import time
-import json
+import hashlib
 import urllib3
+from urllib.parse import urlsplit
 import time
 from opendatacrawler.utils import setup_logger
-from opendatacrawler.portals.ZenodoCrawler import ZenodoCrawler
-from opendatacrawler.portals.DataEuropaCrawler import DataEuropaCrawler
-from tqdm import tqdm
+from opendatacrawler.portals import registry
 from sys import exit
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 logger = setup_logger.logger
+
+
+class CrawlPools():
+    """ Connection, download and metadata normalization pools of a crawl. A
+        batch crawl shares one set between the crawlers of all its portals,
+        and closes it once they are done."""
+
+    def __init__(self, workers=5, download_workers=5, per_host=8, http2=False, rate=10,
+                 limiter=None, normalize_workers=0, hosts=32):
+        # Shared connection pools for every request made by the crawlers and their dms,
+        # kept alive for up to hosts hosts (portals and file servers).
+        # Requests per second start at rate for every host and adapt to the portal's limits.
+        # A distributed crawl passes a limiter shared by all the workers.
+        self.transport = Transport(workers=workers + download_workers, http2=http2, hosts=hosts,
+                                   limiter=limiter if limiter else RateLimiter(rate=rate))
+        # Resources of every package are downloaded in one global pool, taking the packages
+        # in turn and at most per_host files at a time from the same host.
+        self.download_pool = download.DownloadPool(download_workers, HostLimiter(per_host))
+        self.host_limiter = self.download_pool.host_limiter
+        # Metadata is parsed and formatted in worker processes when requested, so it
+        # scales across cores instead of competing for the GIL with the I/O threads.
+        self.normalize_pool = None
+        if normalize_workers:
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            self.normalize_pool = ProcessPoolExecutor(max_workers=normalize_workers,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+
+    def close(self):
+        self.download_pool.shutdown(wait=False, cancel_futures=True)
+        if self.normalize_pool:
+            self.normalize_pool.shutdown(wait=False, cancel_futures=True)
+        self.transport.close()
+        if self.transport.cache:
+            self.transport.cache.close()
+
+
 class OpenDataCrawler():
-    def __init__(self, domain, path, formats=None, only_metadata=False):
+    def __init__(self, domain, path, formats=None, only_metadata=False, workers=5, http2=False,
+                 incremental=False, download_workers=5, per_host=8, max_sec=60, segments=1,
+                 rate=10, bulk=False, dedup=False, metadata_format='json', compression=None,
+                 fanout=False, layout='flat', normalize_workers=0, limiter=None, cache=False,
+                 cache_ttl=86400, cache_size=512, max_size=None, scheduler=None, detect_ttl=604800,
+                 pools=None):
         
         if domain[-1]=="/":
             self.domain = domain[:-1]
@@ -22,9 +72,31 @@ class OpenDataCrawler():
         self.dms = None
         self.dms_instance = None
         self.formats = formats
-        self.max_sec = 60
-        self.last_ids = None
+        # Orders the resources of a package before downloading them (None to keep the portal order).
+        self.scheduler = scheduler
+        # Max seconds spent on a file per turn (None for no limit), then it goes back to the
+        # download pool and is resumed while it makes progress, or in a later run.
+        self.max_sec = max_sec
+        self.retries = 3
+        # Files bigger than max_size bytes are not downloaded.
+        self.max_size = max_size
+        # Number of simultaneous Range requests for big files.
+        self.segments = segments
+        self.resuming = False
         self.only_metadata = only_metadata
+        # Only refetch packages and resources that changed since the previous run.
+        self.incremental = incremental
+        # Harvest formatted packages in pages when the portal supports it.
+        self.bulk = bulk
+        # Pools given by a batch crawl are shared with other portals and closed by it.
+        self.shared_pools = pools is not None
+        self.pools = pools if pools else CrawlPools(workers=workers, download_workers=download_workers,
+                                                    per_host=per_host, http2=http2, rate=rate, limiter=limiter,
+                                                    normalize_workers=normalize_workers)
+        self.transport = self.pools.transport
+        self.download_pool = self.pools.download_pool
+        self.host_limiter = self.pools.host_limiter
+        self.normalize_pool = self.pools.normalize_pool
 
         # Save path or create one based on selected domain. Create selected dms directory.
         if not path:
@@ -36,7 +108,25 @@ class OpenDataCrawler():
             self.save_path = path + '/' + utils.clean_url(self.domain)
             utils.create_folder(self.save_path)
         
+        # Crawl state (saved packages and resources) used to resume interrupted runs.
         self.resume_path = self.save_path + "/resume_{}.txt".format(utils.clean_url(self.domain))
+        self.state = CrawlState(self.save_path + "/state_{}.sqlite".format(utils.clean_url(self.domain)))
+        # API responses are cached for cache_ttl seconds, up to cache_size MB.
+        # A batch crawl has one cache for all its portals.
+        if cache and not self.shared_pools:
+            self.transport.cache = ResponseCache(self.save_path + "/cache_{}.sqlite".format(utils.clean_url(self.domain)),
+                                                 ttl=cache_ttl, max_bytes=cache_size * 1024 * 1024)
+        # Downloaded files are stored once per content and linked from data/.
+        self.blobs = BlobStore(self.save_path + '/blobs', self.state) if dedup else None
+        # Files are saved in data/ or fanned out in data/ab/cd/ with the hashed layout.
+        self.layout = layout
+        # Metadata output (json files, jsonl or parquet shards), written in background.
+        self.metadata_format = metadata_format
+        self.compression = compression
+        self.fanout = fanout
+        self.metadata_writer = None
+        # The detected dms of the domain is reused for detect_ttl seconds (0 to always detect it).
+        self.detect_ttl = detect_ttl
 
         print('Detecting DMS')
         # Detect dms based on domain.
@@ -44,113 +134,91 @@ class OpenDataCrawler():
     
     def detect_dms(self):
         
-        # Check dms
-        dms = dict([
-            ('Zenodo','/api/records/'),
-            ('DataEuropa', '/api/hub/search/')])
+        # Check dms, probing the portal unless it was detected recently.
+        detected_path = self.save_path + "/dms_{}.json".format(utils.clean_url(self.domain))
+        self.dms = registry.load_detected(detected_path, self.detect_ttl)
+        if not self.dms:
+            self.dms = registry.detect(self.transport, self.domain)
+            if self.dms:
+                registry.save_detected(detected_path, self.dms)
 
-        for key, value in dms.items():
-            try:
-                response = requests.get(self.domain+value, verify=False)
-                if response.status_code == 200 and response.headers['Content-Type']!="text/html":
-                    self.dms = key
-                    print('DMS detected')
-                    logger.info("DMS detected %s", key)
-                    # Create data and metadata directories.
-                    data_path = self.save_path + '/data'
-                    metadata_path = self.save_path + '/metadata'
-                    if not utils.create_folder(data_path):
-                        logger.info("Can't create folder" + data_path)
-                        exit()
-                    if not utils.create_folder(metadata_path):
-                        logger.info("Can't create folder" + metadata_path)
-                        exit()
-
-                    self.last_ids = self.get_last_ids()
-                    
-                    break
-
-            except Exception as e:
-                logger.info(e)
+        if self.dms:
+            print('DMS detected')
+            logger.info("DMS detected %s", self.dms)
+            # Create data and metadata directories.
+            data_path = self.save_path + '/data'
+            metadata_path = self.save_path + '/metadata'
+            if not utils.create_folder(data_path):
+                logger.info("Can't create folder" + data_path)
+                exit()
+            if not utils.create_folder(metadata_path):
+                logger.info("Can't create folder" + metadata_path)
+                exit()
+            self.metadata_writer = sinks.BackgroundWriter(
+                sinks.create_sink(metadata_path, self.metadata_format, self.compression, self.fanout))
+
+            self.resuming = self.state.start_run(legacy_resume_path=self.resume_path)
         
         # Create an instance of the corresponding dms.
                 
         if (self.dms):
+            # Only the crawler class of the detected dms is imported.
+            portal = registry.get_portal(self.dms)
             if self.dms=='Zenodo':
-                self.dms_instance = ZenodoCrawler(self.dms, self.formats)
-            if self.dms=='DataEuropa':
+                # Incremental runs only list the records updated since the last complete run.
+                self.dms_instance = portal(self.dms, self.formats, self.transport, base_url=self.domain,
+                                           checkpoints=self.state,
+                                           since=self.state.last_complete_started() if self.incremental else None)
+            elif self.dms=='DataEuropa':
                 if self.formats:
                     formats = []
                     for format in self.formats:
-                        if format in DataEuropaCrawler.get_formats_dict():
-                            formats.extend(DataEuropaCrawler.get_formats_dict().get(format))
+                        if format in portal.get_formats_dict():
+                            formats.extend(portal.get_formats_dict().get(format))
                         else:
                             formats.append(format)
                     self.formats = formats
-                self.dms_instance = DataEuropaCrawler(self.dms, self.formats)
+                self.dms_instance = portal(self.dms, self.formats, self.transport,
+                                           checkpoints=self.state, normalize_pool=self.normalize_pool,
+                                           base_url=self.domain + '/api/hub/search/',
+                                           sparql_url=self.domain + '/sparql')
+            else:
+                # Portals added by plugins.
+                self.dms_instance = portal(self.dms, self.formats, self.transport)
         else:
             print("The domain " + self.domain + " is not supported yet")
             logger.info("DMS not detected in %s", self.domain)
         
         
     # Generic method for saving a resource from an url. 
-    def save_dataset(self, url, ext, id):
-        """ Save a dataset from a given url and extension"""
+    def save_dataset(self, url, ext, id, previous=None):
+        """ Save a dataset from a given url and extension. If the state of a
+            previous download is given, the request is conditional and the
+            previous file is kept when the server answers 304. Interrupted
+            downloads are kept as <id>.part and resumed with Range requests."""
         try:
+            part_path = self.get_data_path(id, 'part')
             # Web page is not consideret a dataset
             if url[-4:] != 'html':
 
                 logger.info("Saving... %s ", url)
 
-                with requests.get(url, stream=True, timeout=60, verify=False) as r:
-
-                    # Checks if response content is not a webpage.
-                    response_content_type = r.headers.get('Content-Type')
-                    is_html = 'text/html' in response_content_type
-
-                    # Tries to get resource format in case it is None
-                    if ext is None:
-                        if url.split('.')[-1] in self.formats:
-                            ext = url.split('.')[-1]
-                        elif response_content_type.split('/')[-1] in self.formats:
-                            ext = response_content_type.split('/')[-1]
-                        else:
-                            response_split = response_content_type.split(';')
-                            for split in response_split:
-                                if split.split('/')[-1] in self.formats:
-                                    ext = split.split('/')[-1]
-                   
-                    if r.status_code == 200 and not is_html:
-                        fname = id + '.' + ext 
-                        path = self.save_path + "/data" + "/"+ fname
-                        total_size = int(r.headers.get('content-length', 0))
-                        # Write the content on a file
-                        with open(path, 'wb') as outfile, tqdm(desc=fname, total=total_size, colour='green',unit='B' ,unit_scale=True, unit_divisor=1024, leave=False) as bar:
-                            partial = False
-                            start_time = time.time()
-                            for chunk in r.iter_content(chunk_size=1024):
-                                # Stops file download if max download time is reached.
-                                if self.max_sec and ((time.time() - start_time) > self.max_sec):
-                                    partial = True
-                                    logger.warning('Timeout! Partially downloaded file: {}/{}'.format(url, id))
-                                    break
-
-                                if chunk:
-                                    size = outfile.write(chunk)
-                                    outfile.flush()
-                                    bar.update(size)
-                                    
-                        if not partial:
-                            logger.info("Dataset saved from {}/{}".format(url, id))
-                            return (id, path, partial)
-                        else:
-                            #utils.delete_interrupted_files(path)
-                            return (id, path, partial)
-                        
-                    else:
-                        logger.warning('Problem obtaining the resource {}'.format(url))
-
-                        return (id, None, False)
+                # Retries resuming the .part file while a lost connection leaves it growing.
+                for attempt in range(self.retries + 1):
+                    # Segmented downloads resume from their own progress, not from the end of the file.
+                    offset = os.path.getsize(part_path) \
+                        if os.path.exists(part_path) and not download.has_segments(part_path) else 0
+                    downloaded = download.downloaded_bytes(part_path)
+                    try:
+                        return self._fetch_dataset(url, ext, id, part_path, offset, previous)
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception as e:
+                        grown = download.downloaded_bytes(part_path) > downloaded
+                        if not grown or attempt == self.retries:
+                            raise
+                        metrics.retries.inc('connection')
+                        logger.warning('Connection lost, resuming {}/{}: {}'.format(url, id, e))
 
         except KeyboardInterrupt:
             raise
@@ -158,41 +226,352 @@ class OpenDataCrawler():
         except Exception as e:
             logger.error('Error saving dataset from %s', url)
             logger.error(e)
-            return (id, None, False)
-        
-    
-    def save_partial_dataset():
-        return None
-    
-    def save_metadata(self, data):
 
-        """ Save the dict containing the metadata on a json file"""
+        return (id, None, False, {})
+
+    async def asave_dataset(self, url, ext, id, transport, previous=None):
+        """ save_dataset for the async engine, through an AsyncTransport. Files
+            are streamed in one request, never in segments."""
         try:
-            with open(self.save_path + '/metadata' + "/meta_" + data['custom:id'] + '.json',
-                      'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+            part_path = self.get_data_path(id, 'part')
+            if url[-4:] != 'html':
+                logger.info("Saving... %s ", url)
+
+                for attempt in range(self.retries + 1):
+                    # A .part left in segments by the thread engine is downloaded again.
+                    offset = os.path.getsize(part_path) \
+                        if os.path.exists(part_path) and not download.has_segments(part_path) else 0
+                    downloaded = download.downloaded_bytes(part_path)
+                    try:
+                        return await self._afetch_dataset(url, ext, id, part_path, offset, previous, transport)
+                    except Exception as e:
+                        grown = download.downloaded_bytes(part_path) > downloaded
+                        if not grown or attempt == self.retries:
+                            raise
+                        metrics.retries.inc('connection')
+                        logger.warning('Connection lost, resuming {}/{}: {}'.format(url, id, e))
+
         except Exception as e:
-            logger.error('Error saving metadata  %s',
-                         self.save_path + "/meta_"+data['custom:id']+'.json')
+            logger.error('Error saving dataset from %s', url)
             logger.error(e)
 
+        return (id, None, False, {})
+
+    # Request headers to resume a .part from offset, or to revalidate the file of a
+    # previous run. Returns them with the state of the .part if it can be resumed.
+    def get_resume_headers(self, id, offset, previous):
+        headers = {}
+        last = None
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            # Only resumes if the file didn't change since the .part was written.
+            last = self.state.get_resource(id)
+            if last and last['status'] == 'partial' and (last['etag'] or last['last_modified']):
+                headers['If-Range'] = last['etag'] or last['last_modified']
+            else:
+                last = None
+        elif previous:
+            if previous['etag']:
+                headers['If-None-Match'] = previous['etag']
+            if previous['last_modified']:
+                headers['If-Modified-Since'] = previous['last_modified']
+        return headers, last
+
+    def _fetch_dataset(self, url, ext, id, part_path, offset, previous):
+        headers, last = self.get_resume_headers(id, offset, previous)
+
+        # The download pool holds a slot of the host while the resource is saved.
+        with self.transport.stream(url, headers=headers, timeout=60, verify=False) as r:
+
+            validators = {
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified')
+            }
+            action, value = self.check_download(r, url, ext, id, offset, previous, last, validators)
+            if action == 'done':
+                return value
+            if action == 'complete':
+                return self._finalize(url, id, part_path, self.get_data_path(id, value), validators)
+
+            if action == 'write':
+                ext = value
+                fname = id + '.' + ext 
+                path = self.get_data_path(id, ext)
+                # The server ignored the Range header, so the file starts again.
+                if r.status_code == 200:
+                    offset = 0
+                total_size = offset + int(r.headers.get('content-length', 0))
+                can_segment = self.segments > 1 and r.status_code == 200 \
+                    and r.headers.get('Accept-Ranges') == 'bytes' and total_size >= download.SEGMENT_THRESHOLD
+                resumable = can_segment and download.has_segments(part_path)
+                if download.has_segments(part_path) and not resumable:
+                    # The file can't be fetched in segments any more.
+                    download.discard_segments(part_path)
+                # Every segment takes a slot of the host, besides the one of this download.
+                extra = self.host_limiter.try_acquire(url, self.segments - 1) if can_segment else 0
+                segmented = can_segment and (extra > 0 or resumable)
+                # Content is hashed while streaming, for the manifest and the content addressed store.
+                hasher = None
+                if not segmented:
+                    hasher = download.hash_file(part_path) if offset else hashlib.sha256()
+
+                # Write the content on a file
+                try:
+                    with progress.bar(desc=fname, total=total_size, initial=offset, colour='green', unit='B',
+                              unit_scale=True, unit_divisor=1024, leave=False) as bar:
+                        if segmented:
+                            # Segments make their own requests, this one is not read.
+                            r.close()
+                            complete = download.download_segments(
+                                self.transport, url, part_path, total_size, self.segments, workers=extra + 1,
+                                max_sec=self.max_sec, callback=bar.update,
+                                validator=validators['etag'] or validators['last_modified'])
+                        else:
+                            complete = download.write_stream(r, part_path, offset, total_size,
+                                                             self.max_sec, bar.update, hasher)
+                finally:
+                    self.host_limiter.release(url, extra)
+
+                if complete:
+                    return self._finalize(url, id, part_path, path, validators, hasher)
+                else:
+                    logger.warning('Timeout! Partially downloaded file: {}/{}'.format(url, id))
+                    return (id, part_path, True, validators)
+
+        os.remove(part_path)
+        return self._fetch_dataset(url, ext, id, part_path, 0, previous)
+
+    async def _afetch_dataset(self, url, ext, id, part_path, offset, previous, transport):
+        headers, last = self.get_resume_headers(id, offset, previous)
+
+        async with transport.stream(url, headers=headers, timeout=60, verify=False) as r:
+
+            validators = {
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified')
+            }
+            action, value = self.check_download(r, url, ext, id, offset, previous, last, validators)
+            if action == 'done':
+                return value
+            if action == 'complete':
+                # Hashing the whole file would hold the loop, it is done in a thread.
+                return await asyncio.to_thread(self._finalize, url, id, part_path,
+                                               self.get_data_path(id, value), validators)
+
+            if action == 'write':
+                path = self.get_data_path(id, value)
+                if r.status_code == 200:
+                    offset = 0
+                    download.discard_segments(part_path)
+                total_size = offset + int(r.headers.get('content-length', 0))
+                hasher = await asyncio.to_thread(download.hash_file, part_path) if offset else hashlib.sha256()
+
+                with progress.bar(desc=id + '.' + value, total=total_size, initial=offset, colour='green',
+                                  unit='B', unit_scale=True, unit_divisor=1024, leave=False) as bar:
+                    complete = await download.awrite_stream(r, part_path, offset, total_size,
+                                                            self.max_sec, bar.update, hasher)
+
+                if complete:
+                    return self._finalize(url, id, part_path, path, validators, hasher)
+                logger.warning('Timeout! Partially downloaded file: {}/{}'.format(url, id))
+                return (id, part_path, True, validators)
+
+        os.remove(part_path)
+        return await self._afetch_dataset(url, ext, id, part_path, 0, previous, transport)
+
+    # Decides what to do with the response to a download request before its body is
+    # read. Returns 'write' and the extension to save the body with, 'complete' and
+    # the extension when the .part is already the whole file, 'restart' when the .part
+    # does not match the server and is downloaded again, or 'done' and the result of
+    # save_dataset when nothing is written (not modified, skipped or failed).
+    def check_download(self, r, url, ext, id, offset, previous, last, validators):
+        if r.status_code == 304 and previous:
+            metrics.resume_skips.inc('not_modified')
+            logger.info("Dataset not modified {}/{}".format(url, id))
+            validators = {
+                'etag': validators['etag'] or previous['etag'],
+                'last_modified': validators['last_modified'] or previous['last_modified'],
+                'checksum': previous['checksum']
+            }
+            return 'done', (id, previous['path'], False, validators)
+
+        if r.status_code == 416 and offset:
+            # Nothing left after the end of the .part: it is complete if it has the size
+            # and version of the file on the server, otherwise it is downloaded again.
+            if self.is_complete_part(r, offset, last):
+                if last:
+                    validators.update(etag=last['etag'], last_modified=last['last_modified'])
+                logger.info("Partially downloaded file was complete {}/{}".format(url, id))
+                return 'complete', ext or self.guess_ext(url, None) or 'bin'
+            logger.warning('Partially downloaded file does not match the server, starting again {}/{}'
+                           .format(url, id))
+            return 'restart', None
+
+        # Checks if response content is not a webpage.
+        response_content_type = r.headers.get('Content-Type', '')
+        is_html = 'text/html' in response_content_type
+
+        # Tries to get resource format in case it is None
+        if ext is None:
+            ext = self.guess_ext(url, response_content_type)
+            if ext is None and self.formats:
+                logger.info('Resource not in the requested formats {}/{}'.format(url, id))
+                return 'done', (id, None, False, validators)
+            elif ext is None:
+                ext = 'bin'
+
+        # Servers may not tell the size of a file until the GET.
+        length = r.headers.get('Content-Length', '')
+        if self.max_size and r.status_code == 200 and length.isdigit() and int(length) > self.max_size:
+            logger.info('Resource bigger than the maximum size {}/{}'.format(url, id))
+            metrics.prefiltered.inc('too_large')
+            return 'done', (id, None, False, validators)
+
+        if r.status_code in (200, 206) and not is_html:
+            return 'write', ext
+        logger.warning('Problem obtaining the resource {}'.format(url))
+        return 'done', (id, None, False, validators)
+
+    # A .part answered with 416 is complete if the server tells the same total size
+    # (Content-Range: bytes */<size>) and, when both are known, the same version.
+    @staticmethod
+    def is_complete_part(response, offset, last):
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        if not total.isdigit() or int(total) != offset:
+            return False
+        if last:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag and last['etag'] and etag != last['etag']:
+                return False
+            if last_modified and last['last_modified'] and last_modified != last['last_modified']:
+                return False
+        return True
+
+    # Moves a complete .part to its path, or to the content addressed store.
+    def _finalize(self, url, id, part_path, path, validators, hasher=None):
+        # Segments are written out of order, so they are hashed once complete.
+        validators['checksum'] = (hasher if hasher else download.hash_file(part_path)).hexdigest()
+        if self.blobs:
+            self.blobs.store(part_path, validators['checksum'], path,
+                             replaces=self.get_stored_checksum(id))
+        else:
+            os.replace(part_path, path)
+        logger.info("Dataset saved from {}/{}".format(url, id))
+        return (id, path, False, validators)
+
+    def save_metadata(self, data, callback=None):
+
+        """ Queue the dict containing the metadata for the metadata sink,
+            callback runs once it has been written"""
+        self.metadata_writer.write(data, callback)
+
+    # Yields the ids of the portal, or whole packages in bulk mode. When resuming,
+    # packages listed but not saved before the interruption come first, and
+    # the ones already saved are skipped.
     def get_package_list(self):
-        return self.dms_instance.get_package_list()
+        items = self.dms_instance.get_packages() if self.bulk else None
+        if items is None:
+            items = self.dms_instance.get_package_list()
+
+        queued = set()
+        if self.resuming:
+            queued = set(self.state.get_queued())
+            yield from queued
+
+        for item in items:
+            id = self.get_item_id(item)
+            if self.resuming and (id in queued or self.state.is_done(id)):
+                metrics.resume_skips.inc('done')
+                continue
+            self.state.enqueue(id)
+            yield item
+
+    @staticmethod
+    def get_item_id(item):
+        return str(item['dct:identifier']) if isinstance(item, dict) else str(item)
 
     def get_package(self, id):
-        return self.dms_instance.get_package(id)
+        # Packages obtained in bulk are already formatted.
+        if isinstance(id, dict):
+            return id
+        start = time.perf_counter()
+        package = self.dms_instance.get_package(id)
+        metrics.metadata_seconds.observe(value=time.perf_counter() - start)
+        if not package:
+            self.mark_package(str(id), 'error', error='Metadata not obtained')
+        return package
 
-    # Downloads and saves package resources. 
+    # get_package for the async engine, with the portal requests made through transport.
+    async def aget_package(self, id, transport):
+        if isinstance(id, dict):
+            return id
+        start = time.perf_counter()
+        package = await self.dms_instance.aget_package(id, transport)
+        metrics.metadata_seconds.observe(value=time.perf_counter() - start)
+        if not package:
+            self.mark_package(str(id), 'error', error='Metadata not obtained')
+        return package
+
+    # Downloads and saves package resources. Returns the updated package and
+    # 'partial' instead of 'done' if a file has to be resumed in a later run.
     def get_package_resources(self, package):
+        downloaded_resources, updated_resources = self.select_resources(package)
+        status = 'done'
+
+        # Downloads selected resources in the shared download pool and waits for all of them.
+        # The package has its own lane in the group of the portal, served in turn with the
+        # other packages in flight and, in a batch crawl, with the other portals.
+        # A file stopped by max_sec goes back to the end of the lane, so the other downloads
+        # get their turn, and is resumed in this run for as long as every turn makes progress.
+        if len(downloaded_resources) > 0:
+            package_id = str(package['dct:identifier'])
+            pending = [self.submit_resource(package_id, resource) for resource in downloaded_resources]
+            while pending:
+                future, progress_before = pending.pop(0)
+                resource, resource_status = future.result()
+                if resource_status == 'partial' and self.get_progress(resource) > progress_before:
+                    logger.info('Resuming {} in this run'.format(resource['dcat:downloadURL']))
+                    pending.append(self.submit_resource(package_id, resource))
+                    continue
+                if resource_status == 'partial':
+                    status = 'partial'
+                updated_resources.append(resource)
+
+        package['dcat:distribution'] = updated_resources
+        
+        return package, status
+
+    # get_package_resources for the async engine: the resources are downloaded at
+    # the same time on the loop, at most per_host at a time from the same host.
+    async def aget_package_resources(self, package, transport):
+        downloaded_resources, updated_resources = self.select_resources(package)
+        status = 'done'
+
+        package_id = str(package['dct:identifier'])
+        results = await asyncio.gather(*[self.asave_resource_resuming(package_id, resource, transport)
+                                         for resource in downloaded_resources])
+        for resource, resource_status in results:
+            if resource_status == 'partial':
+                status = 'partial'
+            updated_resources.append(resource)
+
+        package['dcat:distribution'] = updated_resources
+        return package, status
+
+    # Splits the resources of a package into the ones to download, in the order of
+    # the scheduler, and the ones left out by the requested formats.
+    def select_resources(self, package):
         resources = package['dcat:distribution']
         downloaded_resources = []
         updated_resources = []
-        
+
         # Filters resources by format if specified. Selects all resources otherwise.
+        # Resources without format are left to the prefilter, which asks the server.
         if self.formats:
             for resource in resources:
                 format = resource['dcat:mediaType']
-                if format and format in self.formats:
+                if format is None or format in self.formats:
                     downloaded_resources.append(resource)
                 else:
                     resource['custom:path'] = None
@@ -200,51 +579,313 @@ class OpenDataCrawler():
         else:
             downloaded_resources = resources
 
-        # Downloads and saves selected resources.
-        if len(downloaded_resources) > 0:
-            for resource in downloaded_resources:
-                url = resource['dcat:downloadURL']
-                id = resource['custom:resource_id']
-                mediatype = resource['dcat:mediaType']
-
-                result = self.save_dataset(url, mediatype, id)
-                current_path = result[1]
-                is_partial = result[2]
+        if self.scheduler:
+            downloaded_resources = self.scheduler.sort_resources(downloaded_resources)
+        return downloaded_resources, updated_resources
+
+    # Queues the download of a resource in the shared pool, with its progress so far.
+    def submit_resource(self, package_id, resource):
+        progress_before = self.get_progress(resource)
+        future = self.download_pool.submit(package_id, resource['dcat:downloadURL'],
+                                           self.save_resource, package_id, resource, group=self.domain)
+        return future, progress_before
+
+    # Bytes of a resource already in its .part file.
+    def get_progress(self, resource):
+        if not resource['custom:resource_id']:
+            return 0
+        return download.downloaded_bytes(self.get_data_path(resource['custom:resource_id'], 'part'))
+
+    # Downloads a resource of a package and records it in the crawl state.
+    def save_resource(self, package_id, resource):
+        url = resource['dcat:downloadURL']
+        previous = self.get_previous_resource(resource)
+        result = self.reuse_resource(resource, previous)
+        skip = None
+        if result is None:
+            mediatype, skip = self.prefilter(resource)
+            if skip:
+                result = self.skip_resource(resource, skip)
+            else:
+                start = time.perf_counter()
+                result = self.save_dataset(url, mediatype, resource['custom:resource_id'], previous)
+                metrics.download_seconds.observe(value=time.perf_counter() - start)
+        return self.record_resource(package_id, resource, result, skip)
+
+    # save_resource for the async engine. The slot of the host is taken from the
+    # host limiter of the download pool, waiting on the loop while the host is full.
+    async def asave_resource(self, package_id, resource, transport):
+        url = resource['dcat:downloadURL']
+        previous = self.get_previous_resource(resource)
+        result = self.reuse_resource(resource, previous)
+        skip = None
+        if result is None:
+            while not self.host_limiter.try_acquire(url):
+                await asyncio.sleep(0.05)
+            try:
+                mediatype, skip = await self.aprefilter(resource, transport)
+                if skip:
+                    result = self.skip_resource(resource, skip)
+                else:
+                    start = time.perf_counter()
+                    result = await self.asave_dataset(url, mediatype, resource['custom:resource_id'],
+                                                      transport, previous)
+                    metrics.download_seconds.observe(value=time.perf_counter() - start)
+            finally:
+                self.host_limiter.release(url)
+        return self.record_resource(package_id, resource, result, skip)
+
+    # Saves a resource with asave_resource. A file stopped by max_sec gives its host
+    # slot to the other downloads and is resumed in this run for as long as every
+    # turn makes progress.
+    async def asave_resource_resuming(self, package_id, resource, transport):
+        while True:
+            progress_before = self.get_progress(resource)
+            resource, status = await self.asave_resource(package_id, resource, transport)
+            if status != 'partial' or self.get_progress(resource) <= progress_before:
+                return resource, status
+            logger.info('Resuming {} in this run'.format(resource['dcat:downloadURL']))
+
+    # Returns the result of save_dataset for a resource that does not need a request,
+    # or None if it has to be downloaded.
+    def reuse_resource(self, resource, previous):
+        id = resource['custom:resource_id']
+        known = self.get_known_url(resource)
+        known_path = self.get_data_path(id, known['path'].rsplit('.', 1)[-1]) if known else None
+        if previous and not previous['etag'] and not previous['last_modified'] \
+                and resource.get('dcat:byteSize') and str(resource['dcat:byteSize']) == previous['byte_size']:
+            # Without validators an unchanged declared size is the best hint of an unchanged file.
+            return (id, previous['path'], False, {'checksum': previous['checksum']})
+        if known and self.blobs.link(known['checksum'], known_path, replaces=self.get_stored_checksum(id)):
+            # Same url already downloaded in this run, the stored content is linked without a request.
+            return (id, known_path, False,
+                    {'etag': known['etag'], 'last_modified': known['last_modified'],
+                     'checksum': known['checksum']})
+        return None
+
+    def skip_resource(self, resource, skip):
+        logger.info('Resource skipped ({}) {}'.format(skip, resource['dcat:downloadURL']))
+        metrics.prefiltered.inc(skip)
+        return (resource['custom:resource_id'], None, False, {})
+
+    # Records the result of save_dataset for a resource in the crawl state.
+    # Returns the resource, with its path once saved, and its status.
+    def record_resource(self, package_id, resource, result, skip):
+        url = resource['dcat:downloadURL']
+        id = resource['custom:resource_id']
+        current_path = result[1]
+        is_partial = result[2]
+        validators = result[3]
                 
-                if current_path != None and not is_partial :
-                    resource['custom:path'] = current_path
-                elif current_path != None:          
-                    # Removes file if it was partially downloaded due to a timeout.
-                    utils.delete_interrupted_files(current_path)
+        if current_path != None and not is_partial :
+            resource['custom:path'] = current_path
+            status = 'done'
+        elif current_path != None:          
+            # Keeps the .part file, next attempt resumes it.
+            status = 'partial'
+        elif skip:
+            status = 'skipped'
+        else:
+            status = 'error'
+
+        if id:
+            byte_size = resource.get('dcat:byteSize')
+            self.state.mark_resource(id, package_id, url, status,
+                                     bytes=os.path.getsize(current_path) if current_path else None,
+                                     byte_size=str(byte_size) if byte_size else None,
+                                     etag=validators.get('etag'),
+                                     last_modified=validators.get('last_modified'),
+                                     path=self.get_state_path(resource.get('custom:path')),
+                                     checksum=validators.get('checksum'), error=skip)
                 
-                updated_resources.append(resource)
+        return resource, status
 
-        package['dcat:distribution'] = updated_resources
-        utils.save_temporal_ids(self.resume_path, [package['dct:identifier']])
-        
-        return package
+    # Path of a downloaded file, data/<id>.<ext> or data/ab/cd/<id>.<ext> in the hashed layout.
+    def get_data_path(self, id, ext):
+        if self.layout == 'hashed':
+            path = utils.fanout_path(self.save_path + '/data', id + '.' + ext, id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return path
+        return self.save_path + '/data/' + id + '.' + ext
 
+    # Paths in the crawl state are relative to save_path, so the state and its
+    # manifest stay valid when the crawl is moved or run from another directory.
+    def get_state_path(self, path):
+        return os.path.relpath(path, self.save_path) if path else None
 
-    def get_last_ids(self):
-        saved_ids = []
-        if os.path.exists(self.resume_path):
-            with open(self.resume_path, "r") as file:
-                for line in file:
-                    saved_ids.append(line.strip())
-            return saved_ids
-        else:
+    def get_saved_path(self, state_path):
+        return os.path.join(self.save_path, state_path) if state_path else None
+
+    # Decides from the metadata, or from a HEAD request when it is not enough,
+    # if a resource is worth downloading: HTML landing pages, files bigger than
+    # max_size and files not in the requested formats are skipped before any
+    # body is transferred. Returns the extension of the file and the reason to
+    # skip it, if any.
+    def prefilter(self, resource):
+        decision = self.prefilter_metadata(resource)
+        if decision:
+            return decision
+        url = resource['dcat:downloadURL']
+        try:
+            r = self.transport.head(url, timeout=30, verify=False)
+        except Exception as e:
+            logger.info('HEAD request failed {}: {}'.format(url, e))
+            return resource['dcat:mediaType'], None
+        return self.prefilter_response(resource, r)
+
+    # prefilter for the async engine, with the HEAD request made through transport.
+    async def aprefilter(self, resource, transport):
+        decision = self.prefilter_metadata(resource)
+        if decision:
+            return decision
+        url = resource['dcat:downloadURL']
+        try:
+            r = await transport.head(url, timeout=30, verify=False)
+        except Exception as e:
+            logger.info('HEAD request failed {}: {}'.format(url, e))
+            return resource['dcat:mediaType'], None
+        return self.prefilter_response(resource, r)
+
+    # Decision of the prefilter from the declared metadata, or None if a HEAD request is needed.
+    def prefilter_metadata(self, resource):
+        ext = resource['dcat:mediaType']
+        size = str(resource.get('dcat:byteSize') or '')
+
+        if ext and 'html' in ext:
+            return ext, 'html'
+        if self.max_size and size.isdigit() and int(size) > self.max_size:
+            return ext, 'too_large'
+        if ext and not (self.max_size and not size.isdigit()):
+            return ext, None
+        return None
+
+    # Decision of the prefilter from the response to a HEAD request.
+    def prefilter_response(self, resource, r):
+        ext = resource['dcat:mediaType']
+        # Some servers don't implement HEAD, the GET decides for them.
+        if r.status_code >= 400:
+            return ext, None
+
+        content_type = r.headers.get('Content-Type', '')
+        length = r.headers.get('Content-Length', '')
+        if 'text/html' in content_type:
+            return ext, 'html'
+        if self.max_size and length.isdigit() and int(length) > self.max_size:
+            return ext, 'too_large'
+        if ext is None:
+            ext = self.guess_ext(resource['dcat:downloadURL'], content_type)
+            if ext is None and self.formats:
+                return None, 'format'
+        return ext, None
+
+    # Guesses the extension of a file from its url or Content-Type, among the
+    # requested formats if any.
+    def guess_ext(self, url, content_type):
+        name = urlsplit(url).path.rsplit('/', 1)[-1]
+        candidates = [name.rsplit('.', 1)[-1].lower()] if '.' in name else []
+        candidates += [split.split('/')[-1].strip().lower() for split in (content_type or '').split(';')]
+        for candidate in candidates:
+            if self.formats and candidate in self.formats:
+                return candidate
+            if not self.formats and candidate.isalnum() and len(candidate) <= 5:
+                return candidate
+        return None
+
+    # Checksum of the content saved for a resource, if any.
+    def get_stored_checksum(self, id):
+        stored = self.state.get_resource(id)
+        return stored['checksum'] if stored and stored['status'] == 'done' else None
+
+    # Returns a resource with the same url saved in this run if its content can be linked.
+    def get_known_url(self, resource):
+        if not self.blobs or not resource['custom:resource_id']:
+            return None
+        known = self.state.find_resource_by_url(resource['dcat:downloadURL'])
+        if known and known['id'] != resource['custom:resource_id'] and known['path']:
+            return known
+        return None
+
+    # Returns the state of a resource saved in a previous run if it can be reused.
+    def get_previous_resource(self, resource):
+        id = resource['custom:resource_id']
+        if not self.incremental or not id:
             return None
+        previous = self.state.get_resource(id)
+        if previous:
+            previous['path'] = self.get_saved_path(previous['path'])
+        if previous and previous['status'] == 'done' and previous['url'] == resource['dcat:downloadURL'] \
+                and previous['path'] and os.path.exists(previous['path']):
+            return previous
+        return None
+
+    # Checks if a package has the same dct:modified as when it was saved in a previous run.
+    def is_unchanged(self, package):
+        previous = self.state.get_package(str(package['dct:identifier']))
+        return previous is not None and previous['status'] == 'done' \
+            and package.get('dct:modified') is not None and previous['modified'] == package['dct:modified']
+
+
+    # Saves resources (unless only metadata is requested) and metadata of an obtained package.
+    # The package is marked in the crawl state only after its metadata is written.
+    def store_package(self, package):
+        if self.skip_unchanged(package):
+            return
+        status = 'done'
+        if not self.only_metadata:
+            package, status = self.get_package_resources(package)
+        self.save_package(package, status)
+
+    # store_package for the async engine, with the resources downloaded through transport.
+    async def astore_package(self, package, transport):
+        if self.skip_unchanged(package):
+            return
+        status = 'done'
+        if not self.only_metadata:
+            package, status = await self.aget_package_resources(package, transport)
+        self.save_package(package, status)
+
+    # In incremental runs a package not modified since it was saved is marked as done
+    # again, without saving it. Returns True for those packages.
+    def skip_unchanged(self, package):
+        if not (self.incremental and self.is_unchanged(package)):
+            return False
+        logger.info("Package not modified %s", package['dct:identifier'])
+        metrics.resume_skips.inc('unchanged')
+        self.mark_package(str(package['dct:identifier']), 'done', modified=package.get('dct:modified'))
+        return True
+
+    # Queues the metadata of a package, marking the package once it is written.
+    def save_package(self, package, status):
+        package_id = str(package['dct:identifier'])
+        modified = package.get('dct:modified')
+        self.save_metadata(package, lambda: self.mark_package(package_id, status, modified=modified))
+
+    # Records the status of a package in the crawl state and the metrics.
+    def mark_package(self, id, status, modified=None, error=None):
+        self.state.mark_package(id, status, modified=modified, error=error)
+        metrics.packages.inc(status)
+
+    # Waits until the metadata queued so far is durable and its packages are
+    # marked in the crawl state, and saves the state.
+    def flush(self):
+        if self.metadata_writer:
+            self.metadata_writer.flush()
+        self.state.flush()
+
+    # Releases download threads, pending metadata, crawl state and connections.
+    def close(self):
+        if self.metadata_writer:
+            self.metadata_writer.close()
+            self.metadata_writer = None
+        self.state.close()
+        if not self.shared_pools:
+            self.pools.close()
 
     def process_package(self, id):
         try:
             package = self.get_package(id)
-            if package and not self.only_metadata:
-                updated_package = self.get_package_resources(package)
-                if updated_package:
-                    self.save_metadata(updated_package)
-            elif package:
-                self.save_metadata(package)
-                utils.save_temporal_ids(self.resume_path, [package['dct:identifier']])
+            if package:
+                self.store_package(package)
         except KeyboardInterrupt:
             raise
             
\ No newline at end of file
@@ -0,0 +1,87 @@
+import importlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from importlib.metadata import entry_points
+from opendatacrawler.utils import setup_logger
+
+logger = setup_logger.logger
+
+# Portals shipped with the crawler, as module:class so a crawl only imports the one it uses.
+BUILTIN_PORTALS = {
+    'Zenodo': 'opendatacrawler.portals.ZenodoCrawler:ZenodoCrawler',
+    'DataEuropa': 'opendatacrawler.portals.DataEuropaCrawler:DataEuropaCrawler'
+}
+# Other packages add portals with entry points in this group, name = module:class.
+ENTRY_POINT_GROUP = 'opendatacrawler.portals'
+
+_portals = None
+
+
+def portals():
+    """ Supported portal software by name: the built-in portals and the ones
+        installed as plugins. Plugins are looked up once, the first time."""
+    global _portals
+    if _portals is None:
+        found = dict(BUILTIN_PORTALS)
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+            found.setdefault(entry_point.name, entry_point.value)
+        _portals = found
+    return _portals
+
+
+def is_portal(name):
+    return name in BUILTIN_PORTALS or name in portals()
+
+
+def get_portal(name):
+    """ Crawler class of a portal, imported on first use"""
+    module, _, attribute = (BUILTIN_PORTALS.get(name) or portals()[name]).partition(':')
+    return getattr(importlib.import_module(module), attribute)
+
+
+def probe(transport, domain, name, path, timeout):
+    try:
+        response = transport.get(domain + path, timeout=timeout, verify=False)
+        return name if get_portal(name).matches(response) else None
+    except Exception as e:
+        logger.info(e)
+        return None
+
+
+def detect(transport, domain, timeout=5):
+    """ Name of the portal software of domain, None if no probe matches. The
+        probes of every portal run at the same time and the first match wins,
+        so an unreachable domain costs timeout seconds at most."""
+    probes = [(name, path) for name in portals() for path in get_portal(name).probes]
+    executor = ThreadPoolExecutor(max_workers=len(probes))
+    futures = [executor.submit(probe, transport, domain, name, path, timeout) for name, path in probes]
+    try:
+        for future in as_completed(futures, timeout=timeout * 2):
+            if future.result():
+                return future.result()
+    except TimeoutError:
+        logger.info('Portal detection of %s timed out', domain)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return None
+
+
+def load_detected(path, ttl):
+    """ Portal software detected before in path, if it is younger than ttl seconds"""
+    if not ttl or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as file:
+            detected = json.load(file)
+    except ValueError:
+        return None
+    if time.time() - detected.get('detected', 0) > ttl or not is_portal(detected.get('dms')):
+        return None
+    return detected['dms']
+
+
+def save_detected(path, name):
+    with open(path, 'w') as file:
+        json.dump({'dms': name, 'detected': time.time()}, file)
@@ -0,0 +1,87 @@
+import heapq
+import itertools
+from datetime import datetime
+
+# Size assumed for resources without dcat:byteSize when estimating the cost of a package.
+UNKNOWN_SIZE = 10 * 1024 * 1024
+
+
+def modified_key(package, prefer):
+    """ Most recently modified (or issued) first"""
+    value = package.get('dct:modified') or package.get('dct:issued')
+    try:
+        return -datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return 0
+
+
+def resource_size(resource):
+    size = str(resource.get('dcat:byteSize') or '')
+    return int(size) if size.isdigit() else UNKNOWN_SIZE
+
+
+def size_key(package, prefer):
+    """ Smallest estimated download first, the cheapest packages fill a time-boxed crawl"""
+    return sum(resource_size(resource) for resource in package.get('dcat:distribution') or [])
+
+
+def format_key(package, prefer):
+    """ Packages with a resource in the most preferred format first"""
+    ranks = [prefer.index(resource['dcat:mediaType']) for resource in package.get('dcat:distribution') or []
+             if resource.get('dcat:mediaType') in prefer]
+    return min(ranks) if ranks else len(prefer)
+
+
+def publisher_key(package, prefer):
+    """ Packages of the preferred publishers first, in the given order"""
+    publisher = (package.get('dct:publisher') or {}).get('name')
+    return prefer.index(publisher) if publisher in prefer else len(prefer)
+
+
+PRIORITY_KEYS = {
+    'modified': modified_key,
+    'size': size_key,
+    'format': format_key,
+    'publisher': publisher_key
+}
+
+
+class PriorityScheduler():
+    """ Orders packages by a combination of priority keys (see PRIORITY_KEYS),
+        compared in the given order. prefer lists the preferred formats or
+        publishers for the format and publisher keys.
+
+        Packages arrive as a stream, so they are reordered inside a window of
+        the next packages: a bigger window gets closer to the global order at
+        the cost of memory. Plain ids are passed through, their metadata is
+        not known yet."""
+
+    def __init__(self, keys, prefer=None, window=1000):
+        self.keys = [PRIORITY_KEYS[key] for key in keys]
+        self.prefer = [value.lower() for value in prefer] if prefer else ['csv']
+        self.publishers = prefer or []
+        self.window = window
+
+    def key(self, package):
+        return tuple(key(package, self.publishers if key is publisher_key else self.prefer)
+                     for key in self.keys)
+
+    def reorder(self, items):
+        """ Yields items with the highest priority of the window first"""
+        heap = []
+        counter = itertools.count()
+        for item in items:
+            if not isinstance(item, dict):
+                yield item
+                continue
+            heapq.heappush(heap, (self.key(item), next(counter), item))
+            if len(heap) > self.window:
+                yield heapq.heappop(heap)[2]
+        while heap:
+            yield heapq.heappop(heap)[2]
+
+    def sort_resources(self, resources):
+        """ Smallest resources first when size is one of the keys"""
+        if size_key in self.keys:
+            return sorted(resources, key=resource_size)
+        return resources
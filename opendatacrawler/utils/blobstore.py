@@ -0,0 +1,67 @@
+import os
+import shutil
+import threading
+
+
+class BlobStore():
+    """ Content addressed store for downloaded files. Every distinct content
+        is kept once in <root>/<aa>/<bb>/<sha256> and the data/<id>.<ext>
+        files are hard links to it (copies where links are not supported),
+        so identical files published by several packages or under several
+        urls only take disk space once. Reference counts are kept in index
+        (a CrawlState) and a blob is removed when nothing points to it."""
+
+    def __init__(self, root, index):
+        self.root = root
+        self.index = index
+        self.lock = threading.Lock()
+
+    def blob_path(self, checksum):
+        return os.path.join(self.root, checksum[:2], checksum[2:4], checksum)
+
+    def store(self, file_path, checksum, path, replaces=None):
+        """ Moves a downloaded file into the store, or drops it if the content
+            is already there, and links the blob to path. replaces is the
+            checksum of the content path pointed to before, if any."""
+        blob = self.blob_path(checksum)
+        with self.lock:
+            if os.path.exists(blob):
+                os.remove(file_path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(file_path, blob)
+            self.index.add_blob_ref(checksum, os.path.getsize(blob))
+            self._link(blob, path)
+            if replaces:
+                self._release(replaces)
+
+    def link(self, checksum, path, replaces=None):
+        """ Links an existing blob to path. Returns False if it is not stored"""
+        blob = self.blob_path(checksum)
+        with self.lock:
+            if not os.path.exists(blob):
+                return False
+            self.index.add_blob_ref(checksum, os.path.getsize(blob))
+            self._link(blob, path)
+            if replaces:
+                self._release(replaces)
+        return True
+
+    def release(self, checksum):
+        """ Drops a reference to a blob, removing it if it was the last one"""
+        with self.lock:
+            self._release(checksum)
+
+    def _release(self, checksum):
+        blob = self.blob_path(checksum)
+        if self.index.release_blob(checksum) <= 0 and os.path.exists(blob):
+            os.remove(blob)
+
+    @staticmethod
+    def _link(blob, path):
+        tmp_path = path + '.link'
+        try:
+            os.link(blob, tmp_path)
+        except OSError:
+            shutil.copyfile(blob, tmp_path)
+        os.replace(tmp_path, path)
@@ -0,0 +1,147 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from requests.structures import CaseInsensitiveDict
+from opendatacrawler.utils import utils
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        url TEXT,
+        headers TEXT,
+        body BLOB,
+        size INTEGER,
+        stored_at REAL,
+        last_used REAL
+    ) WITHOUT ROWID""",
+    """CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)""",
+]
+
+
+class CachedResponse():
+    """ Response read from the cache, with the parts of the requests/httpx
+        response API used by the portal crawlers."""
+
+    status_code = 200
+
+    def __init__(self, url, headers, content):
+        self.url = url
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return utils.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class CacheEntry():
+    def __init__(self, url, headers, content, stored_at):
+        self.url = url
+        self.headers = headers
+        self.content = content
+        self.stored_at = stored_at
+
+    def response(self):
+        return CachedResponse(self.url, self.headers, self.content)
+
+
+class ResponseCache():
+    """ Cache of successful API responses keyed by url, parameters and
+        content negotiation headers. Recent entries are kept in memory (LRU,
+        up to memory_entries) and every entry is saved in a SQLite file,
+        where the least recently used ones are evicted above max_bytes.
+
+        Entries younger than ttl are served without a request. Older ones are
+        revalidated with their ETag/Last-Modified when they have them."""
+
+    def __init__(self, path, ttl=86400, max_bytes=512 * 1024 * 1024, memory_entries=1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def key(url, params=None, headers=None):
+        params = sorted((params or {}).items())
+        accept = (headers or {}).get('Accept', '')
+        return json.dumps([url, params, accept])
+
+    def is_fresh(self, entry):
+        return time.time() - entry.stored_at < self.ttl
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """ The cached entry of a key, fresh or not, or None"""
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+            row = self.conn.execute('SELECT url, headers, body, stored_at FROM responses WHERE key=?',
+                                    (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE responses SET last_used=? WHERE key=?', (time.time(), key))
+            entry = CacheEntry(row[0], json.loads(row[1]), row[2], row[3])
+            self._remember(key, entry)
+            return entry
+
+    def put(self, key, url, headers, content):
+        entry = CacheEntry(url, dict(headers), content, time.time())
+        with self.lock:
+            previous = self.conn.execute('SELECT size FROM responses WHERE key=?', (key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (key, url, json.dumps(entry.headers), content, len(content),
+                               entry.stored_at, entry.stored_at))
+            self.size += len(content) - (previous[0] if previous else 0)
+            self._remember(key, entry)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def refresh(self, key, entry):
+        """ Marks a revalidated entry as fresh again"""
+        entry.stored_at = time.time()
+        with self.lock:
+            self.conn.execute('UPDATE responses SET stored_at=?, last_used=? WHERE key=?',
+                              (entry.stored_at, entry.stored_at, key))
+            self._remember(key, entry)
+
+    def _evict(self):
+        # Drops least recently used entries until the cache is at 90% of its size.
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute('SELECT key, size FROM responses ORDER BY last_used').fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.memory.pop(key, None)
+            self.size -= size
+        self.conn.executemany('DELETE FROM responses WHERE key=?', evicted)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
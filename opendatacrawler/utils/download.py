@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from opendatacrawler.utils.transport import Transport, HostLimiter
+from opendatacrawler.utils import metrics
+
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+WRITE_BUFFER = 1024 * 1024
+# Files smaller than this are never split in segments.
+SEGMENT_THRESHOLD = 32 * 1024 * 1024
+# Seconds between saves of the progress of segmented downloads.
+SAVE_INTERVAL = 5
+
+
+def chunk_size_for(total_size):
+    """ Chunk size adapted to the file size, about 1/64 of it between 64 KiB and 4 MiB"""
+    if not total_size:
+        return 256 * 1024
+    return min(max(total_size // 64, MIN_CHUNK), MAX_CHUNK)
+
+
+def hash_file(path, hasher=None):
+    """ Feeds the content of a file to a hasher (a new sha256 by default)"""
+    hasher = hasher if hasher else hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(WRITE_BUFFER), b''):
+            hasher.update(block)
+    return hasher
+
+
+def write_stream(response, path, offset=0, total_size=0, max_sec=None, callback=None, hasher=None):
+    """ Writes the body of a streamed response to path, appending if offset
+        is given, and feeds it to hasher if given. Returns False if max_sec
+        was reached before the end."""
+    start_time = time.time()
+    with open(path, 'ab' if offset else 'wb', buffering=WRITE_BUFFER) as outfile:
+        for chunk in Transport.iter_content(response, chunk_size_for(total_size)):
+            # Stops file download if max download time is reached.
+            if max_sec and ((time.time() - start_time) > max_sec):
+                return False
+            if chunk:
+                outfile.write(chunk)
+                metrics.download_bytes.inc(value=len(chunk))
+                if hasher:
+                    hasher.update(chunk)
+                if callback:
+                    callback(len(chunk))
+    return True
+
+
+async def awrite_stream(response, path, offset=0, total_size=0, max_sec=None, callback=None, hasher=None):
+    """ write_stream for an httpx response streamed by an AsyncTransport. The
+        chunks are written to the file on the loop: they are small and land
+        in the page cache, unlike the network reads, which are awaited."""
+    start_time = time.time()
+    chunk_size = chunk_size_for(total_size)
+    # Chunks come whole from httpx, a bigger buffer would only cost memory per download.
+    with open(path, 'ab' if offset else 'wb', buffering=chunk_size) as outfile:
+        async for chunk in response.aiter_bytes(chunk_size):
+            if max_sec and ((time.time() - start_time) > max_sec):
+                return False
+            if chunk:
+                outfile.write(chunk)
+                metrics.download_bytes.inc(value=len(chunk))
+                if hasher:
+                    hasher.update(chunk)
+                if callback:
+                    callback(len(chunk))
+    return True
+
+
+def segments_path(path):
+    """ File keeping the progress of the segments of a download"""
+    return path + '.segments'
+
+
+def has_segments(path):
+    return os.path.exists(path) and os.path.exists(segments_path(path))
+
+
+def discard_segments(path):
+    for file_path in (path, segments_path(path)):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def downloaded_bytes(path):
+    """ Bytes of a download already on disk, in segments or in a .part file"""
+    if has_segments(path):
+        progress = load_segments(path)
+        return sum(next - start for start, _, next in progress) if progress else 0
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def load_segments(path, total_size=None, validator=None):
+    """ [start, end, next byte] of every segment of a download, None if there
+        is no saved progress or it belongs to another version of the file
+        (another size or ETag/Last-Modified validator)"""
+    try:
+        with open(segments_path(path), 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if total_size is not None and (saved.get('size'), saved.get('validator')) != (total_size, validator):
+        return None
+    if not os.path.exists(path) or os.path.getsize(path) != saved.get('size'):
+        return None
+    return saved['segments']
+
+
+def save_segments(path, total_size, progress, validator=None):
+    tmp_path = segments_path(path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'size': total_size, 'validator': validator, 'segments': progress}, f)
+    os.replace(tmp_path, segments_path(path))
+
+
+def download_segments(transport, url, path, total_size, segments, workers=None, max_sec=None,
+                      callback=None, verify=False, validator=None):
+    """ Downloads a file with several Range requests at the same time, each
+        one writing its own slice of the preallocated file, workers segments
+        at a time. The bytes on disk of every segment are saved in
+        <path>.segments, so a download stopped by max_sec or a lost
+        connection resumes each segment where it was, as long as the file
+        has the same validator (ETag or Last-Modified), which is also sent
+        as If-Range. Returns True once every segment is complete."""
+    progress = load_segments(path, total_size, validator)
+    if progress is None:
+        with open(path, 'wb') as outfile:
+            outfile.truncate(total_size)
+        size = -(-total_size // segments)
+        progress = [[start, min(start + size, total_size) - 1, start] for start in range(0, total_size, size)]
+        save_segments(path, total_size, progress, validator)
+    elif callback:
+        callback(sum(next - start for start, _, next in progress))
+    lock = threading.Lock()
+
+    def commit(segment, position):
+        # Only bytes already flushed to the file are recorded.
+        with lock:
+            segment[2] = position
+            save_segments(path, total_size, progress, validator)
+
+    def fetch(segment):
+        start, end, position = segment
+        if position > end:
+            return True
+        headers = {'Range': 'bytes={}-{}'.format(position, end)}
+        if validator:
+            headers['If-Range'] = validator
+        with transport.stream(url, headers=headers, verify=verify) as r:
+            # A 200 means the file changed (If-Range) or ranges are not served any more.
+            if r.status_code != 206:
+                return False
+            start_time = last_save = time.time()
+            with open(path, 'r+b', buffering=WRITE_BUFFER) as outfile:
+                outfile.seek(position)
+                try:
+                    for chunk in Transport.iter_content(r, chunk_size_for(end - start + 1)):
+                        if max_sec and ((time.time() - start_time) > max_sec):
+                            return False
+                        chunk = chunk[:end + 1 - position]
+                        if chunk:
+                            outfile.write(chunk)
+                            position += len(chunk)
+                            metrics.download_bytes.inc(value=len(chunk))
+                            if callback:
+                                callback(len(chunk))
+                        if position > end:
+                            break
+                        if time.time() - last_save > SAVE_INTERVAL:
+                            outfile.flush()
+                            commit(segment, position)
+                            last_save = time.time()
+                finally:
+                    outfile.flush()
+                    commit(segment, position)
+            return position == end + 1
+
+    pending = [segment for segment in progress if segment[2] <= segment[1]]
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers or segments, len(pending)))) as executor:
+            results = list(executor.map(fetch, pending))
+        if not all(results):
+            return False
+    os.remove(segments_path(path))
+    return True
+
+
+class DownloadPool():
+    """ Download threads shared by every package of a crawl. Files wait in a
+        lane per package and free threads take them from the lanes in turn,
+        so the files of a small package do not wait behind all the files of
+        a big one submitted earlier. Lanes belong to a group (the portal in a
+        batch crawl) and groups are served in turn too, so a portal with many
+        packages in flight does not take the threads of the others. A file
+        whose host already runs per_host downloads is passed over for the
+        next lane: threads never block waiting for a host while other files
+        could be downloaded."""
+
+    def __init__(self, workers=5, host_limiter=None):
+        self.host_limiter = host_limiter if host_limiter else HostLimiter(0)
+        # Group: lanes of files waiting, as (future, url, fn, args). The group
+        # and the lane served last go to the end.
+        self.groups = OrderedDict()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, lane, url, fn, *args, group=None):
+        """ Schedules fn(*args), which downloads url, in lane of group. Returns a Future"""
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('cannot schedule new downloads after shutdown')
+            lanes = self.groups.setdefault(group, OrderedDict())
+            lanes.setdefault(lane, deque()).append((future, url, fn, args))
+            self.condition.notify()
+        return future
+
+    def _next(self):
+        # First file, taking the groups and their lanes in turn, whose host has a free slot.
+        for group, lanes in self.groups.items():
+            for lane, tasks in lanes.items():
+                for i, task in enumerate(tasks):
+                    if self.host_limiter.try_acquire(task[1]):
+                        del tasks[i]
+                        if tasks:
+                            lanes.move_to_end(lane)
+                        else:
+                            del lanes[lane]
+                        if lanes:
+                            self.groups.move_to_end(group)
+                        else:
+                            del self.groups[group]
+                        return task
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                task = self._next()
+                while task is None and (self.groups or not self.closed):
+                    # Slots may also be freed outside the pool (segments), so waits are bounded.
+                    self.condition.wait(timeout=1)
+                    task = self._next()
+                if task is None:
+                    return
+            future, url, fn, args = task
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self.host_limiter.release(url)
+                with self.condition:
+                    self.condition.notify_all()
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self.condition:
+            self.closed = True
+            if cancel_futures:
+                for lanes in self.groups.values():
+                    for tasks in lanes.values():
+                        for task in tasks:
+                            task[0].cancel()
+                self.groups.clear()
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
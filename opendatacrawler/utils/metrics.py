@@ -0,0 +1,204 @@
+import json
+import threading
+
+# Upper bounds in seconds of the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metric():
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError('{} expects labels {}'.format(self.name, self.labels))
+        return tuple(str(label) for label in labels)
+
+    def _label_text(self, key, extra=None):
+        pairs = list(zip(self.labels, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in pairs) + '}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, value=1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        with self.lock:
+            return ['{}_total{} {}'.format(self.name, self._label_text(key), value)
+                    for key, value in self.values.items()]
+
+    def summary(self):
+        with self.lock:
+            return {','.join(key) or 'total': value for key, value in self.values.items()}
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, *labels, value):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def render(self):
+        with self.lock:
+            return ['{}{} {}'.format(self.name, self._label_text(key), value)
+                    for key, value in self.values.items()]
+
+    def summary(self):
+        with self.lock:
+            return {','.join(key) or 'value': value for key, value in self.values.items()}
+
+
+class Histogram(Metric):
+    """ Observations counted in cumulative buckets, with their sum"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(self.name, self._label_text(key, ('le', str(bound))),
+                                                         cumulative))
+                lines.append('{}_count{} {}'.format(self.name, self._label_text(key), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, self._label_text(key), round(total, 6)))
+        return lines
+
+    def quantile(self, counts, q):
+        """ Estimates a quantile interpolating inside its bucket"""
+        count = sum(counts)
+        rank = q * count
+        cumulative = 0
+        lower = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = bound
+        return self.buckets[-1]
+
+    def summary(self):
+        with self.lock:
+            return {','.join(key) or 'all': {
+                'count': sum(counts),
+                'sum': round(total, 6),
+                'p50': round(self.quantile(counts, 0.5), 6),
+                'p99': round(self.quantile(counts, 0.99), 6)
+            } for key, (counts, total) in self.values.items()}
+
+
+class Registry():
+    """ Metrics of the crawler, rendered in the Prometheus text format or as a
+        json summary."""
+
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        return {metric.name: metric.summary() for metric in self.metrics}
+
+    def save_summary(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=4)
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Exposes the metrics on http://host:port/metrics from a background thread"""
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics':
+                    body = registry.render().encode()
+                    content_type = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+                elif self.path.split('?')[0] == '/summary':
+                    body = json.dumps(registry.summary()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+registry = Registry()
+
+http_requests = registry.add(Counter('odc_requests', 'HTTP responses received by host and status code',
+                                     ('host', 'status')))
+download_bytes = registry.add(Counter('odc_download_bytes', 'Bytes of resources downloaded'))
+metadata_seconds = registry.add(Histogram('odc_metadata_seconds', 'Time to obtain the metadata of a package'))
+download_seconds = registry.add(Histogram('odc_download_seconds', 'Time to download a resource'))
+queue_depth = registry.add(Gauge('odc_queue_depth', 'Packages waiting in the crawl engine by stage',
+                                 ('stage',)))
+retries = registry.add(Counter('odc_retries', 'Requests retried by reason', ('reason',)))
+ratelimit_wait_seconds = registry.add(Histogram('odc_ratelimit_wait_seconds',
+                                                'Time requests waited for the rate limiter'))
+resume_skips = registry.add(Counter('odc_resume_skips', 'Packages and resources not fetched again by reason',
+                                    ('reason',)))
+prefiltered = registry.add(Counter('odc_prefiltered', 'Resources skipped before downloading them by reason',
+                                   ('reason',)))
+packages = registry.add(Counter('odc_packages', 'Packages stored by status', ('status',)))
+cache = registry.add(Counter('odc_cache', 'API responses served from the cache (hit, revalidated) or not (miss)',
+                             ('result',)))
@@ -0,0 +1,10 @@
+# Progress bars are not drawn in headless mode, where drawing them costs
+# more than the work they report and nobody is watching the terminal.
+enabled = True
+
+
+def bar(*args, **kwargs):
+    """ A tqdm progress bar, disabled in headless mode"""
+    from tqdm import tqdm
+    kwargs.setdefault('disable', not enabled)
+    return tqdm(*args, **kwargs)
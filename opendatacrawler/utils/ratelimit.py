@@ -0,0 +1,240 @@
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+# Responses telling the client to slow down.
+THROTTLE_CODES = (429, 503)
+
+
+class TokenBucket():
+    def __init__(self, rate, burst, updated=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = updated if updated is not None else time.monotonic()
+        # Nothing is sent to the host before this time (Retry-After, exhausted quota).
+        self.blocked_until = 0
+
+
+class RateLimiter():
+    """ Token bucket per host shared by every request of the crawler. The
+        rate adapts with AIMD: it grows a little after each successful
+        response and is halved on 429/503. Retry-After and X-RateLimit-*
+        headers block the host until the portal allows new requests."""
+
+    def __init__(self, rate=10, burst=None, min_rate=0.2, max_rate=100, increase=0.1, decrease=0.5):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst or max(self.rate, 1))
+            self._buckets[host] = bucket
+        return bucket
+
+    def acquire(self, url):
+        """ Blocks until a request to the host of url is allowed. Returns the seconds waited"""
+        waited = 0
+        while True:
+            wait = self.try_acquire(url)
+            if wait is None:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self, url):
+        """ Takes a token of the host of url without waiting. Returns None if
+            the request is allowed, or the seconds to wait before trying again"""
+        host = urlsplit(url).netloc
+        with self._lock:
+            return self._take(self._bucket(host), time.monotonic())
+
+    def update(self, url, status_code, headers):
+        """ Adapts the rate of a host to a response. Returns True if the
+            request was throttled and should be retried."""
+        host = urlsplit(url).netloc
+        with self._lock:
+            return self._adapt(self._bucket(host), time.monotonic(), status_code, headers)
+
+    # Takes a token from the bucket. Returns None if there was one, or the seconds to wait.
+    def _take(self, bucket, now):
+        bucket.tokens = min(bucket.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+        bucket.updated = now
+        if now >= bucket.blocked_until and bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return None
+        return max(bucket.blocked_until - now, (1 - bucket.tokens) / bucket.rate)
+
+    def _adapt(self, bucket, now, status_code, headers):
+        throttled = status_code in THROTTLE_CODES
+
+        if throttled:
+            bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+            bucket.tokens = 0
+            # Without Retry-After waits as much as a token takes at the new rate.
+            bucket.blocked_until = max(bucket.blocked_until, now + 1 / bucket.rate)
+        else:
+            bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        if retry_after is not None:
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = parse_reset(headers.get('X-RateLimit-Reset'))
+        if remaining is not None and reset is not None and remaining.isdigit():
+            if int(remaining) <= 0:
+                bucket.blocked_until = max(bucket.blocked_until, now + reset)
+            else:
+                # Spreads the remaining quota over the rest of the window.
+                bucket.rate = max(self.min_rate, min(bucket.rate, int(remaining) / max(reset, 1)))
+
+        return throttled
+
+
+class SharedRateLimiter(RateLimiter):
+    """ RateLimiter whose buckets live in a SQLite file shared by every worker
+        of a distributed crawl (see utils/workqueue.py), so the rate of a host
+        is respected by the whole fleet. Buckets use wall clock time, which is
+        shared between hosts unlike the monotonic clock.
+
+        Tokens are leased from the shared bucket in batches, as many as the
+        rate allows in lease_time seconds, and spent locally until they run
+        out or the lease expires. Successful responses are counted locally and
+        applied with the next lease; throttled responses and exhausted quotas
+        are written at once and drop the lease, so every worker slows down."""
+
+    def __init__(self, path, rate=10, burst=None, min_rate=0.2, max_rate=100, increase=0.1, decrease=0.5,
+                 lease_time=1):
+        super().__init__(rate, burst, min_rate, max_rate, increase, decrease)
+        self.lease_time = lease_time
+        # Tokens leased by host, with the time the lease expires.
+        self._leases = {}
+        # Successful responses by host since the last lease, with the last rate limit headers.
+        self._successes = {}
+        self._lease_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS rate_limits (
+            host TEXT PRIMARY KEY,
+            rate REAL,
+            burst REAL,
+            tokens REAL,
+            updated REAL,
+            blocked_until REAL
+        ) WITHOUT ROWID""")
+
+    def _shared(self, host, change):
+        """ Loads the bucket of a host, applies change to it and saves it in one transaction"""
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT rate, burst, tokens, updated, blocked_until FROM rate_limits '
+                                        'WHERE host=?', (host,)).fetchone()
+                now = time.time()
+                if row:
+                    bucket = TokenBucket(row[0], row[1], row[3])
+                    bucket.tokens = row[2]
+                    bucket.blocked_until = row[4]
+                else:
+                    bucket = TokenBucket(self.rate, self.burst or max(self.rate, 1), now)
+                result = change(bucket, now)
+                self.conn.execute('INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?, ?)',
+                                  (host, bucket.rate, bucket.burst, bucket.tokens, bucket.updated,
+                                   bucket.blocked_until))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return result
+
+    # Applies the successes counted locally to the shared bucket.
+    def _apply(self, bucket, now, successes):
+        if successes:
+            count, headers = successes
+            bucket.rate = min(self.max_rate, bucket.rate + self.increase * (count - 1))
+            self._adapt(bucket, now, 200, headers)
+
+    # Takes a lease of tokens from the bucket. Returns the number of tokens
+    # and None, or 0 and the seconds to wait.
+    def _lease(self, bucket, now, successes):
+        self._apply(bucket, now, successes)
+        wait = self._take(bucket, now)
+        if wait is not None:
+            return 0, wait
+        tokens = 1 + min(int(bucket.tokens), max(0, int(bucket.rate * self.lease_time) - 1))
+        bucket.tokens -= tokens - 1
+        return tokens, None
+
+    def try_acquire(self, url):
+        host = urlsplit(url).netloc
+        with self._lease_lock:
+            lease = self._leases.get(host)
+            if lease and lease[0] >= 1 and time.monotonic() < lease[1]:
+                lease[0] -= 1
+                return None
+            successes = self._successes.pop(host, None)
+        tokens, wait = self._shared(host, lambda bucket, now: self._lease(bucket, now, successes))
+        if tokens:
+            with self._lease_lock:
+                self._leases[host] = [tokens - 1, time.monotonic() + self.lease_time]
+            return None
+        return wait
+
+    def update(self, url, status_code, headers):
+        host = urlsplit(url).netloc
+        remaining = headers.get('X-RateLimit-Remaining')
+        if status_code not in THROTTLE_CODES and not headers.get('Retry-After') \
+                and not (remaining is not None and remaining.isdigit() and int(remaining) <= 0):
+            with self._lease_lock:
+                count, last = self._successes.get(host, (0, {}))
+                if 'X-RateLimit-Remaining' in headers:
+                    last = {name: headers.get(name) for name in ('X-RateLimit-Remaining', 'X-RateLimit-Reset')}
+                self._successes[host] = (count + 1, last)
+            return False
+        with self._lease_lock:
+            self._leases.pop(host, None)
+            successes = self._successes.pop(host, None)
+
+        def change(bucket, now):
+            self._apply(bucket, now, successes)
+            return self._adapt(bucket, now, status_code, headers)
+        return self._shared(host, change)
+
+    def close(self):
+        # Successes not applied yet still raise the shared rate.
+        for host, successes in list(self._successes.items()):
+            self._shared(host, lambda bucket, now: self._apply(bucket, now, successes))
+        self._successes = {}
+        self.conn.close()
+
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header (delta seconds or HTTP date)"""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_reset(value):
+    """ Seconds until the quota resets from X-RateLimit-Reset (delta seconds or epoch)"""
+    if not value or not value.strip().isdigit():
+        return None
+    value = int(value)
+    # Big values are epoch timestamps, small ones are seconds from now.
+    if value > 10**9:
+        return max(0, value - time.time())
+    return value
@@ -14,15 +14,23 @@ def create_folder(path):
             return True
 
 
+# Modules log here from import time, but nothing is written until the
+# command line configures it, so importing the package has no side effects.
 logger = logging.getLogger('myLogger')
 logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.NullHandler())
 
-directory = os.getcwd()
-create_folder(directory + "/logs")
 
-today = datetime.now().strftime("%Y%m%d")
+def configure(directory=None):
+    """ Writes the log in logs/debug_<date>.log inside directory (the current one by default)"""
+    if any(isinstance(handler, logging.FileHandler) for handler in logger.handlers):
+        return
+    directory = directory if directory else os.getcwd()
+    create_folder(directory + "/logs")
 
-handler = logging.FileHandler(directory + '/logs/debug_'+str(today)+'.log', 'a', 'utf-8')
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+    today = datetime.now().strftime("%Y%m%d")
+
+    handler = logging.FileHandler(directory + '/logs/debug_'+str(today)+'.log', 'a', 'utf-8')
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
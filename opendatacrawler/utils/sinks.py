@@ -0,0 +1,345 @@
+import os
+import json
+import gzip
+import queue
+import threading
+import time
+from opendatacrawler.utils import setup_logger
+from opendatacrawler.utils.utils import fanout_path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = setup_logger.logger
+
+# Top level metadata fields, as built by the portal crawlers.
+METADATA_FIELDS = ['dct:identifier', 'custom:id', 'custom:url', 'dct:title', 'dct:description',
+                   'dcat:theme', 'dcat:keyword', 'dct:publisher', 'dct:language', 'dct:issued',
+                   'dct:modified', 'custom:country', 'dcat:distribution']
+
+
+class JsonFileSink():
+    """ One indented json file per package, metadata/meta_<id>.json, optionally
+        fanned out in hashed subfolders."""
+
+    # Every file is complete once written, so packages are marked done right away.
+    flush_size = 1
+    flush_interval = 0
+
+    def __init__(self, folder, fanout=False):
+        self.folder = folder
+        self.fanout = fanout
+
+    def write(self, data):
+        name = "meta_" + data['custom:id'] + '.json'
+        if self.fanout:
+            path = fanout_path(self.folder, name, data['custom:id'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        else:
+            path = os.path.join(self.folder, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink():
+    """ Packages appended to rolling JSON Lines shards, metadata/meta_<n>.jsonl,
+        compressed with gzip or zstd. A new shard starts every shard_size
+        packages and every run, so shards are never reopened.
+
+        Each flush ends the current gzip member (or zstd frame) and syncs the
+        shard, whose length is then recorded in meta_<n>.jsonl.gz.flushed until
+        it is closed. A shard left open by a killed run is cut back to that
+        length, so it only holds complete members (zstd readers need
+        read_across_frames to read them all)."""
+
+    extensions = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+    flush_size = 1000
+    flush_interval = 5
+
+    def __init__(self, folder, compression='gzip', shard_size=100000):
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        self.folder = folder
+        self.compression = compression
+        self.shard_size = shard_size
+        self.path = None
+        # Shard file and the compressed stream of its current member.
+        self.raw = None
+        self.stream = None
+        self.count = 0
+        self.unflushed = 0
+        self.recover()
+        self.shard = len([f for f in os.listdir(folder)
+                          if f.startswith('meta_') and '.jsonl' in f and not f.endswith('.flushed')])
+
+    def recover(self):
+        """ Cuts the shards of a killed run back to their last flush"""
+        for name in os.listdir(self.folder):
+            if not (name.startswith('meta_') and name.endswith('.flushed')):
+                continue
+            marker = os.path.join(self.folder, name)
+            path = marker[:-len('.flushed')]
+            with open(marker, 'r') as f:
+                length = int(f.read().strip() or 0)
+            if os.path.exists(path):
+                if length:
+                    with open(path, 'r+b') as f:
+                        f.truncate(length)
+                else:
+                    os.remove(path)
+            os.remove(marker)
+
+    def _mark(self, length):
+        # Written aside and renamed, so a crash never leaves the marker half written.
+        marker = self.path + '.flushed'
+        with open(marker + '.tmp', 'w') as f:
+            f.write(str(length))
+        os.replace(marker + '.tmp', marker)
+
+    def _open(self):
+        self.path = os.path.join(self.folder, 'meta_{:05d}.jsonl{}'.format(
+            self.shard, JsonLinesSink.extensions[self.compression]))
+        self.shard += 1
+        self.count = 0
+        self.raw = open(self.path, 'wb')
+        self._mark(0)
+
+    def _member(self):
+        if self.compression == 'gzip':
+            return gzip.GzipFile(fileobj=self.raw, mode='wb')
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)
+        return self.raw
+
+    def write(self, data):
+        if self.raw is None or self.count >= self.shard_size:
+            self.close()
+            self._open()
+        if self.stream is None:
+            self.stream = self._member()
+        self.stream.write((json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8'))
+        self.count += 1
+        self.unflushed += 1
+
+    def flush(self):
+        if self.raw is None or not self.unflushed:
+            return
+        if self.stream is not self.raw:
+            # Closing the member writes its trailer, the shard stays open.
+            self.stream.close()
+        self.stream = None
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self._mark(self.raw.tell())
+        self.unflushed = 0
+
+    def close(self):
+        if self.raw:
+            self.flush()
+            self.raw.close()
+            self.raw = None
+            os.remove(self.path + '.flushed')
+
+
+class ParquetSink():
+    """ Packages written to Parquet shards, metadata/meta_<n>.parquet, with a
+        fixed schema: one string column per metadata field, where nested
+        values (titles, themes, distributions...) are stored as json.
+
+        A shard is written by one ParquetWriter, each flush appending a row
+        group, and a new shard starts every shard_size rows and every run.
+        Its footer is only written when it is closed, so until then the
+        shard is meta_<n>.parquet.tmp and every flush also appends its rows
+        to meta_<n>.parquet.journal and syncs it. The journal of a shard left
+        open by a killed run is written as a complete shard."""
+
+    flush_size = 10000
+    flush_interval = 60
+
+    def __init__(self, folder, compression=None, shard_size=100000):
+        if pyarrow is None:
+            raise ImportError('parquet output requires the pyarrow package')
+        self.folder = folder
+        self.compression = compression or 'none'
+        self.shard_size = shard_size
+        self.schema = pyarrow.schema([(field, pyarrow.string()) for field in METADATA_FIELDS])
+        self.rows = []
+        self.path = None
+        self.writer = None
+        self.journal = None
+        self.count = 0
+        self.recover()
+        self.shard = len([f for f in os.listdir(folder) if f.startswith('meta_') and f.endswith('.parquet')])
+
+    def recover(self):
+        """ Writes the journals of the shards of a killed run as complete shards"""
+        for name in os.listdir(self.folder):
+            if not (name.startswith('meta_') and name.endswith('.parquet.journal')):
+                continue
+            journal = os.path.join(self.folder, name)
+            path = journal[:-len('.journal')]
+            rows = []
+            with open(journal, 'r', encoding='utf-8') as f:
+                for line in f:
+                    # A line cut by the kill was never synced, its packages were not marked.
+                    if line.endswith('\n'):
+                        rows.append(json.loads(line))
+            if rows:
+                self._write_table(rows, path)
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            os.remove(journal)
+
+    def _write_table(self, rows, path):
+        # Written aside and renamed, so a crash never leaves a broken shard.
+        table = pyarrow.Table.from_pylist(rows, schema=self.schema)
+        pyarrow.parquet.write_table(table, path + '.tmp', compression=self.compression)
+        os.replace(path + '.tmp', path)
+
+    def _open(self):
+        self.path = os.path.join(self.folder, 'meta_{:05d}.parquet'.format(self.shard))
+        self.shard += 1
+        self.count = 0
+        self.writer = pyarrow.parquet.ParquetWriter(self.path + '.tmp', self.schema,
+                                                    compression=self.compression)
+        self.journal = open(self.path + '.journal', 'w', encoding='utf-8')
+
+    def write(self, data):
+        self.rows.append({field: value if value is None or isinstance(value, str)
+                          else json.dumps(value, ensure_ascii=False)
+                          for field, value in ((field, data.get(field)) for field in METADATA_FIELDS)})
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.writer is None:
+            self._open()
+        for row in self.rows:
+            self.journal.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.writer.write_table(pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+        self.count += len(self.rows)
+        self.rows = []
+        if self.count >= self.shard_size:
+            self._close_shard()
+
+    def _close_shard(self):
+        # The footer makes the shard complete, its journal is not needed any more.
+        self.writer.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.journal.close()
+        os.remove(self.path + '.journal')
+        self.writer = None
+        self.journal = None
+
+    def close(self):
+        self.flush()
+        if self.writer:
+            self._close_shard()
+
+
+class BackgroundWriter():
+    """ Writes metadata to a sink from its own thread, so crawler workers only
+        wait when the queue is full. The optional callback of each write runs
+        once the sink made the package durable: the sink is flushed every
+        flush_size packages or flush_interval seconds (attributes of the sink),
+        and when flush or close are called."""
+
+    def __init__(self, sink, queue_size=1000):
+        self.sink = sink
+        self.flush_size = getattr(sink, 'flush_size', 1)
+        self.flush_interval = getattr(sink, 'flush_interval', 0)
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Callbacks of the packages written since the last flush.
+        self.callbacks = []
+        self.unflushed = 0
+        self.first_write = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, data, callback=None):
+        self.queue.put((data, callback))
+
+    def flush(self):
+        """ Waits until the packages written before are durable and their callbacks ran"""
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        flushed.wait()
+
+    def _flush(self):
+        callbacks = self.callbacks
+        self.callbacks = []
+        self.unflushed = 0
+        self.first_write = None
+        try:
+            self.sink.flush()
+        except Exception as e:
+            # Their packages are not marked, so the next run crawls them again.
+            logger.error('Error flushing metadata, %i packages not saved', len(callbacks))
+            logger.error(e)
+            return
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(e)
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.unflushed:
+                timeout = max(0, self.first_write + self.flush_interval - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush()
+                continue
+            if item is None:
+                self._flush()
+                break
+            if isinstance(item, threading.Event):
+                self._flush()
+                item.set()
+                continue
+            data, callback = item
+            try:
+                self.sink.write(data)
+            except Exception as e:
+                logger.error('Error saving metadata %s', data.get('custom:id'))
+                logger.error(e)
+                continue
+            if callback:
+                self.callbacks.append(callback)
+            if not self.unflushed:
+                self.first_write = time.monotonic()
+            self.unflushed += 1
+            if self.unflushed >= self.flush_size:
+                self._flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.sink.close()
+
+
+def create_sink(folder, metadata_format='json', compression=None, fanout=False):
+    if metadata_format == 'jsonl':
+        return JsonLinesSink(folder, compression=compression)
+    if metadata_format == 'parquet':
+        return ParquetSink(folder, compression=compression)
+    return JsonFileSink(folder, fanout=fanout)
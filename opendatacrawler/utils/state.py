@@ -0,0 +1,300 @@
+import os
+import sqlite3
+import threading
+import time
+from opendatacrawler.utils import setup_logger
+
+logger = setup_logger.logger
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS packages (
+        id TEXT PRIMARY KEY,
+        run INTEGER,
+        status TEXT,
+        modified TEXT,
+        updated_at REAL,
+        error TEXT
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS resources (
+        id TEXT PRIMARY KEY,
+        package_id TEXT,
+        url TEXT,
+        status TEXT,
+        updated_at REAL,
+        bytes INTEGER,
+        byte_size TEXT,
+        etag TEXT,
+        last_modified TEXT,
+        path TEXT,
+        checksum TEXT,
+        error TEXT
+    ) WITHOUT ROWID""",
+    """CREATE INDEX IF NOT EXISTS resources_url ON resources (url)""",
+    # Reference counts of the content addressed store (see BlobStore).
+    """CREATE TABLE IF NOT EXISTS blobs (
+        checksum TEXT PRIMARY KEY,
+        size INTEGER,
+        refs INTEGER
+    ) WITHOUT ROWID""",
+    # Files saved on disk, for downstream jobs looking resources up by id. path
+    # is relative to the folder of the crawl and checksum is the sha256 of the file.
+    """CREATE VIEW IF NOT EXISTS manifest AS
+        SELECT id, package_id, path, bytes AS size, checksum FROM resources
+        WHERE status='done' AND path IS NOT NULL""",
+    # Packages listed in a run and not saved yet, replayed when resuming.
+    """CREATE TABLE IF NOT EXISTS queue (
+        id TEXT PRIMARY KEY,
+        run INTEGER
+    ) WITHOUT ROWID""",
+]
+
+PACKAGE_FIELDS = ['id', 'run', 'status', 'modified', 'updated_at', 'error']
+RESOURCE_FIELDS = ['id', 'package_id', 'url', 'status', 'updated_at', 'bytes',
+                   'byte_size', 'etag', 'last_modified', 'path', 'checksum', 'error']
+
+
+class CrawlState():
+    """ Crawl state of a portal stored in SQLite, keyed by package id and
+        resource id. Writes are buffered and committed in batches from a
+        background thread; lookups go through the primary key index, so
+        resuming does not need to read the whole state.
+
+        Every crawl is a numbered run. A package only counts as done if it
+        was saved in the current run, and finishing a run lets the next one
+        start from scratch without deleting anything."""
+
+    def __init__(self, path, batch_size=1000, flush_interval=2):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+
+        self.lock = threading.RLock()
+        self.pending_packages = {}
+        self.pending_resources = {}
+        self.pending_meta = {}
+        self.pending_queue = {}
+        self.pending_dequeue = set()
+        # Changes to the blob reference counts, checksum: [size, delta].
+        self.pending_blobs = {}
+        self.run = int(self.get_meta('run', 0))
+        self.run_started = float(self.get_meta('run_started', 0))
+
+        self.stop_event = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                              (key, str(value)))
+
+    def start_run(self, legacy_resume_path=None):
+        """ Start a new run unless the last one was interrupted.
+            Returns True when resuming an interrupted run."""
+        resuming = self.run > 0 and self.get_meta('run_complete') == '0'
+        if not resuming:
+            self.run += 1
+            self.set_meta('run', self.run)
+            self.set_meta('run_complete', 0)
+            self.set_meta('run_started', time.time())
+            with self.lock:
+                self.conn.execute('DELETE FROM queue WHERE run<?', (self.run,))
+
+        # Imports ids from the old resume_<domain>.txt file.
+        if legacy_resume_path and os.path.exists(legacy_resume_path):
+            with open(legacy_resume_path, 'r') as file:
+                for line in file:
+                    if line.strip():
+                        self.mark_package(line.strip(), 'done')
+            self.flush()
+            os.remove(legacy_resume_path)
+            resuming = True
+
+        self.run_started = float(self.get_meta('run_started', 0))
+        return resuming
+
+    def finish_run(self):
+        """ Closes the run. Its listing checkpoints are dropped, the next run lists from scratch"""
+        self.flush()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.execute("DELETE FROM meta WHERE key LIKE 'checkpoint:%'")
+                self.conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                      [('run_complete', '1'), ('last_complete_started', str(self.run_started))])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def last_complete_started(self):
+        """ Start time of the last run that finished, None before the first one.
+            Anything modified after it was not seen by that run."""
+        started = self.get_meta('last_complete_started')
+        return float(started) if started else None
+
+    def _pending_count(self):
+        return len(self.pending_packages) + len(self.pending_resources) + len(self.pending_queue) \
+            + len(self.pending_blobs)
+
+    def mark_package(self, id, status, modified=None, error=None):
+        with self.lock:
+            self.pending_packages[id] = (id, self.run, status, modified, time.time(), error)
+            if status == 'done':
+                self.pending_dequeue.add(id)
+            full = self._pending_count() >= self.batch_size
+        if full:
+            self.flush()
+
+    def enqueue(self, id):
+        """ Records a listed package until it is marked as done"""
+        with self.lock:
+            self.pending_queue[id] = (id, self.run)
+            self.pending_dequeue.discard(id)
+            full = self._pending_count() >= self.batch_size
+        if full:
+            self.flush()
+
+    def get_queued(self):
+        """ Ids listed in the current run that were not saved"""
+        self.flush()
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT id FROM queue WHERE run=?', (self.run,))]
+
+    def get_checkpoint(self, name):
+        """ Progress of a listing in the current run, see set_checkpoint"""
+        key = 'checkpoint:{}:{}'.format(self.run, name)
+        with self.lock:
+            if key in self.pending_meta:
+                return self.pending_meta[key]
+        return self.get_meta(key)
+
+    def set_checkpoint(self, name, value):
+        """ Saves the progress of a listing in the current run. It is written
+            in the same transaction as the packages queued before it, so a
+            checkpoint never gets ahead of the saved queue."""
+        with self.lock:
+            self.pending_meta['checkpoint:{}:{}'.format(self.run, name)] = str(value)
+
+    def mark_resource(self, id, package_id, url, status, bytes=None, byte_size=None, etag=None,
+                      last_modified=None, path=None, checksum=None, error=None):
+        with self.lock:
+            self.pending_resources[id] = (id, package_id, url, status, time.time(), bytes,
+                                          byte_size, etag, last_modified, path, checksum, error)
+            full = self._pending_count() >= self.batch_size
+        if full:
+            self.flush()
+
+    def is_done(self, id):
+        """ Checks if a package was saved in the current run"""
+        package = self.get_package(id)
+        return package is not None and package['run'] == self.run and package['status'] == 'done'
+
+    def get_package(self, id):
+        with self.lock:
+            row = self.pending_packages.get(id)
+            if row is None:
+                row = self.conn.execute('SELECT {} FROM packages WHERE id=?'.format(
+                    ','.join(PACKAGE_FIELDS)), (id,)).fetchone()
+        return dict(zip(PACKAGE_FIELDS, row)) if row else None
+
+    def get_resource(self, id):
+        with self.lock:
+            row = self.pending_resources.get(id)
+            if row is None:
+                row = self.conn.execute('SELECT {} FROM resources WHERE id=?'.format(
+                    ','.join(RESOURCE_FIELDS)), (id,)).fetchone()
+        return dict(zip(RESOURCE_FIELDS, row)) if row else None
+
+    def find_resource_by_url(self, url):
+        """ A resource with the given url downloaded in the current run, if any"""
+        with self.lock:
+            for row in self.pending_resources.values():
+                if row[2] == url and row[3] == 'done' and row[10]:
+                    return dict(zip(RESOURCE_FIELDS, row))
+            row = self.conn.execute('SELECT {} FROM resources WHERE url=? AND status=? AND checksum IS NOT NULL '
+                                    'AND updated_at>=? LIMIT 1'.format(','.join(RESOURCE_FIELDS)),
+                                    (url, 'done', self.run_started)).fetchone()
+        return dict(zip(RESOURCE_FIELDS, row)) if row else None
+
+    # Reference counts are buffered like the resources pointing to the blobs,
+    # so both are written in the same transaction.
+    def add_blob_ref(self, checksum, size):
+        with self.lock:
+            self.pending_blobs.setdefault(checksum, [size, 0])
+            self.pending_blobs[checksum][0] = size
+            self.pending_blobs[checksum][1] += 1
+
+    def release_blob(self, checksum):
+        """ Drops a reference to a blob and returns how many are left"""
+        with self.lock:
+            self.pending_blobs.setdefault(checksum, [None, 0])[1] -= 1
+            return self.get_blob_refs(checksum)
+
+    def get_blob_refs(self, checksum):
+        with self.lock:
+            row = self.conn.execute('SELECT refs FROM blobs WHERE checksum=?', (checksum,)).fetchone()
+            return (row[0] if row else 0) + self.pending_blobs.get(checksum, [None, 0])[1]
+
+    def flush(self):
+        """ Writes every buffered change in a single transaction"""
+        with self.lock:
+            if not (self.pending_packages or self.pending_resources or self.pending_meta
+                    or self.pending_queue or self.pending_dequeue or self.pending_blobs):
+                return
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT OR REPLACE INTO packages VALUES (?,?,?,?,?,?)',
+                                      self.pending_packages.values())
+                self.conn.executemany('INSERT OR REPLACE INTO resources VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+                                      self.pending_resources.values())
+                self.conn.executemany('INSERT OR REPLACE INTO queue VALUES (?,?)',
+                                      self.pending_queue.values())
+                self.conn.executemany('DELETE FROM queue WHERE id=?',
+                                      [(id,) for id in self.pending_dequeue])
+                self.conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                      self.pending_meta.items())
+                self.conn.executemany('INSERT INTO blobs VALUES (?, ?, ?) ON CONFLICT(checksum) DO UPDATE '
+                                      'SET refs=refs+excluded.refs, size=COALESCE(excluded.size, size)',
+                                      [(checksum, size, delta) for checksum, (size, delta)
+                                       in self.pending_blobs.items()])
+                self.conn.executemany('DELETE FROM blobs WHERE checksum=? AND refs<=0',
+                                      [(checksum,) for checksum in self.pending_blobs])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.pending_packages = {}
+            self.pending_resources = {}
+            self.pending_meta = {}
+            self.pending_queue = {}
+            self.pending_dequeue = set()
+            self.pending_blobs = {}
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('Error saving crawl state')
+                logger.error(e)
+
+    def close(self):
+        self.stop_event.set()
+        self.flusher.join()
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,357 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from opendatacrawler.utils.ratelimit import RateLimiter
+from opendatacrawler.utils import metrics
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Server errors that usually go away, retried with backoff.
+RETRY_CODES = (500, 502, 504)
+
+# Connections of each client of an AsyncTransport.
+CLIENT_CONNECTIONS = 10
+
+
+def backoff(attempt, base=0.5, cap=30):
+    """ Seconds to wait before retry number attempt (from 0): exponential with jitter"""
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class Transport():
+    """ Shared HTTP layer used by every portal crawler. Connections are kept
+        alive in per-host pools sized to the number of workers, so metadata
+        records and files reuse connections instead of opening a new TCP+TLS
+        connection each time. HTTP/2 is used when requested and httpx (with
+        the h2 extra) is installed. Every request waits for the per-host rate
+        limiter. Throttled (429/503) requests are retried when the limiter
+        allows it, and lost connections and 500/502/504 errors with backoff.
+
+        hosts is the number of hosts whose pools are kept: beyond it the
+        least recently used pool is dropped with its connections, so it
+        should cover every portal and file server crawled at the same time."""
+
+    def __init__(self, workers=5, http2=False, timeout=60, limiter=None, retries=3, cache=None, hosts=32):
+        self.workers = workers
+        self.hosts = hosts
+        self.timeout = timeout
+        self.http2 = http2 and httpx is not None
+        self.limiter = limiter if limiter else RateLimiter()
+        self.retries = retries
+        # ResponseCache for API calls made with get, files are never cached.
+        self.cache = cache
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        # One pool per host, each holding as many connections as workers.
+        adapter = HTTPAdapter(pool_connections=self.hosts, pool_maxsize=max(self.workers, 10))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _new_httpx_client(self, verify):
+        limits = httpx.Limits(max_connections=None,
+                              max_keepalive_connections=max(self.workers, 10))
+        return httpx.Client(http2=True, verify=verify, limits=limits,
+                            timeout=self.timeout, follow_redirects=True)
+
+    def _client(self, verify):
+        # requests accepts verify per call, httpx needs a client per value.
+        key = verify if self.http2 else None
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._new_httpx_client(verify) if self.http2 else self._new_session()
+                    self._clients[key] = client
+        return client
+
+    def _send(self, method, url, params, headers, timeout, verify, stream):
+        client = self._client(verify)
+        if self.http2:
+            request = client.build_request(method, url, params=params, headers=headers, timeout=timeout)
+            return client.send(request, stream=stream)
+        return client.request(method, url, params=params, headers=headers, timeout=timeout, verify=verify,
+                              stream=stream, allow_redirects=True)
+
+    def _request(self, url, params, headers, timeout, verify, stream, method='GET'):
+        timeout = timeout or self.timeout
+        for attempt in range(self.retries + 1):
+            metrics.ratelimit_wait_seconds.observe(value=self.limiter.acquire(url))
+            try:
+                response = self._send(method, url, params, headers, timeout, verify, stream)
+            except Exception as e:
+                if not self.is_connection_error(e) or attempt == self.retries:
+                    raise
+                metrics.retries.inc('connection')
+                time.sleep(backoff(attempt))
+                continue
+            wait = self._retry_wait(url, response, attempt)
+            if wait is None:
+                return response
+            response.close()
+            time.sleep(wait)
+
+    # Counts a response and adapts the rate of its host to it. Returns None if the
+    # response is kept, or the seconds to wait before retrying the request.
+    def _retry_wait(self, url, response, attempt):
+        metrics.http_requests.inc(urlsplit(url).netloc, response.status_code)
+        throttled = self.limiter.update(url, response.status_code, response.headers)
+        failed = response.status_code in RETRY_CODES
+        if not (throttled or failed) or attempt == self.retries:
+            return None
+        if throttled:
+            # The limiter already holds the host back as long as needed.
+            metrics.retries.inc('throttled')
+            return 0
+        metrics.retries.inc('server_error')
+        return backoff(attempt)
+
+    @staticmethod
+    def is_connection_error(error):
+        """ Connection refused or reset, worth retrying. Timeouts are not, a
+            slow host would make every retry wait as long."""
+        if isinstance(error, requests.ConnectionError):
+            return not isinstance(error, requests.Timeout)
+        return httpx is not None and isinstance(error, httpx.NetworkError)
+
+    def get(self, url, params=None, headers=None, timeout=None, verify=True, cache=True):
+        """ GET a url through the shared pool and return the full response.
+            cache=False skips the response cache, for requests whose answer
+            depends on server-side state such as a scroll cursor."""
+        if not self.cache or not cache:
+            return self._request(url, params, headers, timeout, verify, stream=False)
+        key, entry, request_headers = self._lookup(self.cache, url, params, headers)
+        if entry and self.cache.is_fresh(entry):
+            metrics.cache.inc('hit')
+            return entry.response()
+        response = self._request(url, params, request_headers, timeout, verify, stream=False)
+        return self._keep(self.cache, key, entry, response)
+
+    # Looks a request up in the cache. Returns its key, the cached entry if any and
+    # the headers to request it with: stale entries are revalidated with their validators.
+    @staticmethod
+    def _lookup(cache, url, params, headers):
+        key = cache.key(url, params, headers)
+        entry = cache.get(key)
+        request_headers = dict(headers or {})
+        if entry:
+            if entry.headers.get('ETag'):
+                request_headers['If-None-Match'] = entry.headers['ETag']
+            if entry.headers.get('Last-Modified'):
+                request_headers['If-Modified-Since'] = entry.headers['Last-Modified']
+        return key, entry, request_headers
+
+    # Caches the response to a request looked up in the cache and returns the response to use.
+    @staticmethod
+    def _keep(cache, key, entry, response):
+        if entry and response.status_code == 304:
+            metrics.cache.inc('revalidated')
+            cache.refresh(key, entry)
+            return entry.response()
+
+        metrics.cache.inc('miss')
+        if response.status_code == 200 and 'no-store' not in response.headers.get('Cache-Control', ''):
+            cache.put(key, str(response.url), response.headers, response.content)
+        return response
+
+    def head(self, url, headers=None, timeout=None, verify=True):
+        """ HEAD a url, following redirects, to learn about a file before downloading it"""
+        return self._request(url, None, headers, timeout, verify, stream=False, method='HEAD')
+
+    @contextmanager
+    def stream(self, url, headers=None, timeout=None, verify=True):
+        """ GET a url without reading the body, to be consumed with iter_content"""
+        response = self._request(url, None, headers, timeout, verify, stream=True)
+        try:
+            yield response
+        finally:
+            response.close()
+
+    @staticmethod
+    def iter_content(response, chunk_size):
+        if hasattr(response, 'iter_content'):
+            return response.iter_content(chunk_size=chunk_size)
+        return response.iter_bytes(chunk_size=chunk_size)
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+
+class AsyncTransport():
+    """ Non-blocking counterpart of a Transport, on httpx.AsyncClient. Requests
+        wait on the event loop (for the rate limiter, the network and the
+        backoff) instead of holding a thread, so one thread keeps up to
+        connections of them in flight. The rate limiter, response cache,
+        retries and timeout are those of the given transport, so blocking and
+        non-blocking requests share the limits of each host.
+
+        The connections are split between clients of CLIENT_CONNECTIONS each:
+        the pool of a client scans all its connections for each idle one
+        whenever a request starts or ends, which costs more CPU than the
+        requests themselves once a pool holds hundreds of connections."""
+
+    def __init__(self, transport, connections=100):
+        if httpx is None:
+            raise ImportError('httpx is required for non-blocking requests: pip install httpx')
+        self.transport = transport
+        self.limiter = transport.limiter
+        self.cache = transport.cache
+        self.retries = transport.retries
+        self.timeout = transport.timeout
+        self.connections = connections
+        # Requests wait here rather than in the clients, which would scan their queue too.
+        self._slots = asyncio.Semaphore(connections)
+        # Clients by verify value, as [client, requests in flight], created when needed.
+        self._clients = {}
+        self._contexts = {}
+        # Client of each streamed response not closed yet.
+        self._streams = {}
+
+    # First client for verify with room for a request, so the connections of the first
+    # ones stay warm and more clients are only created at the peaks of requests.
+    def _client(self, verify):
+        # Clients only live on the loop thread, no lock needed.
+        clients = self._clients.setdefault(verify, [])
+        client = next((client for client in clients if client[1] < CLIENT_CONNECTIONS), None)
+        if client is None:
+            # Loading the CA certificates is slow, every client of a verify value shares them.
+            if verify not in self._contexts:
+                self._contexts[verify] = httpx.create_ssl_context(verify=verify)
+            context = self._contexts[verify]
+            limits = httpx.Limits(max_connections=CLIENT_CONNECTIONS,
+                                  max_keepalive_connections=CLIENT_CONNECTIONS)
+            client = [httpx.AsyncClient(http2=self.transport.http2, verify=context, limits=limits,
+                                        timeout=self.timeout, follow_redirects=True), 0]
+            clients.append(client)
+        client[1] += 1
+        return client
+
+    def _release(self, client):
+        client[1] -= 1
+        self._slots.release()
+
+    async def _acquire(self, url):
+        waited = 0
+        while True:
+            wait = self.limiter.try_acquire(url)
+            if wait is None:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    async def _request(self, url, params, headers, timeout, verify, stream, method='GET'):
+        timeout = timeout or self.timeout
+        for attempt in range(self.retries + 1):
+            metrics.ratelimit_wait_seconds.observe(value=await self._acquire(url))
+            await self._slots.acquire()
+            client = self._client(verify)
+            try:
+                request = client[0].build_request(method, url, params=params, headers=headers, timeout=timeout)
+                response = await client[0].send(request, stream=stream)
+            except BaseException as e:
+                self._release(client)
+                if not Transport.is_connection_error(e) or attempt == self.retries:
+                    raise
+                metrics.retries.inc('connection')
+                await asyncio.sleep(backoff(attempt))
+                continue
+            wait = self.transport._retry_wait(url, response, attempt)
+            if wait is None:
+                if stream:
+                    # The connection is busy until the body is read, stream releases it.
+                    self._streams[response] = client
+                else:
+                    self._release(client)
+                return response
+            await response.aclose()
+            self._release(client)
+            await asyncio.sleep(wait)
+
+    async def get(self, url, params=None, headers=None, timeout=None, verify=True, cache=True):
+        """ GET a url and return the full response, through the response cache
+            unless cache=False, like Transport.get"""
+        if not self.cache or not cache:
+            return await self._request(url, params, headers, timeout, verify, stream=False)
+        key, entry, request_headers = Transport._lookup(self.cache, url, params, headers)
+        if entry and self.cache.is_fresh(entry):
+            metrics.cache.inc('hit')
+            return entry.response()
+        response = await self._request(url, params, request_headers, timeout, verify, stream=False)
+        return Transport._keep(self.cache, key, entry, response)
+
+    async def head(self, url, headers=None, timeout=None, verify=True):
+        """ HEAD a url, following redirects, to learn about a file before downloading it"""
+        return await self._request(url, None, headers, timeout, verify, stream=False, method='HEAD')
+
+    @asynccontextmanager
+    async def stream(self, url, headers=None, timeout=None, verify=True):
+        """ GET a url without reading the body, to be consumed with aiter_bytes"""
+        response = await self._request(url, None, headers, timeout, verify, stream=True)
+        try:
+            yield response
+        finally:
+            try:
+                await response.aclose()
+            finally:
+                self._release(self._streams.pop(response))
+
+    async def aclose(self):
+        for clients in self._clients.values():
+            for client, _ in clients:
+                await client.aclose()
+        self._clients = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+class HostLimiter():
+    """ Counts the downloads running against each host, so a package with
+        hundreds of files on one server does not take the whole download
+        pool. Slots are taken without blocking: the download pool moves on
+        to another file when the host of one is full."""
+
+    def __init__(self, per_host=8):
+        self.per_host = per_host
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, url, count=1):
+        """ Takes up to count slots of the host of url. Returns how many were taken"""
+        if not self.per_host:
+            return count
+        host = urlsplit(url).netloc
+        with self._lock:
+            taken = max(0, min(count, self.per_host - self._running.get(host, 0)))
+            if taken:
+                self._running[host] = self._running.get(host, 0) + taken
+        return taken
+
+    def release(self, url, count=1):
+        if not self.per_host or not count:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            running = self._running.get(host, 0) - count
+            if running > 0:
+                self._running[host] = running
+            else:
+                self._running.pop(host, None)
@@ -1,9 +1,12 @@
 import os
-import configparser
-import pathlib
+import json
 import hashlib
 from url_normalize import url_normalize
-from w3lib.url import url_query_cleaner
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 def check_url(url):
     """ Check if exist a well-formed url"""
@@ -29,15 +32,9 @@ def create_folder(path):
 def clean_url(u):
     """Clean a url string to obtain the mainly domain without protocols."""
 
+    # The query string is dropped with the path below, url_normalize always
+    # puts a / before it.
     u = url_normalize(u)
-    parameters = ['utm_source',
-                  'utm_medium',
-                  'utm_campaign',
-                  'utm_term',
-                  'utm_content']
-
-    u = url_query_cleaner(u, parameterlist=parameters,
-                          remove=True)
 
     if u.startswith("http://"):
         u = u[7:]
@@ -50,11 +47,20 @@ def clean_url(u):
     return u.split('/')[0]
 
 
+def loads(content):
+    """ Parses a json document (bytes or str), with orjson when installed"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
 def get_token(domain):
+    import configparser
+    import pathlib
     config = configparser.ConfigParser()
     current_path = pathlib.Path(__file__).parent.resolve()
     config.read(str(current_path) + '/config.ini')
-    return config.get(domain,'token')
+    return config.get(domain, 'token', fallback=None)
 
 # to do: faltar implementar que sucede cuando la id es None 
 def generate_hash(string, id):
@@ -66,17 +72,11 @@ def generate_hash(string, id):
     return id_hash
 
 
-def save_temporal_ids(path, ids):
-    with open(path, "a") as file:
-        for id in ids:
-            file.write("{}\n".format(id))
-
-
-def get_difference(new_ids, last_ids):
-    new_ids_set = set(new_ids)
-    last_ids_set = set(last_ids)
+def fanout_path(folder, name, key):
+    """ Path of a file inside two levels of subfolders taken from a hash key,
+        e.g. <folder>/ab/cd/<name>, keeping directories small."""
+    return os.path.join(folder, key[:2], key[2:4], name)
 
-    return list(new_ids_set-last_ids_set)
 
 def delete_interrupted_files(path):
     try:
@@ -0,0 +1,133 @@
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS tasks (
+        id TEXT PRIMARY KEY,
+        item TEXT,
+        status TEXT,
+        owner TEXT,
+        lease_expires REAL,
+        attempts INTEGER
+    ) WITHOUT ROWID""",
+    """CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires)""",
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    ) WITHOUT ROWID""",
+]
+
+
+class WorkQueue():
+    """ Durable queue of packages shared by the coordinator and the workers of
+        a distributed crawl, stored in a SQLite file on a shared filesystem.
+
+        Workers lease batches of packages for lease_time seconds and ack them
+        once saved. A lease that expires (a dead or stuck worker) makes its
+        packages available again, up to max_attempts times. The rollback
+        journal is used instead of WAL, which needs memory shared between
+        the processes and does not work over NFS."""
+
+    def __init__(self, path, lease_time=300, max_attempts=5):
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.lock = threading.Lock()
+
+    def _transaction(self, operation):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = operation()
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return result
+
+    def put(self, items):
+        """ Adds (id, item) pairs to the queue, ignoring ids already there.
+            Items are ids or packages, stored as json."""
+        rows = [(id, json.dumps(item), 'ready', None, 0, 0) for id, item in items]
+        self._transaction(lambda: self.conn.executemany(
+            'INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, ?, ?)', rows))
+
+    def lease(self, owner, batch_size=50):
+        """ Leases up to batch_size ready or expired packages to owner. Returns (id, item) pairs"""
+        def operation():
+            now = time.time()
+            # Expired leases that used all their attempts are given up.
+            self.conn.execute("UPDATE tasks SET status='failed', owner=NULL WHERE status='leased' "
+                              "AND lease_expires<? AND attempts>=?", (now, self.max_attempts))
+            rows = self.conn.execute("SELECT id, item FROM tasks WHERE status='ready' "
+                                     "OR (status='leased' AND lease_expires<?) LIMIT ?",
+                                     (now, batch_size)).fetchall()
+            self.conn.executemany("UPDATE tasks SET status='leased', owner=?, lease_expires=?, "
+                                  "attempts=attempts+1 WHERE id=?",
+                                  [(owner, now + self.lease_time, row[0]) for row in rows])
+            return [(row[0], json.loads(row[1])) for row in rows]
+        return self._transaction(operation)
+
+    def extend(self, owner, ids):
+        """ Renews the leases of owner on ids"""
+        expires = time.time() + self.lease_time
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE tasks SET lease_expires=? WHERE id=? AND owner=? AND status='leased'",
+            [(expires, id, owner) for id in ids]))
+
+    def ack(self, owner, ids):
+        """ Marks packages leased by owner as done. Packages whose lease was
+            lost to another worker are left to it."""
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE tasks SET status='done', owner=NULL WHERE id=? AND owner=? AND status='leased'",
+            [(id, owner) for id in ids]))
+
+    def fail(self, owner, ids):
+        """ Gives packages that could not be crawled back to the queue to be
+            tried again, or gives them up once they used all their attempts"""
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE tasks SET status=CASE WHEN attempts>=? THEN 'failed' ELSE 'ready' END, owner=NULL "
+            "WHERE id=? AND owner=? AND status='leased'", [(self.max_attempts, id, owner) for id in ids]))
+
+    def release(self, owner, ids):
+        """ Gives leased packages back to the queue, e.g. when a worker stops"""
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE tasks SET status='ready', owner=NULL, attempts=attempts-1 "
+            "WHERE id=? AND owner=? AND status='leased'", [(id, owner) for id in ids]))
+
+    def set_listed(self, listed=True):
+        """ Records whether the coordinator finished listing the packages"""
+        self._transaction(lambda: self.conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('listed', '1' if listed else '0')))
+
+    def is_listed(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key='listed'").fetchone()
+        return row is not None and row[0] == '1'
+
+    def reset(self):
+        """ Empties the queue to start a new crawl"""
+        def operation():
+            self.conn.execute('DELETE FROM tasks')
+            self.conn.execute('DELETE FROM meta')
+        self._transaction(operation)
+
+    def counts(self):
+        """ Number of packages by status"""
+        with self.lock:
+            return dict(self.conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall())
+
+    def is_finished(self):
+        """ True when every listed package was done or given up"""
+        counts = self.counts()
+        return self.is_listed() and not counts.get('ready') and not counts.get('leased')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
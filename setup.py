@@ -25,5 +25,11 @@ setup(
         'tqdm>=4.63.0',
         'url-normalize>=1.4.3',
         'urllib3>=1.2.1',
-        'w3lib>=1.2.2']
+        'w3lib>=1.2.2'],
+    entry_points={
+        'opendatacrawler.portals': [
+            'Zenodo = opendatacrawler.portals.ZenodoCrawler:ZenodoCrawler',
+            'DataEuropa = opendatacrawler.portals.DataEuropaCrawler:DataEuropaCrawler'
+        ]
+    }
 )
\ No newline at end of file
@@ -0,0 +1,90 @@
+import threading
+import time
+from opendatacrawler.batch import BatchCrawler, read_domains
+
+
+class FakeCrawler():
+    """ Portal with count packages, recording how many are crawled at the same time"""
+
+    def __init__(self, domain, count, running, peaks, lock, delay=0.01):
+        self.domain = domain
+        self.dms = 'Fake' if count is not None else None
+        self.count = count
+        self.running = running
+        self.peaks = peaks
+        self.lock = lock
+        self.delay = delay
+
+    def get_package_list(self):
+        for i in range(self.count):
+            yield '{}-{}'.format(self.domain, i)
+
+    def process_package(self, id):
+        with self.lock:
+            self.running[self.domain] = self.running.get(self.domain, 0) + 1
+            self.peaks[self.domain] = max(self.peaks.get(self.domain, 0), self.running[self.domain])
+            self.peaks['all'] = max(self.peaks.get('all', 0), sum(self.running.values()))
+        time.sleep(self.delay)
+        with self.lock:
+            self.running[self.domain] -= 1
+
+
+def factory(sizes, peaks):
+    running = {}
+    lock = threading.Lock()
+    return lambda domain: FakeCrawler(domain, sizes[domain], running, peaks, lock)
+
+
+def test_portals_are_capped_and_share_the_threads():
+    sizes = {'big': 100, 'small': 5, 'medium': 20}
+    peaks = {}
+    finished = []
+    batch = BatchCrawler(list(sizes), factory(sizes, peaks), concurrency=6, per_portal=3,
+                         finish=lambda portal: finished.append(portal.domain))
+    totals = batch.run()
+
+    assert totals == sizes
+    assert max(peaks[domain] for domain in sizes) <= 3
+    assert peaks['all'] <= 6
+    # The small portals are done while the big one still runs.
+    assert finished[-1] == 'big'
+
+
+def test_parallel_portals_are_limited():
+    sizes = {'a': 10, 'b': 10, 'c': 10}
+    peaks = {}
+    started = []
+    create = factory(sizes, peaks)
+    batch = BatchCrawler(list(sizes), lambda domain: started.append(domain) or create(domain),
+                         concurrency=10, per_portal=5, parallel_portals=2)
+    assert batch.run() == sizes
+    assert peaks['all'] <= 10
+    assert started == ['a', 'b', 'c']
+
+
+def test_undetected_portals_finish_empty():
+    sizes = {'unknown': None, 'known': 3}
+    batch = BatchCrawler(list(sizes), factory(sizes, {}), concurrency=2)
+    assert batch.run() == {'unknown': 0, 'known': 3}
+
+
+def test_batch_file(tmp_path):
+    path = tmp_path / 'domains.txt'
+    path.write_text('https://a.test\n\n# comment\nhttps://b.test  # second\nhttps://a.test\n')
+    assert read_domains(str(path)) == ['https://a.test', 'https://b.test']
+
+
+def test_failed_packages_are_counted():
+    sizes = {'a': 10}
+    crawler = factory(sizes, {})('a')
+    crawl = crawler.process_package
+
+    def process_package(id):
+        if id.endswith('3'):
+            raise ValueError('broken package')
+        crawl(id)
+    crawler.process_package = process_package
+    finished = []
+    batch = BatchCrawler(['a'], lambda domain: crawler, concurrency=2, finish=finished.append)
+    assert batch.run() == {'a': 10}
+    assert finished[0].failed == 1
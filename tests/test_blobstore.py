@@ -0,0 +1,69 @@
+import hashlib
+import os
+import pytest
+from opendatacrawler.utils.blobstore import BlobStore
+from opendatacrawler.utils.state import CrawlState
+
+
+def write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return hashlib.sha256(content).hexdigest()
+
+
+@pytest.fixture
+def data(tmp_path):
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    return folder
+
+
+@pytest.fixture
+def blobs(tmp_path):
+    state = CrawlState(str(tmp_path / 'state.sqlite'), flush_interval=3600)
+    state.start_run()
+    yield BlobStore(str(tmp_path / 'blobs'), state)
+    state.close()
+
+
+def test_identical_files_are_stored_once(blobs, data):
+    checksum = write(str(data / 'a.part'), b'same content')
+    blobs.store(str(data / 'a.part'), checksum, str(data / 'a.csv'))
+    write(str(data / 'b.part'), b'same content')
+    blobs.store(str(data / 'b.part'), checksum, str(data / 'b.csv'))
+
+    blob = blobs.blob_path(checksum)
+    assert os.path.samefile(blob, str(data / 'a.csv'))
+    assert os.path.samefile(blob, str(data / 'b.csv'))
+    assert os.stat(blob).st_nlink == 3
+    assert sorted(os.listdir(str(data))) == ['a.csv', 'b.csv']
+    assert (data / 'b.csv').read_bytes() == b'same content'
+
+
+def test_blob_is_removed_with_its_last_reference(blobs, data):
+    checksum = write(str(data / 'a.part'), b'content')
+    blobs.store(str(data / 'a.part'), checksum, str(data / 'a.csv'))
+    assert blobs.link(checksum, str(data / 'b.csv'))
+
+    blobs.release(checksum)
+    assert os.path.exists(blobs.blob_path(checksum))
+    blobs.release(checksum)
+    assert not os.path.exists(blobs.blob_path(checksum))
+    # The data files keep their content through their own links.
+    assert (data / 'b.csv').read_bytes() == b'content'
+
+
+def test_new_content_releases_the_replaced_blob(blobs, data):
+    old = write(str(data / 'a.part'), b'version 1')
+    blobs.store(str(data / 'a.part'), old, str(data / 'a.csv'))
+    new = write(str(data / 'a.part'), b'version 2')
+    blobs.store(str(data / 'a.part'), new, str(data / 'a.csv'), replaces=old)
+
+    assert not os.path.exists(blobs.blob_path(old))
+    assert os.path.samefile(blobs.blob_path(new), str(data / 'a.csv'))
+    assert (data / 'a.csv').read_bytes() == b'version 2'
+
+
+def test_missing_blobs_are_not_linked(blobs, data):
+    assert blobs.link('0' * 64, str(data / 'a.csv')) is False
+    assert not (data / 'a.csv').exists()
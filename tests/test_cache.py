@@ -0,0 +1,85 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from opendatacrawler.utils.cache import ResponseCache
+from opendatacrawler.utils.transport import Transport
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """ Answers json with an ETag, 304 when the client already has it"""
+    requests = []
+    CACHE_CONTROL = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        ApiHandler.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = b'{"path": "' + self.path.encode() + b'"}'
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        if ApiHandler.CACHE_CONTROL:
+            self.send_header('Cache-Control', ApiHandler.CACHE_CONTROL)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def api():
+    ApiHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/api'.format(server.server_address[1])
+    server.shutdown()
+    ApiHandler.CACHE_CONTROL = None
+
+
+def test_fresh_entries_are_served_without_a_request(tmp_path, api):
+    transport = Transport(cache=ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=3600))
+    assert transport.get(api, params={'page': 1}).json() == {'path': '/api?page=1'}
+    assert transport.get(api, params={'page': 1}).json() == {'path': '/api?page=1'}
+    assert transport.get(api, params={'page': 2}).status_code == 200
+    assert [path for path, _ in ApiHandler.requests] == ['/api?page=1', '/api?page=2']
+
+
+def test_entries_are_kept_across_runs(tmp_path, api):
+    Transport(cache=ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=3600)).get(api).close()
+    transport = Transport(cache=ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=3600))
+    assert transport.get(api).json() == {'path': '/api'}
+    assert len(ApiHandler.requests) == 1
+
+
+def test_stale_entries_are_revalidated(tmp_path, api):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=0)
+    transport = Transport(cache=cache)
+    transport.get(api)
+    response = transport.get(api)
+    assert response.status_code == 200
+    assert response.json() == {'path': '/api'}
+    assert ApiHandler.requests == [('/api', None), ('/api', '"v1"')]
+    assert cache.get(cache.key(api)) is not None
+
+
+def test_no_store_responses_are_not_cached(tmp_path, api):
+    ApiHandler.CACHE_CONTROL = 'no-store'
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=3600)
+    transport = Transport(cache=cache)
+    transport.get(api)
+    transport.get(api)
+    assert len(ApiHandler.requests) == 2
+    assert cache.get(cache.key(api)) is None
+
+
+def test_requests_can_skip_the_cache(tmp_path, api):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=3600)
+    transport = Transport(cache=cache)
+    transport.get(api, params={'scroll': 'true'}, cache=False)
+    transport.get(api, params={'scroll': 'true'}, cache=False)
+    assert len(ApiHandler.requests) == 2
+    assert cache.get(cache.key(api, {'scroll': 'true'})) is None
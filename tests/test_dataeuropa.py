@@ -0,0 +1,181 @@
+import hashlib
+import json
+import re
+import pytest
+from opendatacrawler.portals import DataEuropaCrawler as dataeuropa
+from opendatacrawler.portals.DataEuropaCrawler import DataEuropaCrawler
+from opendatacrawler.portals.odcrawler import OpenDataCrawler
+
+
+class FakeResponse():
+    status_code = 200
+
+    def __init__(self, data):
+        self.content = json.dumps(data).encode('utf-8')
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+def dataset(i, format='csv'):
+    return {
+        'id': 'ds-{}'.format(i),
+        'title': {'en': 'Dataset {}'.format(i)},
+        'resource': 'http://data.europa.eu/88u/dataset/ds-{}'.format(i),
+        'distributions': [{
+            'id': 'res-{}'.format(i),
+            'format': {'id': format.upper()},
+            'download_url': ['http://files/ds-{}.{}'.format(i, format)]
+        }]
+    }
+
+
+class HubTransport():
+    """ Search API of the hub, answering scroll requests in pages of page_size"""
+
+    def __init__(self, datasets, page_size):
+        self.pages = [datasets[i:i + page_size] for i in range(0, len(datasets), page_size)]
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.requests.append((url.rsplit('/', 1)[-1], params, kwargs.get('cache', True)))
+        page = int(params['scrollId']) if 'scrollId' in params else 0
+        results = self.pages[page] if page < len(self.pages) else []
+        return FakeResponse({'result': {'count': sum(len(p) for p in self.pages),
+                                        'results': results, 'scrollId': str(page + 1)}})
+
+
+def test_bulk_harvest_follows_the_scroll():
+    datasets = [dataset(i) for i in range(25)]
+    transport = HubTransport(datasets, 10)
+    crawler = DataEuropaCrawler('DataEuropa', None, transport)
+    packages = list(crawler.get_packages(page_size=10))
+    assert [package['dct:identifier'] for package in packages] == ['ds-{}'.format(i) for i in range(25)]
+    assert packages[0]['dcat:distribution'][0]['dcat:downloadURL'] == 'http://files/ds-0.csv'
+    assert [name for name, _, _ in transport.requests] == ['search', 'scroll', 'scroll', 'scroll']
+    # Scroll ids expire on the server, their pages must never come from the cache.
+    assert not any(cache for _, _, cache in transport.requests)
+
+
+def test_bulk_harvest_filters_formats():
+    datasets = [dataset(i, 'csv' if i % 2 else 'pdf') for i in range(10)]
+    crawler = DataEuropaCrawler('DataEuropa', ['csv'], HubTransport(datasets, 4))
+    packages = list(crawler.get_packages(page_size=4))
+    assert [package['dct:identifier'] for package in packages] == ['ds-{}'.format(i) for i in range(1, 10, 2)]
+
+
+def test_hits_that_can_not_be_formatted_are_requested_by_id():
+    datasets = [dataset(i) for i in range(5)]
+    datasets[3]['distributions'] = 'broken'
+    crawler = DataEuropaCrawler('DataEuropa', ['csv'], HubTransport(datasets, 10))
+    items = list(crawler.get_packages(page_size=10))
+    assert [item if isinstance(item, str) else item['dct:identifier'] for item in items] == \
+        ['ds-{}'.format(i) for i in range(5)]
+    assert items[3] == 'ds-3'
+
+
+class UnreachableTransport():
+    def get(self, url, params=None, headers=None, **kwargs):
+        raise ConnectionError('unreachable')
+
+
+def test_failed_request_by_id_is_marked_as_an_error():
+    crawler = OpenDataCrawler.__new__(OpenDataCrawler)
+    crawler.dms_instance = DataEuropaCrawler('DataEuropa', None, UnreachableTransport())
+    marked = []
+    crawler.mark_package = lambda id, status, **kwargs: marked.append((id, status, kwargs))
+    assert crawler.get_package('ds-3') is None
+    assert marked == [('ds-3', 'error', {'error': 'Metadata not obtained'})]
+
+
+class SparqlTransport():
+    """ SPARQL endpoint listing dataset uris by the MD5 shard and keyset of the query"""
+
+    def __init__(self, count):
+        self.uris = sorted('http://data.europa.eu/88u/dataset/ds-{}'.format(i) for i in range(count))
+        self.queries = []
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        query = params['query']
+        self.queries.append(query)
+        if 'count(' in query:
+            return FakeResponse({'results': {'bindings': [{'total': {'value': str(len(self.uris))}}]}})
+        shard = re.search(r'MD5\(STR\(\?dataset\)\), "(\w+)"', query).group(1)
+        after = re.search(r'STR\(\?dataset\) > "([^"]*)"', query)
+        limit = int(re.search(r'LIMIT (\d+)', query).group(1))
+        uris = [uri for uri in self.uris if hashlib.md5(uri.encode()).hexdigest().startswith(shard)
+                and (not after or uri > after.group(1))]
+        if 'ORDER BY STR(?dataset)' not in query:
+            # Like some stores, IRIs are not ordered as their strings.
+            uris.sort(key=lambda uri: (len(uri), uri))
+        return FakeResponse({'results': {'bindings': [{'dataset': {'value': uri}} for uri in uris[:limit]]}})
+
+
+class Checkpoints():
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get_checkpoint(self, name):
+        return self.values.get(name)
+
+    def set_checkpoint(self, name, value):
+        self.values[name] = value
+
+
+def shard_of(uri):
+    return hashlib.md5(uri.encode()).hexdigest()[0]
+
+
+@pytest.fixture
+def small_pages(monkeypatch):
+    monkeypatch.setattr(DataEuropaCrawler, 'page_size', 3)
+
+
+def test_shards_list_every_dataset_once(small_pages):
+    transport = SparqlTransport(100)
+    checkpoints = Checkpoints()
+    crawler = DataEuropaCrawler('DataEuropa', None, transport, checkpoints=checkpoints)
+    ids = list(crawler.get_package_list())
+    assert sorted(ids) == sorted(uri.rsplit('/', 1)[-1] for uri in transport.uris)
+    assert checkpoints.values == {'sparql:' + format(i, 'x'): 'done' for i in range(16)}
+
+
+def test_listing_resumes_from_the_checkpoints(small_pages):
+    transport = SparqlTransport(100)
+    shard = [uri for uri in transport.uris if shard_of(uri) == '1']
+    checkpoints = Checkpoints({'sparql:0': 'done', 'sparql:1': shard[2]})
+    crawler = DataEuropaCrawler('DataEuropa', None, transport, checkpoints=checkpoints)
+    ids = set(crawler.get_package_list())
+    expected = {uri.rsplit('/', 1)[-1] for uri in transport.uris if shard_of(uri) != '0'} \
+        - {uri.rsplit('/', 1)[-1] for uri in shard[:3]}
+    assert ids == expected
+
+
+def test_failed_shard_is_resumed_by_the_next_listing(small_pages, monkeypatch):
+    monkeypatch.setattr(dataeuropa, 'backoff', lambda attempt: 0)
+    transport = SparqlTransport(100)
+    failing = {'on': True}
+    get = transport.get
+
+    def flaky_get(url, params=None, headers=None, **kwargs):
+        # The second page of shard a keeps failing.
+        if failing['on'] and '"a")' in params['query'] and 'STR(?dataset) >' in params['query']:
+            raise ConnectionError('unreachable')
+        return get(url, params, headers)
+    transport.get = flaky_get
+    checkpoints = Checkpoints()
+    crawler = DataEuropaCrawler('DataEuropa', None, transport, checkpoints=checkpoints)
+    ids = []
+    with pytest.raises(ConnectionError):
+        for id in crawler.get_package_list():
+            ids.append(id)
+    shard = [uri for uri in transport.uris if shard_of(uri) == 'a']
+    assert checkpoints.values['sparql:a'] == shard[2]
+
+    failing['on'] = False
+    ids += list(crawler.get_package_list())
+    assert sorted(ids) == sorted(uri.rsplit('/', 1)[-1] for uri in transport.uris)
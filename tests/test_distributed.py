@@ -0,0 +1,43 @@
+from opendatacrawler.distributed import Worker
+from opendatacrawler.utils.state import CrawlState
+from opendatacrawler.utils.workqueue import WorkQueue
+
+
+class FakeCrawler():
+    def __init__(self, state):
+        self.state = state
+        self.flushed = 0
+
+    def flush(self):
+        self.flushed += 1
+        self.state.flush()
+
+
+class FakeEngine():
+    """ Saves every package but 'bad', whose metadata could not be obtained"""
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    def run(self, ids):
+        for id in ids:
+            self.crawler.state.mark_package(id, 'error' if id == 'bad' else 'done')
+
+    def expired(self):
+        return False
+
+
+def test_worker_acks_saved_packages_and_fails_the_others(tmp_path):
+    state = CrawlState(str(tmp_path / 'state.sqlite'))
+    state.start_run()
+    crawler = FakeCrawler(state)
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), max_attempts=2)
+    queue.put([('a', 'a'), ('b', 'b'), ('bad', 'bad')])
+    queue.set_listed()
+
+    total = Worker(crawler, queue, FakeEngine(crawler), poll_interval=0).run()
+    assert total == 2
+    assert crawler.flushed == 2
+    assert queue.counts() == {'done': 2, 'failed': 1}
+    queue.close()
+    state.close()
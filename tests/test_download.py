@@ -0,0 +1,266 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from opendatacrawler.portals.odcrawler import OpenDataCrawler
+from opendatacrawler.utils.download import DownloadPool, download_segments, downloaded_bytes, has_segments
+from opendatacrawler.utils.state import CrawlState
+from opendatacrawler.utils.transport import AsyncTransport, HostLimiter, Transport
+
+
+def test_small_packages_do_not_wait_behind_a_big_one():
+    pool = DownloadPool(workers=5, host_limiter=HostLimiter(8))
+    start = time.monotonic()
+    big = [pool.submit('big', 'http://a/{}'.format(i), time.sleep, 0.05) for i in range(100)]
+    time.sleep(0.1)
+    small = [pool.submit(lane, 'http://b/' + lane, time.monotonic) for lane in 'wxyz']
+    finished = [future.result() - start for future in small]
+    assert max(finished) < 0.3
+    assert not all(future.done() for future in big)
+    pool.shutdown(wait=True, cancel_futures=True)
+
+
+def test_groups_are_served_in_turn():
+    pool = DownloadPool(workers=1)
+    started = threading.Event()
+    blocker = threading.Event()
+    pool.submit('first', 'http://a/0', lambda: started.set() or blocker.wait(), group='a')
+    started.wait()
+    order = []
+    # Portal a has many packages waiting, portal b only one.
+    futures = [pool.submit(str(i), 'http://a/{}'.format(i), order.append, 'a', group='a') for i in range(5)]
+    futures.append(pool.submit('0', 'http://b/0', order.append, 'b', group='b'))
+    blocker.set()
+    for future in futures:
+        future.result()
+    assert order.index('b') <= 1
+    pool.shutdown()
+
+
+def test_hosts_are_limited_without_blocking_the_threads():
+    running = {}
+    peak = {}
+    lock = threading.Lock()
+
+    def fetch(host):
+        with lock:
+            running[host] = running.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), running[host])
+        time.sleep(0.05)
+        with lock:
+            running[host] -= 1
+        return time.monotonic()
+
+    pool = DownloadPool(workers=6, host_limiter=HostLimiter(2))
+    start = time.monotonic()
+    slow = [pool.submit('a', 'http://slow/{}'.format(i), fetch, 'slow') for i in range(10)]
+    fast = [pool.submit('a', 'http://fast/{}'.format(i), fetch, 'fast') for i in range(2)]
+    assert max(future.result() for future in fast) - start < 0.2
+    for future in slow:
+        future.result()
+    assert peak == {'slow': 2, 'fast': 2}
+    pool.shutdown()
+
+
+def test_errors_and_cancelled_downloads():
+    pool = DownloadPool(workers=1)
+    failed = pool.submit('a', 'http://a/1', lambda: 1 / 0)
+    try:
+        failed.result()
+        assert False
+    except ZeroDivisionError:
+        pass
+    started = threading.Event()
+    blocker = threading.Event()
+    running = pool.submit('a', 'http://a/2', lambda: started.set() or blocker.wait())
+    waiting = pool.submit('a', 'http://a/3', time.monotonic)
+    started.wait()
+    pool.shutdown(wait=False, cancel_futures=True)
+    blocker.set()
+    assert running.result() is True
+    assert waiting.cancelled()
+
+
+def test_host_limiter_slots():
+    limiter = HostLimiter(3)
+    assert limiter.try_acquire('http://a/1', 2) == 2
+    assert limiter.try_acquire('http://a/2', 2) == 1
+    assert limiter.try_acquire('http://a/3') == 0
+    assert limiter.try_acquire('http://b/1') == 1
+    limiter.release('http://a/1', 3)
+    assert limiter.try_acquire('http://a/3') == 1
+    assert HostLimiter(0).try_acquire('http://a/1', 5) == 5
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """ Serves BODY with Range and If-Range support, slowly when DELAY is set"""
+    BODY = bytes(range(256)) * 4096
+    ETAG = '"v1"'
+    DELAY = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = FileHandler.BODY
+        start, end = 0, len(body) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        partial = match and (not if_range or if_range == FileHandler.ETAG)
+        if partial:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('ETag', FileHandler.ETAG)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(body)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send_response(206 if partial else 200)
+        self.send_header('ETag', FileHandler.ETAG)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        for i in range(start, end + 1, 16384):
+            self.wfile.write(body[i:min(i + 16384, end + 1)])
+            time.sleep(FileHandler.DELAY)
+
+
+@pytest.fixture
+def file_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/file'.format(server.server_address[1])
+    server.shutdown()
+    FileHandler.DELAY = 0
+    FileHandler.ETAG = '"v1"'
+
+
+def test_segments_resume_after_the_time_limit(tmp_path, file_server):
+    path = str(tmp_path / 'file.part')
+    size = len(FileHandler.BODY)
+    FileHandler.DELAY = 0.02
+    assert not download_segments(Transport(), file_server, path, size, 4, max_sec=0.2, validator='"v1"')
+    assert has_segments(path)
+    done = downloaded_bytes(path)
+    assert 0 < done < size
+
+    FileHandler.DELAY = 0
+    received = []
+    assert download_segments(Transport(), file_server, path, size, 4, validator='"v1"', callback=received.append)
+    assert received[0] == done and sum(received) == size
+    assert not has_segments(path)
+    with open(path, 'rb') as f:
+        assert f.read() == FileHandler.BODY
+
+
+def test_segments_of_another_version_start_again(tmp_path, file_server):
+    path = str(tmp_path / 'file.part')
+    size = len(FileHandler.BODY)
+    FileHandler.DELAY = 0.02
+    assert not download_segments(Transport(), file_server, path, size, 4, max_sec=0.2, validator='"v1"')
+    FileHandler.DELAY = 0
+    FileHandler.ETAG = '"v2"'
+    received = []
+    assert download_segments(Transport(), file_server, path, size, 4, validator='"v2"', callback=received.append)
+    assert sum(received) == size
+    with open(path, 'rb') as f:
+        assert f.read() == FileHandler.BODY
+
+
+@pytest.fixture
+def crawler(tmp_path):
+    crawler = OpenDataCrawler.__new__(OpenDataCrawler)
+    crawler.domain = 'http://127.0.0.1'
+    crawler.save_path = str(tmp_path)
+    os.makedirs(str(tmp_path / 'data'))
+    crawler.state = CrawlState(str(tmp_path / 'state.sqlite'))
+    crawler.state.start_run()
+    crawler.transport = Transport()
+    crawler.download_pool = DownloadPool(workers=2)
+    crawler.host_limiter = HostLimiter()
+    crawler.max_sec = None
+    crawler.retries = 3
+    crawler.max_size = None
+    crawler.segments = 1
+    crawler.formats = None
+    crawler.blobs = None
+    crawler.layout = 'flat'
+    crawler.incremental = False
+    crawler.scheduler = None
+    yield crawler
+    crawler.download_pool.shutdown()
+    crawler.state.close()
+
+
+def package(url):
+    return {'dct:identifier': 'p', 'dcat:distribution': [
+        {'dcat:downloadURL': url, 'custom:resource_id': 'r', 'dcat:mediaType': 'bin', 'dcat:byteSize': None}]}
+
+
+def test_files_over_the_time_limit_are_resumed_in_the_same_run(crawler, file_server):
+    FileHandler.DELAY = 0.01
+    crawler.max_sec = 0.15
+    updated, status = crawler.get_package_resources(package(file_server))
+    assert status == 'done'
+    with open(updated['dcat:distribution'][0]['custom:path'], 'rb') as f:
+        assert f.read() == FileHandler.BODY
+    assert crawler.state.get_resource('r')['status'] == 'done'
+
+
+def test_complete_part_answered_with_416_is_saved(crawler, file_server):
+    with open(crawler.get_data_path('r', 'part'), 'wb') as f:
+        f.write(FileHandler.BODY)
+    crawler.state.mark_resource('r', 'p', file_server, 'partial', etag='"v1"')
+    id, path, partial, validators = crawler.save_dataset(file_server, 'bin', 'r')
+    assert path == crawler.get_data_path('r', 'bin') and not partial
+    assert validators['etag'] == '"v1"' and validators['checksum']
+    with open(path, 'rb') as f:
+        assert f.read() == FileHandler.BODY
+    assert not os.path.exists(crawler.get_data_path('r', 'part'))
+
+
+def test_part_not_matching_the_server_starts_again(crawler, file_server):
+    with open(crawler.get_data_path('r', 'part'), 'wb') as f:
+        f.write(FileHandler.BODY + b'stale')
+    crawler.state.mark_resource('r', 'p', file_server, 'partial', etag='"v1"')
+    id, path, partial, validators = crawler.save_dataset(file_server, 'bin', 'r')
+    assert path == crawler.get_data_path('r', 'bin') and not partial
+    with open(path, 'rb') as f:
+        assert f.read() == FileHandler.BODY
+
+
+def run_async(crawler, method, *args):
+    async def run():
+        async with AsyncTransport(crawler.transport) as transport:
+            return await method(*args, transport)
+    return asyncio.run(run())
+
+
+def test_async_files_over_the_time_limit_are_resumed_in_the_same_run(crawler, file_server):
+    pytest.importorskip('httpx')
+    FileHandler.DELAY = 0.01
+    crawler.max_sec = 0.15
+    updated, status = run_async(crawler, crawler.aget_package_resources, package(file_server))
+    assert status == 'done'
+    resource = updated['dcat:distribution'][0]
+    with open(resource['custom:path'], 'rb') as f:
+        assert f.read() == FileHandler.BODY
+    state = crawler.state.get_resource('r')
+    assert state['status'] == 'done' and state['etag'] == '"v1"' and state['checksum']
+
+
+def test_async_complete_part_answered_with_416_is_saved(crawler, file_server):
+    pytest.importorskip('httpx')
+    with open(crawler.get_data_path('r', 'part'), 'wb') as f:
+        f.write(FileHandler.BODY)
+    crawler.state.mark_resource('r', 'p', file_server, 'partial', etag='"v1"')
+    id, path, partial, validators = run_async(crawler, crawler.asave_dataset, file_server, 'bin', 'r')
+    assert path == crawler.get_data_path('r', 'bin') and not partial
+    with open(path, 'rb') as f:
+        assert f.read() == FileHandler.BODY
@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+import pytest
+from opendatacrawler.engine import AsyncCrawlEngine, ThreadCrawlEngine
+from opendatacrawler.portals.crawler_interface_abc import OpenDataCrawlerInterface
+from opendatacrawler.utils.ratelimit import RateLimiter
+from opendatacrawler.utils.transport import AsyncTransport, Transport
+
+
+class FakeCrawler():
+    """ Crawls a package by sleeping, counting the packages in flight"""
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.running = 0
+        self.peak = 0
+        self.done = []
+        self.lock = threading.Lock()
+
+    def process_package(self, id):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.done.append(id)
+
+
+def test_every_package_is_crawled():
+    crawler = FakeCrawler()
+    finished = []
+    engine = ThreadCrawlEngine(crawler, concurrency=4, callback=lambda: finished.append(1))
+    engine.run(str(i) for i in range(50))
+    assert sorted(crawler.done) == sorted(str(i) for i in range(50))
+    assert engine.total == 50
+    assert len(finished) == 50
+
+
+def test_ids_are_pulled_as_packages_finish():
+    crawler = FakeCrawler(delay=0.02)
+    ahead = []
+
+    def ids():
+        for i in range(40):
+            # Ids listed and not crawled yet, never more than queue_size.
+            ahead.append(i - len(crawler.done))
+            yield i
+
+    ThreadCrawlEngine(crawler, concurrency=4, queue_size=8).run(ids())
+    assert len(crawler.done) == 40
+    assert max(ahead) <= 8
+    assert crawler.peak <= 4
+
+
+class AsyncFakeCrawler():
+    """ Crawls a package by awaiting, counting the packages in flight and the threads used"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.running = 0
+        self.peak = 0
+        self.done = []
+        self.threads = set()
+        self.transport = Transport()
+
+    async def aget_package(self, id, transport):
+        assert isinstance(transport, AsyncTransport)
+        return {'dct:identifier': id}
+
+    async def astore_package(self, package, transport):
+        self.threads.add(threading.get_ident())
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        self.done.append(package['dct:identifier'])
+
+    @staticmethod
+    def get_item_id(item):
+        return str(item)
+
+
+def test_async_packages_are_crawled_on_the_loop():
+    pytest.importorskip('httpx')
+    crawler = AsyncFakeCrawler()
+    finished = []
+    engine = AsyncCrawlEngine(crawler, concurrency=50, callback=lambda: finished.append(1))
+    start = time.monotonic()
+    engine.run(str(i) for i in range(200))
+    # 200 packages of 0.05 s, 50 at a time, without a thread each.
+    assert time.monotonic() - start < 2
+    assert sorted(crawler.done) == sorted(str(i) for i in range(200))
+    assert crawler.peak == 50 and len(crawler.threads) == 1
+    assert engine.total == 200 and len(finished) == 200
+
+
+class SyncPortal(OpenDataCrawlerInterface):
+    def get_package_list(self):
+        return []
+
+    def get_package(self, id):
+        return {'id': id, 'thread': threading.get_ident()}
+
+
+def test_portals_without_aget_package_run_in_a_thread():
+    package = asyncio.run(SyncPortal().aget_package('a', None))
+    assert package['id'] == 'a' and package['thread'] != threading.get_ident()
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """ Answers after DELAY seconds, throttling the first THROTTLED requests"""
+    DELAY = 0.2
+    THROTTLED = 0
+    requests = 0
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with SlowHandler.lock:
+            SlowHandler.requests += 1
+            SlowHandler.running += 1
+            SlowHandler.peak = max(SlowHandler.peak, SlowHandler.running)
+        try:
+            self.answer()
+        finally:
+            with SlowHandler.lock:
+                SlowHandler.running -= 1
+
+    def answer(self):
+        if SlowHandler.requests <= SlowHandler.THROTTLED:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        time.sleep(SlowHandler.DELAY)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+
+@pytest.fixture
+def slow_server():
+    pytest.importorskip('httpx')
+    SlowHandler.requests = SlowHandler.peak = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    server.shutdown()
+    SlowHandler.DELAY = 0.2
+    SlowHandler.THROTTLED = 0
+
+
+def test_async_requests_wait_together(slow_server):
+    async def crawl():
+        async with AsyncTransport(Transport(limiter=RateLimiter(rate=100))) as transport:
+            return await asyncio.gather(*[transport.get(slow_server + str(i)) for i in range(20)])
+
+    start = time.monotonic()
+    responses = asyncio.run(crawl())
+    # One after the other they would take 4 s.
+    assert time.monotonic() - start < 1.5
+    assert [response.content for response in responses] == [b'ok'] * 20
+
+
+def test_async_requests_in_flight_are_limited_to_the_connections(slow_server):
+    SlowHandler.DELAY = 0.05
+
+    async def crawl():
+        async with AsyncTransport(Transport(limiter=RateLimiter(rate=100)), connections=3) as transport:
+            for i in range(6):
+                async with transport.stream(slow_server + str(i)) as response:
+                    assert response.status_code == 200
+            return await asyncio.gather(*[transport.get(slow_server + str(i)) for i in range(12)])
+
+    assert len(asyncio.run(crawl())) == 12
+    assert SlowHandler.peak == 3
+
+
+def test_async_throttled_requests_are_retried(slow_server):
+    SlowHandler.THROTTLED = 1
+    SlowHandler.DELAY = 0
+    limiter = RateLimiter(rate=10)
+
+    async def crawl():
+        async with AsyncTransport(Transport(limiter=limiter)) as transport:
+            return await transport.get(slow_server)
+
+    assert asyncio.run(crawl()).status_code == 200
+    assert SlowHandler.requests == 2
+    # The limiter of the transport slowed the host down.
+    assert limiter._buckets[urlsplit(slow_server).netloc].rate < 10
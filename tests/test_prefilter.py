@@ -0,0 +1,82 @@
+import asyncio
+import pytest
+from opendatacrawler.portals.odcrawler import OpenDataCrawler
+from opendatacrawler.utils.transport import HostLimiter
+
+
+class FakeResponse():
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class HeadTransport():
+    """ Answers every HEAD request with the same response, recording the urls"""
+
+    def __init__(self, status_code=200, headers=None):
+        self.response = FakeResponse(status_code, headers or {})
+        self.urls = []
+
+    def head(self, url, timeout=None, verify=True):
+        self.urls.append(url)
+        return self.response
+
+
+class AsyncHeadTransport(HeadTransport):
+    async def head(self, url, timeout=None, verify=True):
+        return super().head(url, timeout, verify)
+
+
+def crawler(transport, max_size=None, formats=None):
+    crawler = OpenDataCrawler.__new__(OpenDataCrawler)
+    crawler.transport = transport
+    crawler.host_limiter = HostLimiter()
+    crawler.max_size = max_size
+    crawler.formats = formats
+    return crawler
+
+
+def resource(url='http://data.test/file.csv', format='csv', size=None):
+    return {'dcat:downloadURL': url, 'dcat:mediaType': format, 'dcat:byteSize': size}
+
+
+def test_declared_metadata_avoids_the_head_request():
+    transport = HeadTransport()
+    assert crawler(transport).prefilter(resource()) == ('csv', None)
+    assert crawler(transport).prefilter(resource(format='html')) == ('html', 'html')
+    assert crawler(transport, max_size=100).prefilter(resource(size='1000')) == ('csv', 'too_large')
+    assert crawler(transport, max_size=100).prefilter(resource(size=50)) == ('csv', None)
+    assert transport.urls == []
+
+
+@pytest.mark.parametrize('headers, result', [
+    ({'Content-Type': 'text/html; charset=utf-8'}, ('csv', 'html')),
+    ({'Content-Type': 'text/csv', 'Content-Length': '1000'}, ('csv', 'too_large')),
+    ({'Content-Type': 'text/csv', 'Content-Length': '10'}, ('csv', None)),
+])
+def test_head_decides_without_declared_size(headers, result):
+    transport = HeadTransport(headers=headers)
+    assert crawler(transport, max_size=100).prefilter(resource()) == result
+    assert transport.urls == ['http://data.test/file.csv']
+
+
+def test_unknown_formats_are_guessed():
+    transport = HeadTransport(headers={'Content-Type': 'application/json'})
+    assert crawler(transport).prefilter(resource('http://data.test/get?id=1', None)) == ('json', None)
+    assert crawler(transport, formats=['csv']).prefilter(resource('http://data.test/get?id=1', None)) \
+        == (None, 'format')
+    assert crawler(transport, formats=['csv']).prefilter(resource('http://data.test/a.CSV', None)) \
+        == ('csv', None)
+
+
+def test_failed_head_lets_the_get_decide():
+    transport = HeadTransport(status_code=405)
+    assert crawler(transport, max_size=100).prefilter(resource()) == ('csv', None)
+    assert crawler(transport, formats=['csv']).prefilter(resource(format=None)) == (None, None)
+
+
+def test_async_prefilter_makes_the_same_decisions():
+    transport = AsyncHeadTransport(headers={'Content-Type': 'text/csv', 'Content-Length': '1000'})
+    assert asyncio.run(crawler(None, max_size=100).aprefilter(resource(), transport)) == ('csv', 'too_large')
+    assert asyncio.run(crawler(None).aprefilter(resource(format='html'), transport)) == ('html', 'html')
+    assert transport.urls == ['http://data.test/file.csv']
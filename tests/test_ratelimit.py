@@ -0,0 +1,129 @@
+import time
+from opendatacrawler.utils.ratelimit import RateLimiter, SharedRateLimiter, parse_retry_after, parse_reset
+
+URL = 'http://host/api'
+
+
+def test_burst_is_not_delayed():
+    limiter = RateLimiter(rate=10, burst=5)
+    assert sum(limiter.acquire(URL) for _ in range(5)) == 0
+
+
+def test_requests_beyond_the_burst_wait_for_a_token():
+    limiter = RateLimiter(rate=20, burst=1)
+    limiter.acquire(URL)
+    start = time.monotonic()
+    assert limiter.acquire(URL) > 0
+    assert time.monotonic() - start >= 0.04
+
+
+def test_hosts_have_their_own_bucket():
+    limiter = RateLimiter(rate=1, burst=1)
+    assert limiter.acquire('http://a/x') == 0
+    assert limiter.acquire('http://b/x') == 0
+
+
+def test_rate_grows_on_success_and_halves_when_throttled():
+    limiter = RateLimiter(rate=10, increase=1, decrease=0.5)
+    assert limiter.update(URL, 200, {}) is False
+    assert limiter._buckets['host'].rate == 11
+    assert limiter.update(URL, 429, {}) is True
+    assert limiter._buckets['host'].rate == 5.5
+    assert limiter.update(URL, 503, {}) is True
+    assert limiter._buckets['host'].rate == 2.75
+
+
+def test_rate_stays_within_bounds():
+    limiter = RateLimiter(rate=1, min_rate=0.5, max_rate=1.5, increase=1)
+    limiter.update(URL, 200, {})
+    assert limiter._buckets['host'].rate == 1.5
+    for _ in range(5):
+        limiter.update(URL, 429, {})
+    assert limiter._buckets['host'].rate == 0.5
+
+
+def test_retry_after_blocks_the_host():
+    limiter = RateLimiter(rate=100)
+    limiter.update(URL, 429, {'Retry-After': '30'})
+    assert limiter._buckets['host'].blocked_until - time.monotonic() > 29
+
+
+def test_exhausted_quota_blocks_the_host():
+    limiter = RateLimiter(rate=100)
+    limiter.update(URL, 200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '60'})
+    assert limiter._buckets['host'].blocked_until - time.monotonic() > 59
+
+
+def test_remaining_quota_is_spread_over_the_window():
+    limiter = RateLimiter(rate=100)
+    limiter.update(URL, 200, {'X-RateLimit-Remaining': '30', 'X-RateLimit-Reset': '60'})
+    assert limiter._buckets['host'].rate == 0.5
+
+
+def test_parse_headers():
+    assert parse_retry_after('12') == 12
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('not a date') is None
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert parse_reset('60') == 60
+    assert 59 < parse_reset(str(int(time.time()) + 60)) <= 60
+    assert parse_reset('soon') is None
+
+
+def test_shared_buckets_are_respected_by_every_limiter(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    first = SharedRateLimiter(path, rate=1, burst=2)
+    second = SharedRateLimiter(path, rate=1, burst=2)
+    assert first.acquire(URL) == 0
+    assert second.acquire(URL) == 0
+    # Both tokens of the burst are taken, the next request waits for the shared bucket.
+    assert first._shared('host', first._take) > 0
+    first.close()
+    second.close()
+
+
+def test_shared_throttling_slows_down_every_limiter(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    first = SharedRateLimiter(path, rate=10)
+    second = SharedRateLimiter(path, rate=10)
+    first.acquire(URL)
+    assert second.update(URL, 429, {'Retry-After': '30'}) is True
+    wait = first._shared('host', first._take)
+    assert wait is not None and wait > 29
+    first.close()
+    second.close()
+
+
+def test_shared_tokens_are_leased_in_batches(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    first = SharedRateLimiter(path, rate=10, burst=10, lease_time=1)
+    second = SharedRateLimiter(path, rate=10, burst=10, lease_time=1)
+    assert first.acquire(URL) == 0
+    # The first request leased the whole burst, the rest is spent without the shared file.
+    assert first._leases['host'][0] == 9
+    assert second._shared('host', second._take) > 0
+    assert sum(first.acquire(URL) for _ in range(9)) == 0
+    first.close()
+    second.close()
+
+
+def test_shared_throttling_drops_the_lease(tmp_path):
+    first = SharedRateLimiter(str(tmp_path / 'queue.sqlite'), rate=10, burst=10)
+    first.acquire(URL)
+    assert first.update(URL, 429, {'Retry-After': '30'}) is True
+    assert 'host' not in first._leases
+    assert first._shared('host', first._take) > 29
+    first.close()
+
+
+def test_shared_successes_are_applied_with_the_next_lease(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    first = SharedRateLimiter(path, rate=10, burst=1, increase=1)
+    first.acquire(URL)
+    for _ in range(3):
+        assert first.update(URL, 200, {}) is False
+    assert first._shared('host', lambda bucket, now: bucket.rate) == 10
+    first.close()
+    second = SharedRateLimiter(path, rate=10)
+    assert second._shared('host', lambda bucket, now: bucket.rate) == 13
+    second.close()
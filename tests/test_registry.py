@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+from opendatacrawler.portals import registry
+
+
+class FakeResponse():
+    def __init__(self, data=None, status_code=200, content_type='application/json'):
+        self.content = json.dumps(data).encode('utf-8')
+        self.status_code = status_code
+        self.headers = {'Content-Type': content_type}
+
+
+class PortalTransport():
+    """ Answers the paths of a portal, after delay seconds, and 404 the rest"""
+
+    def __init__(self, paths, delay=0):
+        self.paths = paths
+        self.delay = delay
+        self.urls = []
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, headers=None, timeout=None, verify=True):
+        with self.lock:
+            self.urls.append(url)
+        time.sleep(self.delay)
+        for path, response in self.paths.items():
+            if url.endswith(path):
+                return response
+        return FakeResponse(status_code=404, content_type='text/html')
+
+
+def test_detect_zenodo():
+    transport = PortalTransport({'/api/records/': FakeResponse({'hits': {'hits': [], 'total': 0}})})
+    assert registry.detect(transport, 'https://zenodo.test') == 'Zenodo'
+
+
+def test_detect_data_europa():
+    transport = PortalTransport({'/api/hub/search/': FakeResponse({'result': {}})})
+    assert registry.detect(transport, 'https://europa.test') == 'DataEuropa'
+
+
+def test_html_pages_are_not_portals():
+    transport = PortalTransport({'/api/records/': FakeResponse({}, content_type='text/html'),
+                                 '/api/hub/search/': FakeResponse(status_code=500)})
+    assert registry.detect(transport, 'https://other.test') is None
+
+
+def test_probes_run_at_the_same_time():
+    transport = PortalTransport({'/api/hub/search/': FakeResponse({'result': {}})}, delay=0.3)
+    start = time.monotonic()
+    assert registry.detect(transport, 'https://europa.test') == 'DataEuropa'
+    assert time.monotonic() - start < 0.5
+    assert len(transport.urls) == 2
+
+
+def test_unreachable_domains_time_out():
+    start = time.monotonic()
+    assert registry.detect(PortalTransport({}, delay=3), 'https://slow.test', timeout=0.2) is None
+    assert time.monotonic() - start < 1
+
+
+def test_detected_portal_is_reused_within_the_ttl(tmp_path):
+    path = str(tmp_path / 'dms_zenodo.test.json')
+    assert registry.load_detected(path, 3600) is None
+    registry.save_detected(path, 'Zenodo')
+    assert registry.load_detected(path, 3600) == 'Zenodo'
+    # A ttl of 0 always probes the portal again.
+    assert registry.load_detected(path, 0) is None
+
+    with open(path, 'w') as f:
+        json.dump({'dms': 'Zenodo', 'detected': time.time() - 7200}, f)
+    assert registry.load_detected(path, 3600) is None
+
+
+def test_broken_or_unknown_detections_are_ignored(tmp_path):
+    path = str(tmp_path / 'dms_other.test.json')
+    registry.save_detected(path, 'Unknown')
+    assert registry.load_detected(path, 3600) is None
+    with open(path, 'w') as f:
+        f.write('{"dms": "Zen')
+    assert registry.load_detected(path, 3600) is None
+    assert os.path.exists(path)
+
+
+class EntryPoint():
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+class PluginCrawler():
+    probes = ['/api/3/action/package_list']
+
+    @classmethod
+    def matches(cls, response):
+        return response.status_code == 200
+
+
+def test_portals_are_imported_on_first_use():
+    assert registry.is_portal('Zenodo') and not registry.is_portal('Unknown')
+    assert registry.get_portal('Zenodo').__name__ == 'ZenodoCrawler'
+
+
+def test_plugins_add_portals(monkeypatch):
+    monkeypatch.setattr(registry, '_portals', None)
+    monkeypatch.setattr(registry, 'entry_points', lambda group: [
+        EntryPoint('CKAN', 'test_registry:PluginCrawler'), EntryPoint('Zenodo', 'test_registry:PluginCrawler')])
+    assert registry.get_portal('CKAN') is PluginCrawler
+    # Plugins do not replace the built-in portals.
+    assert registry.get_portal('Zenodo').__name__ == 'ZenodoCrawler'
+
+    transport = PortalTransport({'/api/3/action/package_list': FakeResponse({'result': []})})
+    assert registry.detect(transport, 'https://ckan.test') == 'CKAN'
@@ -0,0 +1,60 @@
+from opendatacrawler.scheduler import PriorityScheduler
+
+
+def package(id, modified=None, sizes=(), formats=(), publisher=None):
+    return {'custom:id': id, 'dct:modified': modified,
+            'dct:publisher': {'name': publisher} if publisher else None,
+            'dcat:distribution': [{'dcat:byteSize': size, 'dcat:mediaType': format}
+                                  for size, format in zip(sizes, formats or ['csv'] * len(sizes))]}
+
+
+def ids(packages):
+    return [item['custom:id'] if isinstance(item, dict) else item for item in packages]
+
+
+def test_most_recently_modified_first():
+    scheduler = PriorityScheduler(['modified'])
+    packages = [package('old', '2020-01-01'), package('new', '2024-05-01T10:00:00Z'),
+                package('unknown'), package('mid', '2022-03-01')]
+    assert ids(scheduler.reorder(packages)) == ['new', 'mid', 'old', 'unknown']
+
+
+def test_cheapest_packages_first():
+    scheduler = PriorityScheduler(['size'])
+    packages = [package('big', sizes=[5000, 5000]), package('small', sizes=[10]),
+                package('unknown', sizes=[None]), package('medium', sizes=['2000'])]
+    assert ids(scheduler.reorder(packages)) == ['small', 'medium', 'big', 'unknown']
+
+
+def test_keys_are_combined_in_order():
+    scheduler = PriorityScheduler(['publisher', 'size'], prefer=['ine', 'aemet'])
+    packages = [package('a', sizes=[1], publisher='other'), package('b', sizes=[100], publisher='aemet'),
+                package('c', sizes=[1000], publisher='ine'), package('d', sizes=[1], publisher='aemet')]
+    assert ids(scheduler.reorder(packages)) == ['c', 'd', 'b', 'a']
+
+
+def test_preferred_formats_first():
+    scheduler = PriorityScheduler(['format'], prefer=['CSV', 'json'])
+    packages = [package('pdf', sizes=[1], formats=['pdf']), package('json', sizes=[1, 1], formats=['pdf', 'json']),
+                package('csv', sizes=[1], formats=['csv'])]
+    assert ids(scheduler.reorder(packages)) == ['csv', 'json', 'pdf']
+
+
+def test_reordering_is_bounded_by_the_window():
+    scheduler = PriorityScheduler(['size'], window=2)
+    packages = [package(str(size), sizes=[size]) for size in (50, 40, 30, 20, 10)]
+    # Only the two packages held back can be overtaken.
+    assert ids(scheduler.reorder(packages)) == ['30', '20', '10', '40', '50']
+
+
+def test_plain_ids_pass_through():
+    scheduler = PriorityScheduler(['size'])
+    assert ids(scheduler.reorder(['x', package('a', sizes=[2]), 'y', package('b', sizes=[1])])) \
+        == ['x', 'y', 'b', 'a']
+
+
+def test_smallest_resources_first_only_with_size():
+    resources = [{'dcat:byteSize': 30}, {'dcat:byteSize': None}, {'dcat:byteSize': '5'}]
+    assert PriorityScheduler(['size', 'modified']).sort_resources(resources) == \
+        [resources[2], resources[0], resources[1]]
+    assert PriorityScheduler(['modified']).sort_resources(resources) == resources
@@ -0,0 +1,147 @@
+import gzip
+import json
+import os
+import pytest
+from opendatacrawler.utils.sinks import BackgroundWriter, JsonFileSink, JsonLinesSink, ParquetSink, create_sink
+
+
+def read_shard(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line)['custom:id'] for line in f]
+
+
+def test_shards_roll_every_shard_size_packages(tmp_path):
+    sink = JsonLinesSink(str(tmp_path), shard_size=2)
+    for id in 'abcde':
+        sink.write({'custom:id': id})
+    sink.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['meta_00000.jsonl.gz', 'meta_00001.jsonl.gz',
+                                                  'meta_00002.jsonl.gz']
+    assert read_shard(str(tmp_path / 'meta_00002.jsonl.gz')) == ['e']
+
+
+def test_every_run_starts_a_new_shard(tmp_path):
+    for id in 'ab':
+        sink = JsonLinesSink(str(tmp_path))
+        sink.write({'custom:id': id})
+        sink.close()
+    assert read_shard(str(tmp_path / 'meta_00000.jsonl.gz')) == ['a']
+    assert read_shard(str(tmp_path / 'meta_00001.jsonl.gz')) == ['b']
+
+
+def test_json_files_are_fanned_out(tmp_path):
+    sink = JsonFileSink(str(tmp_path), fanout=True)
+    sink.write({'custom:id': 'abcdef', 'dct:title': 'Título'})
+    with open(str(tmp_path / 'ab' / 'cd' / 'meta_abcdef.json'), encoding='utf-8') as f:
+        assert json.load(f)['dct:title'] == 'Título'
+
+
+def test_callbacks_run_once_written(tmp_path):
+    writer = BackgroundWriter(create_sink(str(tmp_path), 'jsonl', 'gzip'))
+    done = []
+    for id in 'abc':
+        writer.write({'custom:id': id}, lambda id=id: done.append(id))
+    writer.close()
+    assert done == ['a', 'b', 'c']
+    assert read_shard(str(tmp_path / 'meta_00000.jsonl.gz')) == ['a', 'b', 'c']
+
+
+def test_callbacks_wait_for_flush(tmp_path):
+    sink = JsonLinesSink(str(tmp_path))
+    sink.flush_interval = 3600
+    writer = BackgroundWriter(sink)
+    done = []
+    for id in ('a', 'b'):
+        writer.write({'custom:id': id}, lambda id=id: done.append(id))
+    writer.flush()
+    assert done == ['a', 'b']
+    assert read_shard(str(tmp_path / 'meta_00000.jsonl.gz')) == ['a', 'b']
+    writer.close()
+    assert not os.path.exists(str(tmp_path / 'meta_00000.jsonl.gz.flushed'))
+
+
+def test_flush_every_flush_size_packages(tmp_path):
+    sink = JsonLinesSink(str(tmp_path))
+    sink.flush_size = 2
+    sink.flush_interval = 3600
+    writer = BackgroundWriter(sink)
+    done = []
+    for id in ('a', 'b', 'c'):
+        writer.write({'custom:id': id}, lambda id=id: done.append(id))
+    writer.flush()
+    writer.close()
+    assert done == ['a', 'b', 'c']
+
+
+def test_killed_shard_is_cut_back_to_last_flush(tmp_path):
+    sink = JsonLinesSink(str(tmp_path))
+    sink.write({'custom:id': 'a'})
+    sink.flush()
+    sink.write({'custom:id': 'b'})
+    # Killed before b was flushed: the shard holds part of an unfinished member.
+    sink.stream.flush()
+    sink.raw.flush()
+
+    JsonLinesSink(str(tmp_path))
+    assert read_shard(str(tmp_path / 'meta_00000.jsonl.gz')) == ['a']
+    assert os.listdir(str(tmp_path)) == ['meta_00000.jsonl.gz']
+
+
+def test_shard_without_flush_is_removed(tmp_path):
+    sink = JsonLinesSink(str(tmp_path))
+    sink.write({'custom:id': 'a'})
+
+    sink = JsonLinesSink(str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
+    assert sink.shard == 0
+
+
+@pytest.fixture
+def parquet():
+    return pytest.importorskip('pyarrow.parquet')
+
+
+def read_parquet(parquet, path):
+    return parquet.read_table(path).column('custom:id').to_pylist()
+
+
+def test_parquet_flushes_append_row_groups(tmp_path, parquet):
+    sink = ParquetSink(str(tmp_path))
+    for ids in ('abc', 'de'):
+        for id in ids:
+            sink.write({'custom:id': id, 'dcat:keyword': [id]})
+        sink.flush()
+    sink.close()
+    assert os.listdir(str(tmp_path)) == ['meta_00000.parquet']
+    assert parquet.ParquetFile(str(tmp_path / 'meta_00000.parquet')).num_row_groups == 2
+    table = parquet.read_table(str(tmp_path / 'meta_00000.parquet'))
+    assert table.column('custom:id').to_pylist() == list('abcde')
+    assert table.column('dcat:keyword').to_pylist()[0] == '["a"]'
+
+
+def test_parquet_shards_roll_on_size(tmp_path, parquet):
+    sink = ParquetSink(str(tmp_path), shard_size=2)
+    for id in 'abcde':
+        sink.write({'custom:id': id})
+        sink.flush()
+    sink.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['meta_00000.parquet', 'meta_00001.parquet',
+                                                  'meta_00002.parquet']
+    assert read_parquet(parquet, str(tmp_path / 'meta_00002.parquet')) == ['e']
+
+
+def test_killed_parquet_shard_keeps_its_flushed_rows(tmp_path, parquet):
+    sink = ParquetSink(str(tmp_path))
+    writer = BackgroundWriter(sink)
+    done = []
+    for id in 'ab':
+        writer.write({'custom:id': id}, lambda id=id: done.append(id))
+    writer.flush()
+    sink.write({'custom:id': 'c'})
+    # Killed: the shard has no footer and c was never flushed.
+    assert done == ['a', 'b']
+
+    sink = ParquetSink(str(tmp_path))
+    assert os.listdir(str(tmp_path)) == ['meta_00000.parquet']
+    assert read_parquet(parquet, str(tmp_path / 'meta_00000.parquet')) == ['a', 'b']
+    assert sink.shard == 1
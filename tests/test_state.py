@@ -0,0 +1,142 @@
+import sqlite3
+from opendatacrawler.utils.state import CrawlState
+
+
+def open_state(tmp_path):
+    return CrawlState(str(tmp_path / 'state.sqlite'), flush_interval=3600)
+
+
+def test_first_run_is_not_resumed(tmp_path):
+    state = open_state(tmp_path)
+    assert state.start_run() is False
+    assert state.run == 1
+    state.close()
+
+
+def test_interrupted_run_is_resumed(tmp_path):
+    state = open_state(tmp_path)
+    state.start_run()
+    state.enqueue('a')
+    state.enqueue('b')
+    state.mark_package('a', 'done')
+    state.mark_package('b', 'error', error='Metadata not obtained')
+    state.close()
+
+    state = open_state(tmp_path)
+    assert state.start_run() is True
+    assert state.run == 1
+    assert state.is_done('a')
+    assert not state.is_done('b')
+    assert state.get_package('b')['error'] == 'Metadata not obtained'
+    assert state.get_queued() == ['b']
+    state.close()
+
+
+def test_finished_run_starts_a_new_one(tmp_path):
+    state = open_state(tmp_path)
+    state.start_run()
+    state.enqueue('a')
+    state.mark_package('a', 'done')
+    state.finish_run()
+    assert state.last_complete_started() == state.run_started
+    state.close()
+
+    state = open_state(tmp_path)
+    assert state.start_run() is False
+    assert state.run == 2
+    # Packages of previous runs are kept but do not count as done.
+    assert state.get_package('a')['status'] == 'done'
+    assert not state.is_done('a')
+    assert state.get_queued() == []
+    state.close()
+
+
+def test_legacy_resume_file_is_imported(tmp_path):
+    resume = tmp_path / 'resume_portal.txt'
+    resume.write_text('a\nb\n')
+    state = open_state(tmp_path)
+    assert state.start_run(legacy_resume_path=str(resume)) is True
+    assert state.is_done('a') and state.is_done('b')
+    assert not resume.exists()
+    state.close()
+
+
+def test_checkpoints_are_dropped_when_the_run_finishes(tmp_path):
+    state = open_state(tmp_path)
+    state.start_run()
+    state.set_checkpoint('sparql:a', 'x')
+    assert state.get_checkpoint('sparql:a') == 'x'
+    state.flush()
+    state.finish_run()
+    state.start_run()
+    assert state.get_checkpoint('sparql:a') is None
+    keys = [row[0] for row in state.conn.execute("SELECT key FROM meta WHERE key LIKE 'checkpoint:%'")]
+    assert keys == []
+    state.close()
+
+
+def test_checkpoints_survive_an_interruption(tmp_path):
+    state = open_state(tmp_path)
+    state.start_run()
+    state.set_checkpoint('sparql:a', 'x')
+    state.close()
+
+    state = open_state(tmp_path)
+    state.start_run()
+    assert state.get_checkpoint('sparql:a') == 'x'
+    state.close()
+
+
+def test_resources_are_read_before_and_after_flushing(tmp_path):
+    state = open_state(tmp_path)
+    state.start_run()
+    state.mark_resource('r1', 'p1', 'http://host/file.csv', 'done', bytes=3, path='data/r1.csv', checksum='abc')
+    assert state.get_resource('r1')['path'] == 'data/r1.csv'
+    assert state.find_resource_by_url('http://host/file.csv')['id'] == 'r1'
+    state.flush()
+    assert state.get_resource('r1')['checksum'] == 'abc'
+    assert state.find_resource_by_url('http://host/file.csv')['id'] == 'r1'
+    assert state.find_resource_by_url('http://host/other.csv') is None
+    state.close()
+
+
+def test_blob_refs_are_written_with_the_resources(tmp_path):
+    path = str(tmp_path / 'state.sqlite')
+    state = open_state(tmp_path)
+    state.start_run()
+    state.add_blob_ref('abc', 10)
+    state.add_blob_ref('abc', 10)
+    state.mark_resource('r1', 'p1', 'http://host/1.csv', 'done', checksum='abc')
+    assert state.get_blob_refs('abc') == 2
+
+    # Nothing is visible to other connections until the batch is flushed.
+    reader = sqlite3.connect(path)
+    assert reader.execute('SELECT COUNT(*) FROM blobs').fetchone()[0] == 0
+    assert reader.execute('SELECT COUNT(*) FROM resources').fetchone()[0] == 0
+    state.flush()
+    assert reader.execute('SELECT refs FROM blobs').fetchone()[0] == 2
+    assert reader.execute('SELECT COUNT(*) FROM resources').fetchone()[0] == 1
+
+    assert state.release_blob('abc') == 1
+    assert state.release_blob('abc') == 0
+    state.flush()
+    assert reader.execute('SELECT COUNT(*) FROM blobs').fetchone()[0] == 0
+    reader.close()
+    state.close()
+
+
+def test_releasing_an_unknown_blob(tmp_path):
+    state = open_state(tmp_path)
+    assert state.release_blob('missing') == -1
+    state.flush()
+    assert state.get_blob_refs('missing') == 0
+    state.close()
+
+
+def test_batches_are_flushed_when_full(tmp_path):
+    state = CrawlState(str(tmp_path / 'state.sqlite'), batch_size=10, flush_interval=3600)
+    state.start_run()
+    for i in range(10):
+        state.enqueue(str(i))
+    assert state.pending_queue == {}
+    state.close()
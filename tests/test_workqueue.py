@@ -0,0 +1,110 @@
+import time
+from opendatacrawler.utils.workqueue import WorkQueue
+
+
+def open_queue(tmp_path, **kwargs):
+    return WorkQueue(str(tmp_path / 'queue.sqlite'), **kwargs)
+
+
+def test_put_ignores_ids_already_queued(tmp_path):
+    queue = open_queue(tmp_path)
+    queue.put([('a', 'a'), ('b', {'dct:identifier': 'b'})])
+    queue.put([('a', 'other')])
+    assert queue.counts() == {'ready': 2}
+    assert dict(queue.lease('w1', 10)) == {'a': 'a', 'b': {'dct:identifier': 'b'}}
+    queue.close()
+
+
+def test_leased_packages_are_not_leased_again(tmp_path):
+    queue = open_queue(tmp_path)
+    queue.put([(str(i), i) for i in range(5)])
+    first = queue.lease('w1', 3)
+    second = queue.lease('w2', 3)
+    assert len(first) == 3 and len(second) == 2
+    assert not {id for id, _ in first} & {id for id, _ in second}
+    assert queue.lease('w3', 3) == []
+    queue.close()
+
+
+def test_ack_only_applies_to_the_owner(tmp_path):
+    queue = open_queue(tmp_path)
+    queue.put([('a', 'a')])
+    queue.lease('w1')
+    queue.ack('w2', ['a'])
+    assert queue.counts() == {'leased': 1}
+    queue.ack('w1', ['a'])
+    assert queue.counts() == {'done': 1}
+    queue.close()
+
+
+def test_released_packages_are_ready_again(tmp_path):
+    queue = open_queue(tmp_path)
+    queue.put([('a', 'a')])
+    queue.lease('w1')
+    queue.release('w1', ['a'])
+    assert queue.counts() == {'ready': 1}
+    assert queue.conn.execute('SELECT attempts FROM tasks').fetchone()[0] == 0
+    queue.close()
+
+
+def test_expired_leases_go_to_other_workers(tmp_path):
+    queue = open_queue(tmp_path, lease_time=0.1)
+    queue.put([('a', 'a')])
+    assert queue.lease('w1') == [('a', 'a')]
+    assert queue.lease('w2') == []
+    time.sleep(0.2)
+    assert queue.lease('w2') == [('a', 'a')]
+    # The first worker lost its lease, its ack is ignored.
+    queue.ack('w1', ['a'])
+    assert queue.counts() == {'leased': 1}
+    queue.close()
+
+
+def test_extended_leases_do_not_expire(tmp_path):
+    queue = open_queue(tmp_path, lease_time=0.3)
+    queue.put([('a', 'a')])
+    queue.lease('w1')
+    time.sleep(0.2)
+    queue.extend('w1', ['a'])
+    time.sleep(0.2)
+    assert queue.lease('w2') == []
+    queue.close()
+
+
+def test_packages_are_given_up_after_max_attempts(tmp_path):
+    queue = open_queue(tmp_path, lease_time=0.05, max_attempts=2)
+    queue.put([('a', 'a')])
+    queue.set_listed()
+    for _ in range(2):
+        assert queue.lease('w1') == [('a', 'a')]
+        time.sleep(0.1)
+    assert queue.lease('w1') == []
+    assert queue.counts() == {'failed': 1}
+    assert queue.is_finished()
+    queue.close()
+
+
+def test_finished_when_listed_and_nothing_left(tmp_path):
+    queue = open_queue(tmp_path)
+    queue.put([('a', 'a')])
+    assert not queue.is_finished()
+    queue.lease('w1')
+    queue.ack('w1', ['a'])
+    assert not queue.is_finished()
+    queue.set_listed()
+    assert queue.is_finished()
+    queue.reset()
+    assert queue.counts() == {} and not queue.is_listed()
+    queue.close()
+
+
+def test_failed_packages_are_retried_until_max_attempts(tmp_path):
+    queue = open_queue(tmp_path, max_attempts=2)
+    queue.put([('a', 'a')])
+    queue.lease('w1')
+    queue.fail('w1', ['a'])
+    assert queue.counts() == {'ready': 1}
+    queue.lease('w1')
+    queue.fail('w1', ['a'])
+    assert queue.counts() == {'failed': 1}
+    queue.close()
@@ -0,0 +1,181 @@
+import json
+import re
+import pytest
+from datetime import datetime, timedelta, timezone
+from opendatacrawler.portals import ZenodoCrawler as zenodo
+from opendatacrawler.portals.ZenodoCrawler import ZenodoCrawler, normalize_record
+from opendatacrawler.utils import utils
+
+
+class FakeResponse():
+    def __init__(self, data, status_code=200):
+        self.content = json.dumps(data).encode('utf-8')
+        self.status_code = status_code
+        self.headers = {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('HTTP {}'.format(self.status_code))
+
+
+class RecordTransport():
+    """ Serves /api/records/<id>, recording the urls"""
+
+    def __init__(self, records):
+        self.records = {str(record['id']): record for record in records}
+        self.urls = []
+
+    def get(self, url, params=None, headers=None, timeout=None, verify=True):
+        self.urls.append(url)
+        return FakeResponse(self.records[url.rsplit('/', 1)[-1]])
+
+
+class SearchTransport():
+    """ Serves the records search: the records of the date window of the
+        query, most recent first, page by page."""
+
+    def __init__(self, records):
+        self.records = records
+        self.searches = []
+
+    def get(self, url, params=None, headers=None, timeout=None, verify=True):
+        field, start, end = re.match(r'(\w+):\["(.+)" TO "(.+)"\}', params['q']).groups()
+        self.searches.append((field, start, end, params['page'], params['size']))
+        hits = sorted((record for record in self.records if start <= record[field] < end),
+                      key=lambda record: record[field], reverse=True)
+        first = (params['page'] - 1) * params['size']
+        links = {'next': 'more'} if first + params['size'] < len(hits) else {}
+        return FakeResponse({'hits': {'total': len(hits), 'hits': hits[first:first + params['size']]},
+                             'links': links})
+
+
+class Checkpoints():
+    def __init__(self):
+        self.values = {}
+
+    def get_checkpoint(self, name):
+        return self.values.get(name)
+
+    def set_checkpoint(self, name, value):
+        self.values[name] = value
+
+
+def dated_records(count):
+    start = datetime(2015, 1, 1)
+    return [dict(record(i), created=(start + timedelta(days=20 * i)).strftime('%Y-%m-%dT%H:%M:%S'),
+                 updated=(start + timedelta(days=20 * i + 5)).strftime('%Y-%m-%dT%H:%M:%S'))
+            for i in range(count)]
+
+
+def search_crawler(transport, checkpoints, since=None):
+    crawler = ZenodoCrawler('zenodo.org', None, transport=transport, checkpoints=checkpoints,
+                            window_workers=2, since=since)
+    crawler.page_size = 5
+    crawler.max_results = 10
+    return crawler
+
+
+def record(id, files=True, access='open'):
+    data = {
+        'id': id,
+        'created': '2021-01-01T00:00:00',
+        'updated': '2022-02-02T00:00:00',
+        'links': {'self_html': 'https://zenodo.org/records/{}'.format(id)},
+        'metadata': {'title': 'Record {}'.format(id), 'language': 'eng', 'keywords': ['a', 'b'],
+                     'access_right': access, 'license': {'id': 'cc-by-4.0'}}
+    }
+    if files:
+        data['files'] = [{'id': 'f{}'.format(id), 'key': 'table.CSV', 'size': 100,
+                          'links': {'self': 'https://zenodo.org/files/{}'.format(id)}}]
+    return data
+
+
+def test_records_are_normalized():
+    package = normalize_record('zenodo.org', record(7))
+    assert package['dct:identifier'] == 7
+    assert package['custom:id'] == utils.generate_hash('zenodo.org', 7)
+    assert package['dct:title'] == {'language': 'eng', 'label': 'Record 7'}
+    assert [keyword['label'] for keyword in package['dcat:keyword']] == ['a', 'b']
+    assert package['dct:modified'] == '2022-02-02T00:00:00'
+    assert package['dcat:distribution'] == [{
+        'dct:title': {'language': None, 'label': 'table.CSV'},
+        'dcat:downloadURL': 'https://zenodo.org/files/7',
+        'custom:resource_id': utils.generate_hash('zenodo.org', 'f7'),
+        'dcat:mediaType': 'csv',
+        'dcat:byteSize': 100,
+        'dct:rights': 'cc-by-4.0',
+        'custom:path': None
+    }]
+
+
+def test_packages_are_harvested_from_the_hits():
+    hits = [record(1), record(2, files=False), record(3, files=False, access='restricted')]
+    transport = RecordTransport([record(2)])
+    crawler = ZenodoCrawler('zenodo.org', None, transport=transport)
+    crawler.get_records = lambda: iter(hits)
+
+    packages = list(crawler.get_packages())
+    assert [package['dct:identifier'] for package in packages] == [1, 2, 3]
+    # Only the open record without files in its hit is requested on its own.
+    assert transport.urls == ['https://zenodo.org/api/records/2']
+    assert len(packages[1]['dcat:distribution']) == 1
+    assert packages[2]['dcat:distribution'] == []
+
+
+def test_windows_with_too_many_records_are_bisected():
+    records = dated_records(60)
+    transport = SearchTransport(records)
+    checkpoints = Checkpoints()
+    ids = [record['id'] for record in search_crawler(transport, checkpoints).get_records()]
+
+    assert sorted(ids) == list(range(60))
+    field, start, end = checkpoints.values['zenodo:bounds'].split('|')
+    assert (field, start) == ('created', '2013-01-01T00:00:00')
+    assert checkpoints.values['zenodo:created:{}/{}'.format(start, end)] == 'split'
+    # No window was paginated past max_results.
+    assert max(page * size for _, _, _, page, size in transport.searches) <= 10
+    assert all(value in ('split', 'done') for name, value in checkpoints.values.items() if name != 'zenodo:bounds')
+
+
+def test_finished_windows_are_not_listed_again():
+    transport = SearchTransport(dated_records(30))
+    checkpoints = Checkpoints()
+    list(search_crawler(transport, checkpoints).get_records())
+    transport.searches = []
+    assert list(search_crawler(transport, checkpoints).get_records()) == []
+    # Only the size of the harvest is asked for.
+    assert [page for _, _, _, page, _ in transport.searches] == [1]
+
+
+def test_delta_lists_the_records_updated_since():
+    records = dated_records(60)
+    since = datetime(2017, 1, 1, tzinfo=timezone.utc).timestamp()
+    checkpoints = Checkpoints()
+    ids = [record['id'] for record in search_crawler(SearchTransport(records), checkpoints, since).get_records()]
+
+    assert sorted(ids) == [record['id'] for record in records if record['updated'] >= '2017-01-01T00:00:00']
+    assert checkpoints.values['zenodo:bounds'].startswith('updated|2017-01-01T00:00:00|')
+
+
+def test_failed_window_is_resumed_by_the_next_listing(monkeypatch):
+    monkeypatch.setattr(zenodo, 'backoff', lambda attempt: 0)
+    transport = SearchTransport(dated_records(60))
+    failing = {'on': True}
+    search = transport.get
+
+    def flaky_get(url, params=None, **kwargs):
+        # The second page of the windows keeps failing.
+        if failing['on'] and params['page'] == 2:
+            return FakeResponse({}, status_code=503)
+        return search(url, params)
+    transport.get = flaky_get
+    checkpoints = Checkpoints()
+    ids = []
+    with pytest.raises(ConnectionError):
+        for record in search_crawler(transport, checkpoints).get_records():
+            ids.append(record['id'])
+    assert 1 in checkpoints.values.values()
+
+    failing['on'] = False
+    ids += [record['id'] for record in search_crawler(transport, checkpoints).get_records()]
+    assert sorted(ids) == list(range(60))